@@ -1,6 +1,19 @@
-import datetime
+import os
+import csv
+import time
+import uuid
+import hashlib
+import argparse
+import itertools
 import numpy as np
 
+import poll_data
+import poll_groups
+import poll_cube
+import poll_titles
+import poll_trace
+from poll_trace import span
+
 np.set_printoptions(suppress=True, formatter={ 'float_kind' : '{:0.2f}'.format })
 
 
@@ -11,24 +24,215 @@ BEATMAPSET_ID = 3
 TOPIC_ID      = 4
 NUM_YES       = 5
 NUM_NO        = 6
+TOPIC_TITLE   = 7
 
+CSV_PATH   = 'data/poll_history.csv'
+CHUNK_ROWS = 100000
+HASH_BLOCK = 1 << 20
 
-def datetime_to_int(txt):
-    txt = txt.decode('utf-8')
-    date_i = datetime.datetime(1970, 1, 1)
-    date_f = datetime.datetime.strptime(txt.split('+')[0], '%Y-%m-%dT%H:%M:%S')
-    return (date_f - date_i).total_seconds()
+# Rows printed from each end of the cache after an ingest
+PRINT_ROWS = 5
 
+# Poll end time is ISO-8601, e.g. 2018-01-09T03:28:26+00:00
+TIMESTAMP_LEN = 25
 
 usecols = (ROUND, END_TIME, GAMEMODE, BEATMAPSET_ID, TOPIC_ID, NUM_YES, NUM_NO,)
-converters = {
-    END_TIME: datetime_to_int
-}
+csv_dtype = [
+    (poll_data.ROUND,         np.int64),
+    (poll_data.END_TIME,      f'U{TIMESTAMP_LEN}'),
+    (poll_data.GAMEMODE,      np.int64),
+    (poll_data.BEATMAPSET_ID, np.int64),
+    (poll_data.TOPIC_ID,      np.int64),
+    (poll_data.NUM_YES,       np.int64),
+    (poll_data.NUM_NO,        np.int64),
+]
+
+
+def parse_timestamps(txt):
+    # Date and time parse in bulk through datetime64, the utc offset is read digit-wise off the code points
+    epoch = txt.astype('U19').astype('datetime64[s]').astype(np.int64)
+
+    chars = np.ascontiguousarray(txt).view(np.uint32).reshape(-1, TIMESTAMP_LEN)
+    has_offset = (chars[:, 19] == ord('+')) | (chars[:, 19] == ord('-'))
+    sign   = np.where(chars[:, 19] == ord('-'), -1, 1)
+    digits = chars[:, 20:].astype(np.int64) - ord('0')
+    offset = (digits[:, 0]*10 + digits[:, 1])*3600 + (digits[:, 3]*10 + digits[:, 4])*60
+
+    return epoch - np.where(has_offset, sign*offset, 0)
+
+
+def to_column(name, values):
+    dtype = poll_data.COLUMNS[name]
+    if len(values) > 0 and (values.min() < np.iinfo(dtype).min or values.max() > np.iinfo(dtype).max):
+        raise ValueError(f'Column {name} has values outside of the {dtype} range')
+
+    return values.astype(dtype)
+
+
+def parse_chunk(lines):
+    with span('ingest.loadtxt', rows=len(lines)):
+        rows = np.loadtxt(lines, delimiter=',', quotechar='"', usecols=usecols, dtype=csv_dtype, ndmin=1)
+
+    data = {}
+    with span('ingest.columns'):
+        for name in poll_data.COLUMNS:
+            values = parse_timestamps(rows[name]) if name == poll_data.END_TIME else rows[name]
+            data[name] = to_column(name, values)
+
+    with span('ingest.titles'):
+        data.update(poll_titles.parse_titles([ row[TOPIC_TITLE] for row in csv.reader(lines) ]))
+
+    return data
+
+
+def read_chunks(f, chunk_rows=CHUNK_ROWS):
+    # Yields (data, raw lines) so the caller can track the byte offset and hash of what was consumed
+    while True:
+        with span('ingest.read'):
+            lines = list(itertools.islice(f, chunk_rows))
+
+            # Split on newlines only, the same as the raw lines were. str.splitlines would also split a title at
+            # characters like \u2028 or \x1c, and its rows would no longer line up with the lines counted.
+            text = b''.join(lines).decode('utf-8').replace('\r\n', '\n').split('\n')
+            if text[-1] == '':
+                text.pop()
+
+        if len(lines) == 0:
+            return
+
+        yield parse_chunk(text), lines
+
+
+def hash_prefix(f, length):
+    prefix_hash = hashlib.sha1()
+    f.seek(0)
+
+    while length > 0:
+        block = f.read(min(length, HASH_BLOCK))
+        if len(block) == 0:
+            break
+
+        prefix_hash.update(block)
+        length -= len(block)
+
+    return prefix_hash
+
+
+def column_dtypes():
+    return dict({ name : dtype.str for name, dtype in poll_data.COLUMNS.items() }, **{ name : 'str' for name in poll_data.STRING_COLUMNS })
+
+
+def convert(csv_path=CSV_PATH, data_dir=poll_data.DATA_DIR, chunk_rows=CHUNK_ROWS, rebuild=False):
+    # Other processes ingesting into the same cache, like two windows watching the csv, wait their turn
+    with poll_data.lock(data_dir):
+        return ingest(csv_path, data_dir, chunk_rows, rebuild)
+
+
+def ingest(csv_path, data_dir, chunk_rows, rebuild):
+    # The meta file records how far into the csv the cache got. Only rows after that offset are parsed, unless the
+    # csv changed before it, in which case everything is rebuilt. A trailing line without a newline may still be
+    # mid-write, so its row is cached but not committed to the meta and is re-parsed on the next run. Every rebuild
+    # gets a new build id, so readers holding rows from before it know to reload instead of appending.
+    meta     = None if rebuild else poll_data.load_meta(data_dir)
+    new_rows = 0
+    t_start  = time.perf_counter()
+
+    with open(csv_path, 'rb') as f_csv:
+        csv_size = os.fstat(f_csv.fileno()).st_size
+        if meta is not None and meta['columns'] == column_dtypes() and meta['offset'] <= csv_size:
+            with span('ingest.verify_prefix', bytes=meta['offset']):
+                prefix_hash = hash_prefix(f_csv, meta['offset'])
+            if prefix_hash.hexdigest() != meta['prefix_hash']:
+                meta = None
+        else:
+            meta = None
+
+        if meta is None:
+            f_csv.seek(0)
+            prefix_hash = hashlib.sha1(f_csv.readline())
+            meta = { 'offset' : f_csv.tell(), 'committed_rows' : 0, 'build_id' : uuid.uuid4().hex }
+            print('Rebuilding cache')
+
+        f_csv.seek(meta['offset'])
+        offset = meta['offset']
+        committed_rows = meta['committed_rows']
+        previous_rows = meta.get('rows', 0)
+
+        # Anything past the committed rows is an uncommitted tail row or the remains of an interrupted run
+        f_columns = {}
+        for name, dtype in poll_data.COLUMNS.items():
+            f_columns[name] = open(poll_data.column_path(name, data_dir), 'ab')
+            f_columns[name].truncate(committed_rows*dtype.itemsize)
+
+        for name in poll_data.STRING_COLUMNS:
+            f_columns[name] = poll_titles.StringWriter(name, committed_rows, data_dir)
+
+        try:
+            for data, lines in read_chunks(f_csv, chunk_rows):
+                with span('ingest.write'):
+                    for name in poll_data.COLUMNS:
+                        f_columns[name].write(data[name].tobytes())
+                    for name in poll_data.STRING_COLUMNS:
+                        f_columns[name].write(data[name])
+                new_rows += len(data[poll_data.ROUND])
+
+                if not lines[-1].endswith(b'\n'):
+                    lines = lines[:-1]
+
+                for line in lines:
+                    prefix_hash.update(line)
+                    offset += len(line)
+                committed_rows += len(lines)
+        finally:
+            for f in f_columns.values():
+                f.close()
+
+    num_rows = meta['committed_rows'] + new_rows
+    poll_data.save_meta({
+        'rows'           : num_rows,
+        'committed_rows' : committed_rows,
+        'offset'         : offset,
+        'prefix_hash'    : prefix_hash.hexdigest(),
+        'columns'        : column_dtypes(),
+        'build_id'       : meta.get('build_id'),
+    }, data_dir)
+
+    # Grouping polls by map is kept next to the columns so launches don't redo it
+    with span('ingest.groups'):
+        poll_groups.update_groups(data_dir)
+
+    # Only the rows committed since the last ingest are counted into the cube, and only once something has asked
+    # for one
+    with span('ingest.cube'):
+        poll_cube.update_cube(data_dir, create=False)
+
+    # Same for the token index of the artists, titles and mappers
+    with span('ingest.index'):
+        poll_titles.update_index(data_dir)
+
+    # The uncommitted tail row of the last run is parsed again but isn't new
+    t_elapsed = time.perf_counter() - t_start
+    print(f'Parsed {num_rows - previous_rows} new rows in {t_elapsed:.2f}s ({new_rows/t_elapsed:.0f} rows/s), {num_rows} rows total')
+    return num_rows - previous_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rebuild', action='store_true', help='Re-parse the whole csv instead of appending new rows')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--trace', default=None, help='Write a chrome trace of the ingest stages to this file')
+    args = parser.parse_args()
 
-data = np.genfromtxt('data/poll_history.csv', delimiter=',', skip_header=1, usecols=usecols, converters=converters)
+    if args.trace is not None:
+        poll_trace.enable(args.trace)
 
-## Save as npy
-with open('data/player_skills.npy', 'wb') as f:
-    np.save(f, data)
+    with span('ingest'):
+        convert(chunk_rows=args.chunk_rows, rebuild=args.rebuild)
 
-print(data)
\ No newline at end of file
+    # Only the ends are read, the columns are mapped and may not fit in memory
+    columns = list(poll_data.load().values())
+    num_rows = len(columns[0])
+    print(np.column_stack([ column[:PRINT_ROWS] for column in columns ]))
+    if num_rows > PRINT_ROWS:
+        print('...')
+        print(np.column_stack([ column[max(num_rows - PRINT_ROWS, PRINT_ROWS):] for column in columns ]))
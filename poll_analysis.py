@@ -0,0 +1,278 @@
+import numpy as np
+
+import result_cache
+from poll_data import GAMEMODE, NUM_YES, NUM_NO
+from result_cache import memoize
+
+
+STD_GAMEMODE   = 0
+TAIKO_GAMEMODE = 1
+CATCH_GAMEMODE = 2
+MANIA_GAMEMODE = 3
+
+GAMEMODES = {
+    'std'   : STD_GAMEMODE,
+    'taiko' : TAIKO_GAMEMODE,
+    'catch' : CATCH_GAMEMODE,
+    'mania' : MANIA_GAMEMODE,
+}
+
+# Derived columns
+NUM_VOTES = 'num_votes'
+YES_RATIO = 'yes_ratio'
+
+LOVED_LEVELS = np.asarray([ 1.00, 0.95, 0.90, 0.85, 0.80, 0.75, 0.50 ])
+
+# Polls with a yes ratio above this are counted as passing
+LOVED_THRESHOLD = 0.85
+
+
+class GamemodePartition():
+
+    def __init__(self, poll_data):
+        # One stable sort by gamemode groups each mode's polls contiguously while keeping them in poll order,
+        # so every per-mode column below is a slice view rather than a masked copy
+        gamemode = np.asarray(poll_data[GAMEMODE])
+        self.order   = np.argsort(gamemode, kind='stable')
+        self.offsets = np.zeros(len(GAMEMODES) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(gamemode, minlength=len(GAMEMODES))[:len(GAMEMODES)])
+
+        self.columns = { name : np.asarray(column)[self.order] for name, column in poll_data.items() }
+        self.columns[NUM_VOTES] = self.columns[NUM_YES].astype(np.int64) + self.columns[NUM_NO]
+        self.columns[YES_RATIO] = self.columns[NUM_YES]/self.columns[NUM_VOTES]
+
+        # Per-mode views plus sort orders, the latter as indices local to each mode's slice
+        self.modes       = {}
+        self.ratio_order = {}
+        self.votes_order = {}
+
+        for name, gamemode in GAMEMODES.items():
+            select = slice(self.offsets[gamemode], self.offsets[gamemode + 1])
+            self.modes[name] = { column_name : column[select] for column_name, column in self.columns.items() }
+
+            self.ratio_order[name] = np.argsort(self.modes[name][YES_RATIO], kind='stable')
+            self.votes_order[name] = np.argsort(self.modes[name][NUM_VOTES], kind='stable')
+
+
+        self.__fingerprint = None
+
+
+    def append(self, poll_data):
+        # New polls go on the end of their mode's slice. Modes they land in get the new polls merged into their sort
+        # orders, which in a stable sort come after equal old ones. Other modes keep their orders as they are.
+        # Returns the names of the modes that got new polls.
+        delta = GamemodePartition(poll_data)
+        changed = [ name for name in GAMEMODES if len(delta[name][YES_RATIO]) > 0 ]
+
+        self.order = np.concatenate([ part for gamemode in GAMEMODES.values() for part in (
+            self.order[self.offsets[gamemode]:self.offsets[gamemode + 1]], len(self.order) + delta.order[delta.offsets[gamemode]:delta.offsets[gamemode + 1]]) ])
+        self.offsets = self.offsets + delta.offsets
+        self.columns = { column_name : np.concatenate([ part for name in GAMEMODES for part in (self.modes[name][column_name], delta[name][column_name]) ])
+            for column_name in self.columns }
+
+        for name, gamemode in GAMEMODES.items():
+            select = slice(self.offsets[gamemode], self.offsets[gamemode + 1])
+            old_mode = self.modes[name]
+            self.modes[name] = { column_name : column[select] for column_name, column in self.columns.items() }
+
+            if name in changed:
+                self.ratio_order[name] = merge_order(old_mode[YES_RATIO], self.ratio_order[name], delta[name][YES_RATIO], delta.ratio_order[name])
+                self.votes_order[name] = merge_order(old_mode[NUM_VOTES], self.votes_order[name], delta[name][NUM_VOTES], delta.votes_order[name])
+
+        self.__fingerprint = None
+        return changed
+
+
+    def __getitem__(self, name):
+        return self.modes[name]
+
+
+    @property
+    def fingerprint(self):
+        # Hashed once, memoized analyses key their results on it
+        if self.__fingerprint is None:
+            self.__fingerprint = result_cache.fingerprint(self.columns).hexdigest()
+
+        return self.__fingerprint
+
+
+    def __len__(self):
+        return len(self.order)
+
+
+    def sorted_yes_ratio(self, name):
+        return self[name][YES_RATIO][self.ratio_order[name]]
+
+
+def merge_order(values, order, new_values, new_order):
+    # Sort order of values followed by new_values, from the sort orders of each
+    positions = np.searchsorted(values[order], new_values[new_order], side='right')
+    return np.insert(order, positions, len(values) + new_order)
+
+
+def loved_curve(sorted_yes_percent, percent_threshold):
+    # Fraction of polls with a yes ratio >= each threshold. Exact for any thresholds, no matter the resolution
+    if len(sorted_yes_percent) == 0:
+        return np.full(len(percent_threshold), np.nan)
+
+    num_passing = len(sorted_yes_percent) - np.searchsorted(sorted_yes_percent, percent_threshold, side='left')
+    return num_passing/len(sorted_yes_percent)
+
+
+def loved_breakpoints(sorted_yes_percent, percent_threshold, loved_levels=LOVED_LEVELS):
+    # First threshold at which less than each fraction of polls pass. That is the first threshold above the
+    # yes ratio of the poll that is the m-th highest, where m is the least count with m/n >= loved level.
+    num_polls = len(sorted_yes_percent)
+    if num_polls == 0:
+        return np.full(len(loved_levels), np.nan)
+
+    num_loved = loved_counts(num_polls, loved_levels)
+    breakpoint_idx = np.searchsorted(percent_threshold, sorted_yes_percent[num_polls - num_loved], side='right')
+    return np.where(breakpoint_idx < len(percent_threshold), percent_threshold[np.minimum(breakpoint_idx, len(percent_threshold) - 1)], np.nan)
+
+
+def loved_counts(num_polls, loved_levels=LOVED_LEVELS):
+    # Least number of polls m with m/num_polls >= each loved level, guarding against the float product rounding
+    num_loved  = np.ceil(loved_levels*num_polls).astype(np.int64)
+    num_loved -= ((num_loved - 1)/num_polls >= loved_levels)
+    num_loved += (num_loved/num_polls < loved_levels)
+    return num_loved
+
+
+def bin_edges(values, num_bins):
+    # Equal width bins over the range of the values
+    return range_bin_edges(*((values.min(), values.max()) if len(values) > 0 else (0, 1)), num_bins)
+
+
+def range_bin_edges(low, high, num_bins):
+    # Widened around a single value like scipy does
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+
+    return np.linspace(low, high, num_bins + 1)
+
+
+def bin_index(values, edges):
+    # Bins are closed on the left, except the last which also holds values equal to the upper edge
+    return np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+
+
+def binned_mean(values, stat_values, edges):
+    return binned_stats(values, stat_values, edges, percentiles=())['mean']
+
+
+def binned_stats(values, stat_values, edges, percentiles=(25, 50, 75), density_edges=None):
+    # Count and mean come from bincount reductions. Percentiles need each bin's values in order, which one lexsort
+    # by (bin, value) gives for all bins at once, and are skipped along with the sort when none are asked for.
+    num_bins = len(edges) - 1
+    bin_idx  = bin_index(values, edges)
+    count    = np.bincount(bin_idx, minlength=num_bins)
+    total    = np.bincount(bin_idx, weights=stat_values, minlength=num_bins)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        results = {
+            'count' : count,
+            'mean'  : total/count,
+        }
+
+    if len(percentiles) > 0:
+        sorted_stats = stat_values[np.lexsort((stat_values, bin_idx))]
+        bin_start    = np.cumsum(count) - count
+        has_values   = count > 0
+
+        # Linear interpolation between closest ranks, same as np.percentile
+        results['percentiles'] = {}
+        for percentile in percentiles:
+            rank = bin_start + (percentile/100)*np.maximum(count - 1, 0)
+            low  = np.floor(rank).astype(np.int64)
+            high = np.ceil(rank).astype(np.int64)
+
+            low_value  = sorted_stats[np.minimum(low,  len(sorted_stats) - 1)] if len(sorted_stats) > 0 else np.zeros(num_bins)
+            high_value = sorted_stats[np.minimum(high, len(sorted_stats) - 1)] if len(sorted_stats) > 0 else np.zeros(num_bins)
+            results['percentiles'][percentile] = np.where(has_values, low_value + (rank - low)*(high_value - low_value), np.nan)
+
+    # 2D histogram over the same bins against a second set of edges for the stat values
+    if density_edges is not None:
+        num_density_bins = len(density_edges) - 1
+        flat_idx = bin_idx*num_density_bins + bin_index(stat_values, density_edges)
+        results['density'] = np.bincount(flat_idx, minlength=num_bins*num_density_bins).reshape(num_bins, num_density_bins)
+
+    return results
+
+
+def loved_mode(partition, name, percent_threshold, loved_levels=LOVED_LEVELS):
+    yes_percent = partition.sorted_yes_ratio(name)
+    return {
+        'loved_passing' : loved_curve(yes_percent, percent_threshold),
+        'breakpoints'   : loved_breakpoints(yes_percent, percent_threshold, loved_levels),
+    }
+
+
+@memoize
+def loved_results(partition, percent_threshold, loved_levels=LOVED_LEVELS):
+    return { name : loved_mode(partition, name, percent_threshold, loved_levels) for name in GAMEMODES }
+
+
+@memoize
+def loved_mode_results(partition, name, percent_threshold, loved_levels=LOVED_LEVELS):
+    # One mode of loved_results, for the windows that compute each mode as its own job
+    return loved_mode(partition, name, percent_threshold, loved_levels)
+
+
+def yes_vote_mode(partition, name, num_bins, percentiles=(25, 50, 75), density_edges=None):
+    votes = partition[name][NUM_VOTES]
+    edges = bin_edges(votes, num_bins)
+
+    results = binned_stats(votes, partition[name][YES_RATIO], edges, percentiles, density_edges)
+    results['bin_edges'] = edges
+    return results
+
+
+@memoize
+def yes_vote_results(partition, num_bins, percentiles=(25, 50, 75), density_edges=None):
+    return { name : yes_vote_mode(partition, name, num_bins, percentiles, density_edges) for name in GAMEMODES }
+
+
+@memoize
+def yes_vote_mode_results(partition, name, num_bins, percentiles=(25, 50, 75), density_edges=None):
+    # One mode of yes_vote_results, as for loved_mode_results
+    return yes_vote_mode(partition, name, num_bins, percentiles, density_edges)
+
+
+class ThresholdIndex():
+
+    def __init__(self, sorted_yes_ratio, threshold=LOVED_THRESHOLD):
+        # Polls pass when their yes ratio is above the threshold, so in ratio order the failing polls are
+        # always a prefix and moving the threshold only ever flips the polls between the old and new split
+        self.sorted_yes_ratio = sorted_yes_ratio
+        self.threshold   = threshold
+        self.num_failing = np.searchsorted(sorted_yes_ratio, threshold, side='right')
+
+
+    def __len__(self):
+        return len(self.sorted_yes_ratio)
+
+
+    @property
+    def num_passing(self):
+        return len(self) - self.num_failing
+
+
+    @property
+    def pass_percent(self):
+        return self.num_passing/len(self) if len(self) > 0 else np.nan
+
+
+    def split(self, threshold):
+        return np.searchsorted(self.sorted_yes_ratio, threshold, side='right')
+
+
+    def set_threshold(self, threshold):
+        # Returns the range of ratio sorted positions that flipped and whether they now pass
+        num_failing = self.split(threshold)
+        changed     = slice(min(num_failing, self.num_failing), max(num_failing, self.num_failing))
+        now_passing = num_failing < self.num_failing
+
+        self.threshold   = threshold
+        self.num_failing = num_failing
+        return changed, now_passing
@@ -0,0 +1,110 @@
+import warnings
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from result_cache import memoize
+from poll_analysis import GAMEMODES, NUM_VOTES, YES_RATIO, LOVED_LEVELS, bin_edges, bin_index
+
+
+# Resamples per task. Tasks are seeded by their index, so results don't depend on how many workers run them.
+TASK_RESAMPLES = 500
+
+# Upper bound on resamples x polls held at once inside a task
+BATCH_ELEMENTS = 1 << 22
+
+# The GUIs run the bootstrap from a pool thread, and forking a process that has other threads running can leave the
+# children holding locks nobody will release. Workers are started from a clean process instead.
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def resample_weights(rng, num_polls, num_resamples):
+    # A bootstrap resample is fully described by how many times each poll was drawn
+    return rng.multinomial(num_polls, np.full(num_polls, 1/num_polls), size=num_resamples)
+
+
+def bootstrap_task(seed, num_resamples, sorted_yes_ratio, bin_idx, num_bins, percent_threshold, loved_levels):
+    # Polls are in yes ratio order. Passing counts for every threshold in a batch of resamples are suffix sums of
+    # the draw counts, and per-bin mean yes ratios are ratio-weighted draw counts summed per bin.
+    rng = np.random.default_rng(seed)
+    num_polls  = len(sorted_yes_ratio)
+    batch_size = max(1, BATCH_ELEMENTS//max(num_polls, 1))
+
+    threshold_idx = np.searchsorted(sorted_yes_ratio, percent_threshold, side='left')
+
+    bin_order = np.argsort(bin_idx, kind='stable')
+    bin_count = np.bincount(bin_idx, minlength=num_bins)
+    has_polls = bin_count > 0
+    bin_start = (np.cumsum(bin_count) - bin_count)[has_polls]
+
+    loved_passing    = np.empty((num_resamples, len(percent_threshold)))
+    breakpoints      = np.empty((num_resamples, len(loved_levels)))
+    mean_yes_percent = np.full((num_resamples, num_bins), np.nan)
+
+    for batch_start in range(0, num_resamples, batch_size):
+        batch = slice(batch_start, min(batch_start + batch_size, num_resamples))
+        weights = resample_weights(rng, num_polls, batch.stop - batch.start)
+
+        num_passing = np.zeros((len(weights), num_polls + 1), dtype=np.int64)
+        num_passing[:, :-1] = np.cumsum(weights[:, ::-1], axis=1)[:, ::-1]
+        loved_passing[batch] = num_passing[:, threshold_idx]/num_polls
+
+        # Same definition as the printed table, the first threshold where fewer than each level of polls pass
+        for i, loved_level in enumerate(loved_levels):
+            below = loved_passing[batch] < loved_level
+            breakpoints[batch, i] = np.where(below.any(axis=1), percent_threshold[np.argmax(below, axis=1)], np.nan)
+
+        bin_weights = weights[:, bin_order]
+        bin_total   = np.add.reduceat(bin_weights, bin_start, axis=1)
+        bin_yes     = np.add.reduceat(bin_weights*sorted_yes_ratio[bin_order], bin_start, axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_yes_percent[batch, has_polls] = bin_yes/bin_total
+
+    return loved_passing, breakpoints, mean_yes_percent
+
+
+@memoize(ignore=('workers',))
+def bootstrap(partition, percent_threshold, num_bins, num_resamples=10000, confidence=0.95, seed=0, workers=None, loved_levels=LOVED_LEVELS):
+    # Confidence bands for the loved curve, its breakpoints and the per-bin mean yes ratio of each mode
+    percentile_band = [ 50*(1 - confidence), 50*(1 + confidence) ]
+    num_tasks = -(-num_resamples//TASK_RESAMPLES)
+
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(START_METHOD)) as pool:
+        futures = {}
+        for name, gamemode in GAMEMODES.items():
+            ratio_order      = partition.ratio_order[name]
+            sorted_yes_ratio = partition[name][YES_RATIO][ratio_order]
+            votes            = partition[name][NUM_VOTES][ratio_order]
+            bin_idx          = bin_index(votes, bin_edges(votes, num_bins))
+
+            # A selection can leave a mode without polls, which has nothing to resample
+            seeds = np.random.SeedSequence([ seed, gamemode ]).spawn(num_tasks)
+            futures[name] = [
+                pool.submit(bootstrap_task, seeds[i], min(TASK_RESAMPLES, num_resamples - i*TASK_RESAMPLES),
+                    sorted_yes_ratio, bin_idx, num_bins, percent_threshold, loved_levels)
+                for i in range(num_tasks)
+            ] if len(sorted_yes_ratio) > 0 else []
+
+        results = {}
+        for name in GAMEMODES:
+            if len(futures[name]) == 0:
+                results[name] = {
+                    'loved_passing'    : np.full((2, len(percent_threshold)), np.nan),
+                    'breakpoints'      : np.full((2, len(loved_levels)), np.nan),
+                    'mean_yes_percent' : np.full((2, num_bins), np.nan),
+                }
+                continue
+
+            loved_passing, breakpoints, mean_yes_percent = [ np.concatenate(parts) for parts in zip(*[ future.result() for future in futures[name] ]) ]
+
+            # Bins no resample drew a poll from stay nan
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                results[name] = {
+                    'loved_passing'    : np.nanpercentile(loved_passing,    percentile_band, axis=0),
+                    'breakpoints'      : np.nanpercentile(breakpoints,      percentile_band, axis=0),
+                    'mean_yes_percent' : np.nanpercentile(mean_yes_percent, percentile_band, axis=0),
+                }
+
+    return results
@@ -0,0 +1,187 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import poll_data
+from poll_data import ROUND, END_TIME, GAMEMODE, NUM_YES, NUM_NO
+from poll_analysis import GAMEMODES, LOVED_LEVELS, LOVED_THRESHOLD, loved_counts, range_bin_edges, bin_index
+
+
+# Rows read per block. Everything a block allocates is a few times this many values, whatever the history's length.
+CHUNK_ROWS = 1 << 20
+
+# Blocks handed to the workers ahead of the one being merged, which bounds the partials held at once
+BLOCKS_IN_FLIGHT = 2
+
+# How partials of each kind combine, anything not listed adds
+MERGE = {
+    'votes_min'      : np.minimum,
+    'votes_max'      : np.maximum,
+    'max_round'      : np.maximum,
+    'round_end_time' : np.maximum,
+}
+
+
+def read_block(data_dir, start, stop, columns):
+    # Workers map the column files themselves, so only block bounds go over to them
+    return { name : np.asarray(column[start:stop]) for name, column in poll_data.load(data_dir, columns).items() }
+
+
+def block_ranges(num_rows, chunk_rows=CHUNK_ROWS):
+    return [ (start, min(start + chunk_rows, num_rows)) for start in range(0, num_rows, chunk_rows) ]
+
+
+def merge(partial, other):
+    return { name : MERGE.get(name, np.add)(value, other[name]) for name, value in partial.items() }
+
+
+def map_reduce(block_fn, data_dir, num_rows, chunk_rows=CHUNK_ROWS, workers=None, *args):
+    # Partials are merged in block order as they come back, so float sums come out the same however many workers
+    # ran them. workers=0 runs every block in this process.
+    ranges  = block_ranges(num_rows, chunk_rows)
+    partial = None
+
+    if workers == 0:
+        for start, stop in ranges:
+            block = block_fn(data_dir, start, stop, *args)
+            partial = block if partial is None else merge(partial, block)
+
+        return partial
+
+    in_flight = (workers or os.cpu_count() or 1)*BLOCKS_IN_FLIGHT
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [ pool.submit(block_fn, data_dir, start, stop, *args) for start, stop in ranges[:in_flight] ]
+
+        for i in range(len(ranges)):
+            if i + in_flight < len(ranges):
+                futures.append(pool.submit(block_fn, data_dir, *ranges[i + in_flight], *args))
+
+            block = futures[i].result()
+            futures[i] = None
+            partial = block if partial is None else merge(partial, block)
+
+    return partial
+
+
+def range_block(data_dir, start, stop):
+    # First pass, the range of total votes per mode that the participation bins are spread over, and the last round
+    block = read_block(data_dir, start, stop, [ ROUND, GAMEMODE, NUM_YES, NUM_NO ])
+    votes = block[NUM_YES].astype(np.int64) + block[NUM_NO]
+
+    partial = {
+        'votes_min' : np.full(len(GAMEMODES), np.iinfo(np.int64).max),
+        'votes_max' : np.full(len(GAMEMODES), -1),
+        'max_round' : np.asarray(int(block[ROUND].max()) if stop > start else 0),
+    }
+    np.minimum.at(partial['votes_min'], block[GAMEMODE], votes)
+    np.maximum.at(partial['votes_max'], block[GAMEMODE], votes)
+    return partial
+
+
+def analysis_block(data_dir, start, stop, percent_threshold, vote_edges, ratio_edges, num_rounds, loved_threshold):
+    # Second pass. Every partial is a count, sum or max per mode, so blocks combine exactly in any grouping.
+    block     = read_block(data_dir, start, stop, [ ROUND, END_TIME, GAMEMODE, NUM_YES, NUM_NO ])
+    gamemode  = block[GAMEMODE].astype(np.int64)
+    votes     = block[NUM_YES].astype(np.int64) + block[NUM_NO]
+    yes_ratio = block[NUM_YES]/votes
+
+    num_modes      = len(GAMEMODES)
+    num_thresholds = len(percent_threshold)
+    num_bins       = vote_edges.shape[1] - 1
+    num_ratio_bins = len(ratio_edges) - 1
+
+    # Loved curve, how many polls have their yes ratio at or above exactly k thresholds
+    threshold_idx = np.searchsorted(percent_threshold, yes_ratio, side='right')
+    threshold_counts = np.bincount(gamemode*(num_thresholds + 1) + threshold_idx, minlength=num_modes*(num_thresholds + 1))
+
+    # Participation bins, each mode against its own edges
+    vote_bin = np.empty(len(votes), dtype=np.int64)
+    for gamemode_id in range(num_modes):
+        in_mode = gamemode == gamemode_id
+        vote_bin[in_mode] = bin_index(votes[in_mode], vote_edges[gamemode_id])
+
+    flat_bin   = gamemode*num_bins + vote_bin
+    flat_ratio = flat_bin*num_ratio_bins + bin_index(yes_ratio, ratio_edges)
+
+    # Per-round aggregates
+    flat_round = gamemode*num_rounds + block[ROUND]
+    round_end_time = np.zeros(num_modes*num_rounds, dtype=np.int64)
+    np.maximum.at(round_end_time, flat_round, block[END_TIME])
+
+    return {
+        'threshold_counts' : threshold_counts.reshape(num_modes, num_thresholds + 1),
+        'bin_count'        : np.bincount(flat_bin, minlength=num_modes*num_bins).reshape(num_modes, num_bins),
+        'bin_yes_total'    : np.bincount(flat_bin, weights=yes_ratio, minlength=num_modes*num_bins).reshape(num_modes, num_bins),
+        'bin_density'      : np.bincount(flat_ratio, minlength=num_modes*num_bins*num_ratio_bins).reshape(num_modes, num_bins, num_ratio_bins),
+        'round_polls'      : np.bincount(flat_round, minlength=num_modes*num_rounds).reshape(num_modes, num_rounds),
+        'round_votes'      : np.bincount(flat_round, weights=votes, minlength=num_modes*num_rounds).reshape(num_modes, num_rounds),
+        'round_yes_total'  : np.bincount(flat_round, weights=yes_ratio, minlength=num_modes*num_rounds).reshape(num_modes, num_rounds),
+        'round_passing'    : np.bincount(flat_round[yes_ratio > loved_threshold], minlength=num_modes*num_rounds).reshape(num_modes, num_rounds),
+        'round_end_time'   : round_end_time.reshape(num_modes, num_rounds),
+    }
+
+
+def loved_from_counts(threshold_counts, percent_threshold, loved_levels=LOVED_LEVELS):
+    # Same as loved_curve and loved_breakpoints on the sorted yes ratios. Polls passing a threshold are the ones
+    # at or above more thresholds than it, and the m-th highest poll sits in the highest count whose suffix holds m.
+    num_polls = int(threshold_counts.sum())
+    if num_polls == 0:
+        return np.full(len(percent_threshold), np.nan), np.full(len(loved_levels), np.nan)
+
+    suffix = np.cumsum(threshold_counts[::-1])[::-1]
+    loved_passing = suffix[1:]/num_polls
+
+    breakpoint_idx = np.count_nonzero(suffix[None, :] >= loved_counts(num_polls, loved_levels)[:, None], axis=1) - 1
+    breakpoints = np.where(breakpoint_idx < len(percent_threshold), percent_threshold[np.minimum(breakpoint_idx, len(percent_threshold) - 1)], np.nan)
+    return loved_passing, breakpoints
+
+
+def chunked_results(data_dir=poll_data.DATA_DIR, percent_threshold=np.linspace(0, 1, 1000), num_bins=20, ratio_edges=np.linspace(0, 1, 21),
+        loved_threshold=LOVED_THRESHOLD, chunk_rows=CHUNK_ROWS, workers=None):
+    # Loved curve and breakpoints, participation bins and per-round aggregates of every poll in the column cache,
+    # streamed through in blocks. Memory depends on the block size, threshold resolution, bins and number of rounds,
+    # never on the number of polls. Bin means and per-round means are float sums and match the in-memory
+    # analyses to rounding, counts and everything derived from them match exactly. Percentiles and medians aren't
+    # mergeable and are left out.
+    num_rows = poll_data.load_meta(data_dir)['rows']
+
+    ranges = map_reduce(range_block, data_dir, num_rows, chunk_rows, workers)
+    if ranges is None:
+        ranges = range_block(data_dir, 0, 0)
+
+    vote_edges = np.asarray([ range_bin_edges(*((low, high) if high >= 0 else (0, 1)), num_bins) for low, high in zip(ranges['votes_min'], ranges['votes_max']) ])
+    num_rounds = int(ranges['max_round']) + 1
+
+    args = (percent_threshold, vote_edges, ratio_edges, num_rounds, loved_threshold)
+    partial = map_reduce(analysis_block, data_dir, num_rows, chunk_rows, workers, *args)
+    if partial is None:
+        partial = analysis_block(data_dir, 0, 0, *args)
+
+    results = {}
+    for name, gamemode in GAMEMODES.items():
+        loved_passing, breakpoints = loved_from_counts(partial['threshold_counts'][gamemode], percent_threshold)
+
+        round_polls = partial['round_polls'][gamemode]
+        has_polls   = round_polls > 0
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            results[name] = {
+                'loved_passing' : loved_passing,
+                'breakpoints'   : breakpoints,
+                'yes_vote'      : {
+                    'count'     : partial['bin_count'][gamemode],
+                    'mean'      : partial['bin_yes_total'][gamemode]/partial['bin_count'][gamemode],
+                    'density'   : partial['bin_density'][gamemode],
+                    'bin_edges' : vote_edges[gamemode],
+                },
+                'rounds'        : {
+                    'round'          : np.flatnonzero(has_polls),
+                    'end_time'       : partial['round_end_time'][gamemode][has_polls],
+                    'num_polls'      : round_polls[has_polls],
+                    'mean_votes'     : partial['round_votes'][gamemode][has_polls]/round_polls[has_polls],
+                    'mean_yes_ratio' : partial['round_yes_total'][gamemode][has_polls]/round_polls[has_polls],
+                    'pass_rate'      : partial['round_passing'][gamemode][has_polls]/round_polls[has_polls],
+                },
+            }
+
+    return results
@@ -0,0 +1,290 @@
+import os
+import json
+import numpy as np
+
+import poll_data
+from poll_data import ROUND, GAMEMODE, NUM_YES, NUM_NO
+from poll_analysis import GAMEMODES
+
+
+CUBE_FILE = 'cube.bin'
+CUBE_META = 'cube.json'
+
+# Steps between 0 and 1 of the yes ratio thresholds the cube counts at. Thresholds are made as k/CUBE_RESOLUTION,
+# so one like 0.8 is exactly a grid point.
+CUBE_RESOLUTION = 1000
+
+# Counts are int32, a mode would need 2^31 polls to overflow one
+COUNT_DTYPE = np.dtype('<i4')
+
+# Rounds counted at once, which bounds the histogram of an append to this many rows of the cube
+BLOCK_ROUNDS = 256
+
+# Rows of the column cache read at once when counting them into the saved cube
+CHUNK_ROWS = 1 << 20
+
+
+class LovedCube():
+
+    def __init__(self, thresholds, first_round=0, passing=None):
+        # passing[r, mode, t] counts the polls of each mode in rounds first_round to first_round + r - 1 with a yes
+        # ratio at or above thresholds[t], so any round range is a difference of two rows. The first threshold is
+        # 0, which every poll is at or above, so passing[r, mode, 0] counts all of them. Rows are whole rounds
+        # one after the other, the saved cube is a file of them that new rounds are appended to.
+        self.thresholds  = thresholds
+        self.first_round = first_round
+        self.passing     = np.zeros((1, len(GAMEMODES), len(thresholds)), dtype=COUNT_DTYPE) if passing is None else passing
+
+        # Polls counted into a small cube of their own, like the uncommitted last row of the saved one
+        self.tail = None
+
+
+    @property
+    def num_rounds(self):
+        # Rounds first_round to last_round are covered
+        return len(self.passing) - 1
+
+
+    @property
+    def last_round(self):
+        return self.first_round + self.num_rounds - 1
+
+
+    def append(self, poll_data):
+        # Histograms the new polls by round, mode and how many grid thresholds they reach, a block of rounds at a
+        # time, and adds the running totals to the cumulative rows from their first round on. Appending polls of
+        # the latest rounds only touches those rounds' rows.
+        rounds, gamemode, bucket = poll_buckets(poll_data, self.thresholds)
+        if len(rounds) == 0:
+            return
+
+        if np.any(rounds[1:] < rounds[:-1]):
+            order = np.argsort(rounds, kind='stable')
+            rounds, gamemode, bucket = rounds[order], gamemode[order], bucket[order]
+
+        first_round, last_round = int(rounds[0]), int(rounds[-1])
+        self.__cover(first_round, last_round)
+
+        num_modes, num_thresholds = len(GAMEMODES), len(self.thresholds)
+        carry = np.zeros((num_modes, num_thresholds), dtype=np.int64)
+
+        for block_first in range(first_round, last_round + 1, BLOCK_ROUNDS):
+            num_block_rounds = min(BLOCK_ROUNDS, last_round + 1 - block_first)
+            start, stop = np.searchsorted(rounds, [ block_first, block_first + num_block_rounds ])
+
+            # Bucket k holds polls at or above exactly k thresholds, the ones at or above threshold t are buckets past t
+            flat   = ((rounds[start:stop] - block_first)*num_modes + gamemode[start:stop])*(num_thresholds + 1) + bucket[start:stop]
+            counts = np.bincount(flat, minlength=num_block_rounds*num_modes*(num_thresholds + 1)).reshape(num_block_rounds, num_modes, num_thresholds + 1)
+            block_passing = np.cumsum(np.cumsum(counts[:, :, :0:-1], axis=2)[:, :, ::-1], axis=0) + carry
+
+            row = block_first - self.first_round + 1
+            self.passing[row:row + num_block_rounds] += block_passing
+            carry = block_passing[-1]
+
+        self.passing[last_round - self.first_round + 2:] += carry
+
+
+    def __cover(self, first_round, last_round):
+        # Rows for rounds before the first are zeros put in front, rows for rounds past the last repeat it
+        if self.num_rounds == 0:
+            self.first_round = first_round
+        elif first_round < self.first_round:
+            zeros = np.zeros((self.first_round - first_round,) + self.passing.shape[1:], dtype=self.passing.dtype)
+            self.passing     = np.concatenate([ zeros, self.passing ])
+            self.first_round = first_round
+
+        if last_round > self.last_round:
+            self.passing = np.concatenate([ self.passing, np.repeat(self.passing[-1:], last_round - self.last_round, axis=0) ])
+
+
+    def __window(self, first_round, last_round):
+        # Rows bounding rounds first_round to last_round, either end may be left out and is clipped to the cube
+        start = 0 if first_round is None else min(max(int(first_round) - self.first_round, 0), self.num_rounds)
+        stop  = self.num_rounds if last_round is None else min(max(int(last_round) + 1 - self.first_round, start), self.num_rounds)
+        return start, stop
+
+
+    def __counts(self, name, first_round, last_round, t):
+        # Polls of the mode in the round range at or above thresholds[t], t being an index or a slice of them
+        start, stop = self.__window(first_round, last_round)
+        counts = self.passing[stop, GAMEMODES[name], t].astype(np.int64) - self.passing[start, GAMEMODES[name], t]
+        if self.tail is not None:
+            counts = counts + self.tail.__counts(name, first_round, last_round, t)
+
+        return counts
+
+
+    def threshold_index(self, threshold):
+        # Grid threshold a pass rate is read at, the first at or above the one asked for
+        return min(int(np.searchsorted(self.thresholds, threshold, side='left')), len(self.thresholds) - 1)
+
+
+    def grid_threshold(self, threshold):
+        # The threshold counts are actually read at, for saying so next to them
+        return float(self.thresholds[self.threshold_index(threshold)])
+
+
+    def num_polls(self, name, first_round=None, last_round=None):
+        return int(self.__counts(name, first_round, last_round, 0))
+
+
+    def num_passing(self, name, threshold, first_round=None, last_round=None):
+        return int(self.__counts(name, first_round, last_round, self.threshold_index(threshold)))
+
+
+    def pass_rate(self, name, threshold, first_round=None, last_round=None):
+        # Share of a mode's polls in the round range with a yes ratio at or above the threshold, in O(1)
+        num_polls = self.num_polls(name, first_round, last_round)
+        return self.num_passing(name, threshold, first_round, last_round)/num_polls if num_polls > 0 else np.nan
+
+
+    def loved_curve(self, name, first_round=None, last_round=None):
+        # Same as poll_analysis.loved_curve over the cube's thresholds for the polls in the round range
+        passing = self.__counts(name, first_round, last_round, slice(None))
+        if passing[0] == 0:
+            return np.full(len(self.thresholds), np.nan)
+
+        return passing/passing[0]
+
+
+def cube_thresholds(resolution=CUBE_RESOLUTION):
+    return np.arange(resolution + 1)/resolution
+
+
+def poll_buckets(poll_data, thresholds):
+    # Round and mode of each poll, and how many of the thresholds its yes ratio is at or above
+    rounds    = np.asarray(poll_data[ROUND]).astype(np.int64)
+    gamemode  = np.asarray(poll_data[GAMEMODE]).astype(np.int64)
+    num_yes   = np.asarray(poll_data[NUM_YES]).astype(np.int64)
+    yes_ratio = num_yes/(num_yes + poll_data[NUM_NO])
+
+    return rounds, gamemode, np.searchsorted(thresholds, yes_ratio, side='right')
+
+
+def build_cube(poll_data, resolution=CUBE_RESOLUTION):
+    # In memory, over only the rounds the polls are from
+    cube = LovedCube(cube_thresholds(resolution))
+    cube.append(poll_data)
+    return cube
+
+
+def cube_paths(data_dir=poll_data.DATA_DIR):
+    return os.path.join(data_dir, CUBE_FILE), os.path.join(data_dir, CUBE_META)
+
+
+def read_cube_meta(data_dir=poll_data.DATA_DIR):
+    # Rows and build the saved cube counts, its first round and how many it has, or None
+    _, meta_path = cube_paths(data_dir)
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+
+def save_cube_meta(cube_meta, data_dir=poll_data.DATA_DIR):
+    _, meta_path = cube_paths(data_dir)
+    with open(f'{meta_path}.tmp', 'w') as f:
+        json.dump(cube_meta, f, indent=4)
+
+    os.replace(f'{meta_path}.tmp', meta_path)
+
+
+def open_cube(cube_meta, path, mode='r'):
+    thresholds = cube_thresholds(cube_meta['resolution'])
+    passing    = np.memmap(path, dtype=COUNT_DTYPE, mode=mode, shape=(cube_meta['num_rounds'] + 1, len(GAMEMODES), len(thresholds)))
+    return LovedCube(thresholds, cube_meta['first_round'], passing)
+
+
+def extend_cube(cube_meta, path, last_round):
+    # Appends rows repeating the last one up to last_round, the only way the file ever grows
+    grow = last_round - (cube_meta['first_round'] + cube_meta['num_rounds'] - 1)
+    if grow <= 0:
+        return
+
+    last_row = open_cube(cube_meta, path).passing[-1:].copy()
+    with open(path, 'ab') as f:
+        for start in range(0, grow, BLOCK_ROUNDS):
+            f.write(np.repeat(last_row, min(BLOCK_ROUNDS, grow - start), axis=0).tobytes())
+
+    cube_meta['num_rounds'] += grow
+
+
+def remove_cube(data_dir=poll_data.DATA_DIR):
+    for path in cube_paths(data_dir):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def update_cube(data_dir=poll_data.DATA_DIR, resolution=CUBE_RESOLUTION, create=True):
+    # Counts the rows committed since the saved cube was brought up to date into it, a last line without its
+    # newline yet can still change. New polls add to the rows of their round onward in place and new rounds are
+    # appended, so an ingest of the latest round's polls costs those polls and a row or two. A cube that has to be
+    # counted from scratch is written to the side and swapped in, for readers still mapping the old one. The
+    # ingest passes create False, which leaves a missing or stale cube for the first reader that asks for one.
+    meta = poll_data.load_meta(data_dir)
+    committed_rows = meta['committed_rows']
+    cube_path, _ = cube_paths(data_dir)
+
+    cube_meta = read_cube_meta(data_dir)
+    if cube_meta is None or cube_meta['rows'] is None or cube_meta['build_id'] != meta.get('build_id') or cube_meta['rows'] > committed_rows or cube_meta['resolution'] != resolution:
+        cube_meta = None
+
+    if cube_meta is not None and cube_meta['rows'] == committed_rows:
+        return
+
+    columns = poll_data.load(data_dir, [ ROUND, GAMEMODE, NUM_YES, NUM_NO ])
+    rows = 0 if cube_meta is None else cube_meta['rows']
+
+    # Polls of rounds before the cube's first aren't expected, they'd shift every row
+    if cube_meta is not None and int(columns[ROUND][rows:committed_rows].min()) < cube_meta['first_round']:
+        cube_meta, rows = None, 0
+
+    if cube_meta is None:
+        if not create:
+            remove_cube(data_dir)
+            return
+
+        cube_meta = {
+            'rows'        : None,
+            'build_id'    : meta.get('build_id'),
+            'resolution'  : resolution,
+            'first_round' : int(columns[ROUND][:committed_rows].min()) if committed_rows > 0 else 0,
+            'num_rounds'  : 0,
+        }
+        path = f'{cube_path}.tmp'
+        with open(path, 'wb') as f:
+            f.write(np.zeros((1, len(GAMEMODES), resolution + 1), dtype=COUNT_DTYPE).tobytes())
+    else:
+        # Marked as being written, a crash part way through leaves it to be counted again
+        path = cube_path
+        save_cube_meta(dict(cube_meta, rows=None), data_dir)
+
+    for start in range(rows, committed_rows, CHUNK_ROWS):
+        chunk = { name : np.asarray(column[start:min(start + CHUNK_ROWS, committed_rows)]) for name, column in columns.items() }
+        extend_cube(cube_meta, path, int(chunk[ROUND].max()))
+
+        cube = open_cube(cube_meta, path, mode='r+')
+        cube.append(chunk)
+        cube.passing.flush()
+        del cube
+
+    if path != cube_path:
+        save_cube_meta(dict(cube_meta, rows=None), data_dir)
+        os.replace(path, cube_path)
+
+    save_cube_meta(dict(cube_meta, rows=committed_rows), data_dir)
+
+
+def load_cube(data_dir=poll_data.DATA_DIR):
+    # The saved cube, counted the first time one is asked for and brought up to date, plus any uncommitted last row
+    # counted in memory only
+    with poll_data.lock(data_dir):
+        update_cube(data_dir)
+        meta = poll_data.load_meta(data_dir)
+        cube = open_cube(read_cube_meta(data_dir), cube_paths(data_dir)[0])
+
+    if meta['rows'] > meta['committed_rows']:
+        cube.tail = build_cube({ name : column[meta['committed_rows']:meta['rows']] for name, column in poll_data.load(data_dir, [ ROUND, GAMEMODE, NUM_YES, NUM_NO ]).items() })
+
+    return cube
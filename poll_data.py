@@ -0,0 +1,158 @@
+import os
+import json
+import contextlib
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+DATA_DIR  = 'data/polls'
+META_FILE = 'meta.json'
+LOCK_FILE = '.lock'
+
+ROUND         = 'round'
+END_TIME      = 'end_time'
+GAMEMODE      = 'gamemode'
+BEATMAPSET_ID = 'beatmapset_id'
+TOPIC_ID      = 'topic_id'
+NUM_YES       = 'num_yes'
+NUM_NO        = 'num_no'
+
+# Each column is a raw little-endian array in its own file so it can be memory mapped on its own and appended to
+COLUMNS = {
+    ROUND         : np.dtype('<u2'),
+    END_TIME      : np.dtype('<i8'),
+    GAMEMODE      : np.dtype('u1'),
+    BEATMAPSET_ID : np.dtype('<u4'),
+    TOPIC_ID      : np.dtype('<u4'),
+    NUM_YES       : np.dtype('<u4'),
+    NUM_NO        : np.dtype('<u4'),
+}
+
+# Text of each poll, kept as one utf-8 buffer per column with the offset of every row's string in a second file.
+# The topic title has its html entities decoded, artist, title and mapper are split out of it.
+TOPIC_TITLE = 'topic_title'
+ARTIST      = 'artist'
+TITLE       = 'title'
+MAPPER      = 'mapper'
+
+STRING_COLUMNS = [ TOPIC_TITLE, ARTIST, TITLE, MAPPER ]
+
+
+class StringColumn():
+
+    def __init__(self, buffer, offsets):
+        # Strings are decoded one at a time as they're asked for, never all at once
+        self.buffer  = buffer
+        self.offsets = offsets
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+    def encoded(self, row):
+        return bytes(self.buffer[self.offsets[row]:self.offsets[row + 1]])
+
+
+    def __getitem__(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            return self.encoded(rows).decode('utf-8')
+
+        start, stop, step = rows.indices(len(self)) if isinstance(rows, slice) else (None, None, None)
+        if step == 1:
+            # A run of rows is one read of the buffer, split at their offsets
+            if stop <= start:
+                return []
+
+            encoded = bytes(self.buffer[self.offsets[start]:self.offsets[stop]])
+            offsets = (self.offsets[start:stop + 1] - self.offsets[start]).tolist()
+            return [ encoded[begin:end].decode('utf-8') for begin, end in zip(offsets[:-1], offsets[1:]) ]
+
+        if isinstance(rows, slice):
+            rows = range(start, stop, step)
+
+        return [ self.encoded(row).decode('utf-8') for row in rows ]
+
+
+def column_path(name, data_dir=DATA_DIR):
+    return os.path.join(data_dir, f'{name}.bin')
+
+
+def load_meta(data_dir=DATA_DIR):
+    meta_path = os.path.join(data_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+
+def save_meta(meta, data_dir=DATA_DIR):
+    # Written to the side and swapped in so a crash never leaves a half written meta file
+    meta_path = os.path.join(data_dir, META_FILE)
+    with open(f'{meta_path}.tmp', 'w') as f:
+        json.dump(meta, f, indent=4)
+
+    os.replace(f'{meta_path}.tmp', meta_path)
+
+
+@contextlib.contextmanager
+def lock(data_dir=DATA_DIR):
+    # Held by whatever writes to the cache, so processes ingesting into the same data directory take turns. Windows
+    # has no flock, writers there aren't kept apart.
+    os.makedirs(data_dir, exist_ok=True)
+    with open(os.path.join(data_dir, LOCK_FILE), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def open_column(name, num_rows, data_dir=DATA_DIR):
+    if num_rows == 0:
+        return np.empty(0, dtype=COLUMNS[name])
+
+    return np.memmap(column_path(name, data_dir), dtype=COLUMNS[name], mode='r', shape=(num_rows,))
+
+
+def load(data_dir=DATA_DIR, columns=None):
+    # Columns are memory mapped, so only the pages of the columns an analysis actually reads are loaded
+    meta = load_meta(data_dir)
+    if meta is None:
+        raise FileNotFoundError(f'No poll data in {data_dir}, run csv_to_npy.py first')
+
+    if columns is None:
+        columns = COLUMNS.keys()
+
+    return { name : open_column(name, meta['rows'], data_dir) for name in columns }
+
+
+def string_paths(name, data_dir=DATA_DIR):
+    return os.path.join(data_dir, f'{name}.str'), os.path.join(data_dir, f'{name}.offsets')
+
+
+def open_strings(name, num_rows, data_dir=DATA_DIR):
+    buffer_path, offsets_path = string_paths(name, data_dir)
+    offsets = np.memmap(offsets_path, dtype='<i8', mode='r', shape=(num_rows + 1,))
+    buffer  = np.memmap(buffer_path, dtype=np.uint8, mode='r', shape=(int(offsets[-1]),)) if offsets[-1] > 0 else np.empty(0, dtype=np.uint8)
+    return StringColumn(buffer, offsets)
+
+
+def load_strings(data_dir=DATA_DIR, columns=None):
+    # Memory mapped like the numeric columns
+    meta = load_meta(data_dir)
+    if meta is None:
+        raise FileNotFoundError(f'No poll data in {data_dir}, run csv_to_npy.py first')
+
+    if columns is None:
+        columns = STRING_COLUMNS
+
+    return { name : open_strings(name, meta['rows'], data_dir) for name in columns }
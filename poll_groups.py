@@ -0,0 +1,206 @@
+import os
+import numpy as np
+
+import poll_data
+from poll_data import GAMEMODE, BEATMAPSET_ID, NUM_YES, NUM_NO
+
+
+GROUPS_FILE = 'groups.npz'
+
+# Which poll stands for a map that was polled more than once
+KEEP_LATEST = 'latest'
+KEEP_BEST   = 'best'
+
+
+GROUP_COLUMNS = [ BEATMAPSET_ID, GAMEMODE, NUM_YES, NUM_NO ]
+
+
+def group_key(beatmapset_id, gamemode):
+    return (np.asarray(beatmapset_id).astype(np.uint64) << np.uint64(8)) | np.asarray(gamemode).astype(np.uint64)
+
+
+def group_polls(polls, start=0):
+    # Groups polls by (beatmapset, gamemode) with one stable sort on a combined key, so each map's polls are a run of
+    # the sort order in poll order. Everything per map comes out of reductions over those runs. The first poll is
+    # row start.
+    num_yes   = np.asarray(polls[NUM_YES]).astype(np.int64)
+    yes_ratio = num_yes/(num_yes + polls[NUM_NO])
+
+    key   = group_key(polls[BEATMAPSET_ID], polls[GAMEMODE])
+    order = np.argsort(key, kind='stable')
+    keys, starts, counts = np.unique(key[order], return_index=True, return_counts=True)
+
+    group_of_sorted = np.repeat(np.arange(len(keys)), counts)
+    group = np.empty(len(order), dtype=np.int64)
+    group[order] = group_of_sorted
+
+    # Best poll of a map is the last of its run once sorted by yes ratio within the run, the latest of any ties
+    sorted_yes_ratio = yes_ratio[order]
+    best_order = np.lexsort((sorted_yes_ratio, group_of_sorted))
+    best = best_order[starts + counts - 1] if len(keys) > 0 else starts
+
+    rows = order + start
+    return {
+        'beatmapset_id'    : (keys >> np.uint64(8)).astype(poll_data.COLUMNS[BEATMAPSET_ID]),
+        'gamemode'         : (keys & np.uint64(0xff)).astype(poll_data.COLUMNS[GAMEMODE]),
+        'num_polls'        : counts,
+        'offsets'          : np.append(starts, len(order)),
+        'rows'             : rows,
+        'yes_ratio'        : sorted_yes_ratio,
+        'group'            : group,
+        'first_row'        : rows[starts],
+        'latest_row'       : rows[starts + counts - 1],
+        'best_row'         : rows[best],
+        'latest_yes_ratio' : sorted_yes_ratio[starts + counts - 1],
+        'best_yes_ratio'   : sorted_yes_ratio[best],
+    }
+
+
+def merge_groups(groups, other):
+    # Grouping of both, other's rows all coming after these. A map's polls stay a run in poll order with the earlier
+    # ones first, so each run is placed by offset arithmetic and nothing is sorted again.
+    keys     = group_key(groups['beatmapset_id'], groups['gamemode'])
+    new_keys = group_key(other['beatmapset_id'], other['gamemode'])
+
+    place = np.searchsorted(keys, new_keys)
+    known = place < len(keys)
+    known[known] = keys[place[known]] == new_keys[known]
+
+    # Maps not polled before go in among the others, which move along by how many went in ahead of them
+    shift    = np.cumsum(np.bincount(place[~known], minlength=len(keys) + 1))
+    group    = np.arange(len(keys)) + shift[:-1]
+    all_keys = np.insert(keys, place[~known], new_keys[~known])
+
+    new_group = np.empty(len(new_keys), dtype=np.int64)
+    new_group[known]  = group[place[known]]
+    new_group[~known] = place[~known] + np.arange(np.count_nonzero(~known))
+
+    counts     = np.zeros(len(all_keys), dtype=np.int64)
+    new_counts = np.zeros(len(all_keys), dtype=np.int64)
+    counts[group]         = groups['num_polls']
+    new_counts[new_group] = other['num_polls']
+    offsets = np.append(0, np.cumsum(counts + new_counts))
+
+    # Where each poll of either sort order lands in the merged one, its run's new start plus its place in the run
+    positions     = np.repeat(offsets[group] - groups['offsets'][:-1], groups['num_polls']) + np.arange(len(groups['rows']))
+    new_positions = np.repeat(offsets[new_group] + counts[new_group] - other['offsets'][:-1], other['num_polls']) + np.arange(len(other['rows']))
+
+    rows = np.empty(offsets[-1], dtype=np.int64)
+    rows[positions]     = groups['rows']
+    rows[new_positions] = other['rows']
+
+    yes_ratio = np.empty(offsets[-1])
+    yes_ratio[positions]     = groups['yes_ratio']
+    yes_ratio[new_positions] = other['yes_ratio']
+
+    # A map's first poll is from the earlier rows if it has any there, its latest from the later ones
+    first_row = np.empty(len(all_keys), dtype=np.int64)
+    first_row[new_group] = other['first_row']
+    first_row[group]     = groups['first_row']
+
+    latest_row, latest_yes_ratio = np.empty(len(all_keys), dtype=np.int64), np.empty(len(all_keys))
+    latest_row[group],     latest_yes_ratio[group]     = groups['latest_row'], groups['latest_yes_ratio']
+    latest_row[new_group], latest_yes_ratio[new_group] = other['latest_row'], other['latest_yes_ratio']
+
+    # A later best poll takes over when its yes ratio is at least as high, NaN sorting above any number as in
+    # group_polls
+    best_row, best_yes_ratio = np.zeros(len(all_keys), dtype=np.int64), np.full(len(all_keys), np.nan)
+    best_row[group], best_yes_ratio[group] = groups['best_row'], groups['best_yes_ratio']
+
+    later = (counts[new_group] == 0) | np.isnan(other['best_yes_ratio']) | (other['best_yes_ratio'] >= best_yes_ratio[new_group])
+    best_row[new_group[later]], best_yes_ratio[new_group[later]] = other['best_row'][later], other['best_yes_ratio'][later]
+
+    return {
+        'beatmapset_id'    : (all_keys >> np.uint64(8)).astype(poll_data.COLUMNS[BEATMAPSET_ID]),
+        'gamemode'         : (all_keys & np.uint64(0xff)).astype(poll_data.COLUMNS[GAMEMODE]),
+        'num_polls'        : counts + new_counts,
+        'offsets'          : offsets,
+        'rows'             : rows,
+        'yes_ratio'        : yes_ratio,
+        'group'            : np.concatenate([ group[groups['group']], new_group[other['group']] ]),
+        'first_row'        : first_row,
+        'latest_row'       : latest_row,
+        'best_row'         : best_row,
+        'latest_yes_ratio' : latest_yes_ratio,
+        'best_yes_ratio'   : best_yes_ratio,
+    }
+
+
+def outcomes(groups, threshold):
+    # Pass/fail of every poll of every map in poll order, a run per map between consecutive offsets
+    return groups['yes_ratio'] > threshold
+
+
+def outcome_strings(groups, threshold):
+    # P for a pass and F for a fail per poll, for output only
+    letters = np.where(outcomes(groups, threshold), 'P', 'F')
+    return [ ''.join(run) for run in np.split(letters, groups['offsets'][1:-1]) ]
+
+
+def dedup_rows(groups, keep=KEEP_LATEST):
+    # One poll per map, in poll order
+    return np.sort(groups['latest_row'] if keep == KEEP_LATEST else groups['best_row'])
+
+
+def groups_path(data_dir=poll_data.DATA_DIR):
+    return os.path.join(data_dir, GROUPS_FILE)
+
+
+def save_groups(groups, rows, build_id, data_dir=poll_data.DATA_DIR):
+    # Stamped with the rows and build they were grouped from, written to the side and swapped in
+    path = groups_path(data_dir)
+    with open(f'{path}.tmp', 'wb') as f:
+        np.savez(f, rows_stamp=rows, build_stamp=str(build_id), **groups)
+
+    os.replace(f'{path}.tmp', path)
+
+
+def read_groups(data_dir=poll_data.DATA_DIR):
+    # The saved grouping and the rows and build it covers, or None
+    path = groups_path(data_dir)
+    if not os.path.exists(path):
+        return None, None, None
+
+    with np.load(path) as saved:
+        groups = { name : saved[name] for name in saved.files if not name.endswith('_stamp') }
+        return groups, int(saved['rows_stamp']), str(saved['build_stamp'])
+
+
+def group_rows(data_dir, start, stop):
+    return group_polls({ name : column[start:stop] for name, column in poll_data.load(data_dir, GROUP_COLUMNS).items() }, start)
+
+
+def update_groups(data_dir=poll_data.DATA_DIR):
+    # The ingest runs this after appending rows. As with the token index only committed rows go in the saved
+    # grouping, and only rows committed since it was saved are grouped and merged in.
+    meta = poll_data.load_meta(data_dir)
+    committed_rows = meta['committed_rows']
+    groups, rows, build_id = read_groups(data_dir)
+
+    if groups is None or build_id != str(meta.get('build_id')) or rows > committed_rows:
+        groups, rows = None, 0
+
+    if groups is None:
+        groups = group_rows(data_dir, 0, committed_rows)
+    elif committed_rows > rows:
+        groups = merge_groups(groups, group_rows(data_dir, rows, committed_rows))
+    else:
+        return groups
+
+    save_groups(groups, committed_rows, meta.get('build_id'), data_dir)
+    return groups
+
+
+def load_groups(data_dir=poll_data.DATA_DIR):
+    # The saved grouping brought up to date, plus any uncommitted last row merged in memory only. Bringing it up to
+    # date writes the file the ingest does, so it's done under the same lock.
+    with poll_data.lock(data_dir):
+        meta = poll_data.load_meta(data_dir)
+        groups, rows, build_id = read_groups(data_dir)
+        if groups is None or build_id != str(meta.get('build_id')) or rows != meta['committed_rows']:
+            groups = update_groups(data_dir)
+
+    if meta['rows'] > meta['committed_rows']:
+        groups = merge_groups(groups, group_rows(data_dir, meta['committed_rows'], meta['rows']))
+
+    return groups
@@ -0,0 +1,118 @@
+import sys
+import traceback
+
+from PyQt5.QtCore import *
+
+
+class JobSignals(QObject):
+
+    # Emitted from the worker thread, delivered to the runner on the thread it lives on
+    finished = pyqtSignal(int, object, object)
+    failed   = pyqtSignal(int, object, str)
+
+
+class Job(QRunnable):
+
+    def __init__(self, generation, fn, args, callback, name):
+        QRunnable.__init__(self)
+        self.generation = generation
+        self.fn         = fn
+        self.args       = args
+        self.callback   = callback
+        self.name       = name
+        self.signals    = JobSignals()
+
+
+    def run(self):
+        try:
+            result = self.fn(*self.args)
+        except Exception:
+            self.signals.failed.emit(self.generation, self.name, traceback.format_exc())
+            return
+
+        self.signals.finished.emit(self.generation, self.callback, result)
+
+
+class JobRunner(QObject):
+
+    # Jobs finished and submitted since the last restart
+    progressChanged = pyqtSignal(int, int)
+
+    # Name the failed job was submitted under, and its last traceback line
+    jobFailed = pyqtSignal(object, str)
+
+    def __init__(self, max_threads=None, parent=None):
+        # Runs functions on a thread pool and hands each result to its callback back on the GUI thread. Every
+        # restart starts a new generation, queued jobs of older ones are taken off the pool and results of ones
+        # already running are dropped when they arrive, so nothing stale is ever drawn.
+        QObject.__init__(self, parent)
+
+        self.pool = QThreadPool(self)
+        if max_threads is not None:
+            self.pool.setMaxThreadCount(max_threads)
+
+        self.generation = 0
+        self.num_done   = 0
+        self.num_jobs   = 0
+        self.jobs       = {}
+
+
+    def restart(self):
+        self.generation += 1
+        for signals, job in list(self.jobs.items()):
+            if self.pool.tryTake(job):
+                del self.jobs[signals]
+
+        self.num_done = 0
+        self.num_jobs = 0
+        self.progressChanged.emit(self.num_done, self.num_jobs)
+
+
+    def submit(self, fn, *args, callback=None, name=None):
+        job = Job(self.generation, fn, args, callback, name)
+        job.signals.finished.connect(self.__finished)
+        job.signals.failed.connect(self.__failed)
+
+        # Kept until the job reports back so its signals outlive the python side of the runnable
+        self.jobs[job.signals] = job
+        job.setAutoDelete(False)
+        self.pool.start(job)
+
+        self.num_jobs += 1
+        self.progressChanged.emit(self.num_done, self.num_jobs)
+
+
+    def busy(self):
+        return self.num_done < self.num_jobs
+
+
+    def wait(self):
+        # Blocks until every job, along with any its callback submits, has run and delivered its result. For
+        # scripts and tests, the GUI never waits.
+        while self.busy():
+            self.pool.waitForDone()
+            QCoreApplication.sendPostedEvents()
+
+
+    def __finished(self, generation, callback, result):
+        self.jobs.pop(self.sender(), None)
+        if generation != self.generation:
+            return
+
+        self.num_done += 1
+        if callback is not None:
+            callback(result)
+
+        self.progressChanged.emit(self.num_done, self.num_jobs)
+
+
+    def __failed(self, generation, name, message):
+        self.jobs.pop(self.sender(), None)
+        if generation != self.generation:
+            return
+
+        # Whatever its callback would have submitted never is, so the failure has to be shown where its result would be
+        print(message, file=sys.stderr)
+        self.num_done += 1
+        self.jobFailed.emit(name, message.strip().splitlines()[-1])
+        self.progressChanged.emit(self.num_done, self.num_jobs)
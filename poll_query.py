@@ -0,0 +1,277 @@
+import threading
+import numpy as np
+
+import poll_groups
+import poll_titles
+from poll_data import DATA_DIR, ROUND, END_TIME, GAMEMODE, BEATMAPSET_ID, TOPIC_ID
+from poll_analysis import GAMEMODES
+
+
+# Fibonacci hashing multiplier, spreads consecutive ids like topic ids evenly over the table
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+# Empty hash table slot
+EMPTY = -1
+
+
+class SortedIndex():
+
+    def __init__(self, values):
+        # Polls come out of the ingest in round and end time order, in which case the index is the column itself and
+        # every range is a slice. Otherwise ranges are slices of a stable sort order.
+        self.values = values
+        if np.all(values[1:] >= values[:-1]):
+            self.order  = None
+            self.sorted = values
+        else:
+            self.order  = np.argsort(values, kind='stable')
+            self.sorted = values[self.order]
+
+
+    def range(self, low=None, high=None):
+        # Rows with low <= value <= high in O(log N), as a slice when the column is in order and otherwise as a view
+        # of the sort order
+        start = 0 if low is None else int(np.searchsorted(self.sorted, low, side='left'))
+        stop  = len(self.sorted) if high is None else int(np.searchsorted(self.sorted, high, side='right'))
+        stop  = max(start, stop)
+
+        return slice(start, stop) if self.order is None else self.order[start:stop]
+
+
+class HashIndex():
+
+    def __init__(self, values):
+        # Open addressing with linear probing over the distinct values. Each slot holds the position of a distinct
+        # value, whose rows are a contiguous run of the stable sort order. Built a probe step at a time for all
+        # values at once, so insertion never loops over values in python.
+        self.order = np.argsort(values, kind='stable')
+        self.keys, self.starts, self.counts = np.unique(values[self.order], return_index=True, return_counts=True)
+
+        self.bits  = max(4, int(np.ceil(np.log2(2*len(self.keys) + 1))))
+        self.mask  = (1 << self.bits) - 1
+        self.table = np.full(1 << self.bits, EMPTY, dtype=np.int64)
+
+        pending = np.arange(len(self.keys))
+        slots   = self.hash(self.keys)
+        while len(pending) > 0:
+            free = self.table[slots] == EMPTY
+
+            # One value wins each free slot, the rest move on to the next one
+            _, first = np.unique(slots[free], return_index=True)
+            winners  = np.flatnonzero(free)[first]
+            self.table[slots[winners]] = pending[winners]
+
+            lost    = np.ones(len(pending), dtype=bool)
+            lost[winners] = False
+            pending = pending[lost]
+            slots   = (slots[lost] + 1) & self.mask
+
+
+    def hash(self, keys):
+        keys = np.asarray(keys).astype(np.uint64)
+        return ((keys*HASH_MULTIPLIER) >> np.uint64(64 - self.bits)).astype(np.int64)
+
+
+    def find(self, keys):
+        # Position of each key among the distinct values, -1 for keys not present. Expected O(1) per key.
+        keys    = np.asarray(keys)
+        found   = np.full(len(keys), EMPTY, dtype=np.int64)
+        active  = np.arange(len(keys))
+        slots   = self.hash(keys)
+
+        while len(active) > 0:
+            entry = self.table[slots]
+            empty = entry == EMPTY
+            hit   = ~empty & (self.keys[np.maximum(entry, 0)] == keys[active])
+            found[active[hit]] = entry[hit]
+
+            probe  = ~empty & ~hit
+            active = active[probe]
+            slots  = (slots[probe] + 1) & self.mask
+
+        return found
+
+
+    def rows(self, key):
+        # Rows holding the key, a view of the sort order
+        position = self.find([ key ])[0]
+        if position == EMPTY:
+            return self.order[:0]
+
+        return self.order[self.starts[position]:self.starts[position] + self.counts[position]]
+
+
+class PollQuery():
+
+    def __init__(self, poll_data):
+        # Indexes are built the first time a query needs them and kept for the next, so one query is kept per loaded
+        # dataset and replaced when polls are appended to it. The GUIs' loads can overlap on their job pool, the
+        # lock keeps them from building the same index twice.
+        self.poll_data = poll_data
+        self.num_rows  = len(next(iter(poll_data.values())))
+        self.indexes   = {}
+        self.lock      = threading.Lock()
+
+
+    def index(self, name):
+        with self.lock:
+            if name not in self.indexes:
+                index_type = HashIndex if name in (BEATMAPSET_ID, TOPIC_ID) else SortedIndex
+                self.indexes[name] = index_type(np.asarray(self.poll_data[name]))
+
+            return self.indexes[name]
+
+
+    def rounds(self, first=None, last=None):
+        return self.index(ROUND).range(first, last)
+
+
+    def last_rounds(self, num_rounds):
+        sorted_rounds = self.index(ROUND).sorted
+        if len(sorted_rounds) == 0:
+            return slice(0, 0)
+
+        return self.rounds(int(sorted_rounds[-1]) - num_rounds + 1, None)
+
+
+    def time_range(self, start=None, stop=None):
+        # Bounds are inclusive epoch seconds or anything np.datetime64 parses. A stop given as a date alone, like
+        # '2019-01-01', takes in the whole of that day.
+        if start is not None and not isinstance(start, (int, np.integer)):
+            start = np.datetime64(start).astype('datetime64[s]').astype(np.int64)
+
+        if stop is not None and not isinstance(stop, (int, np.integer)):
+            stop = np.datetime64(stop)
+            stop = (stop + np.timedelta64(1, np.datetime_data(stop.dtype)[0]) - np.timedelta64(1, 's')).astype('datetime64[s]').astype(np.int64)
+
+        return self.index(END_TIME).range(start, stop)
+
+
+    def beatmapset(self, beatmapset_id):
+        return self.index(BEATMAPSET_ID).rows(beatmapset_id)
+
+
+    def topic(self, topic_id):
+        return self.index(TOPIC_ID).rows(topic_id)
+
+
+    def gamemodes(self, names, rows=None):
+        # Gamemode isn't indexed, the mask is over the rows selected so far only
+        rows = self.rows(rows)
+        modes = [ GAMEMODES[name] for name in names ]
+        return rows[np.isin(np.asarray(self.poll_data[GAMEMODE][rows]), modes)]
+
+
+    def rows(self, selection):
+        # Row numbers of a selection, in row order
+        if selection is None:
+            return np.arange(self.num_rows)
+
+        if isinstance(selection, slice):
+            return np.arange(*selection.indices(self.num_rows))
+
+        return np.sort(selection)
+
+
+    def intersect(self, *selections):
+        # Slices intersect into a slice, anything else into sorted row numbers
+        selections = [ selection for selection in selections if selection is not None ]
+        if len(selections) == 0:
+            return None
+
+        if all(isinstance(selection, slice) for selection in selections):
+            start = max(selection.start for selection in selections)
+            stop  = min(selection.stop for selection in selections)
+            return slice(start, max(start, stop))
+
+        rows = self.rows(selections[0])
+        for selection in selections[1:]:
+            rows = np.intersect1d(rows, self.rows(selection), assume_unique=True)
+
+        return rows
+
+
+    def select(self, selection, columns=None):
+        # Column views for a slice, copies for row numbers, as poll_data.load would return them
+        if columns is None:
+            columns = self.poll_data.keys()
+
+        if selection is None:
+            return { name : self.poll_data[name] for name in columns }
+
+        return { name : self.poll_data[name][selection] for name in columns }
+
+
+def add_selection_args(parser):
+    parser.add_argument('--rounds', default=None, help='Round range FIRST:LAST, either end may be left out')
+    parser.add_argument('--last-rounds', type=int, default=None, help='Only the last N rounds')
+    parser.add_argument('--since', default=None, help='Polls ending on or after this date')
+    parser.add_argument('--until', default=None, help='Polls ending on or before this date')
+    parser.add_argument('--beatmapset', type=int, default=None)
+    parser.add_argument('--topic', type=int, default=None)
+    parser.add_argument('--gamemode', action='append', choices=list(GAMEMODES), default=None, help='Only these gamemodes, may be repeated')
+    parser.add_argument('--search', default=None, help='Only polls whose artist, title or mapper match, see poll_titles.py')
+    parser.add_argument('--dedup', choices=[ poll_groups.KEEP_LATEST, poll_groups.KEEP_BEST ], default=None, help='Count each map once per gamemode, by its latest or best poll')
+
+
+def selection_from_args(args):
+    return {
+        'rounds'      : args.rounds,
+        'last_rounds' : args.last_rounds,
+        'since'       : args.since,
+        'until'       : args.until,
+        'beatmapset'  : args.beatmapset,
+        'topic'       : args.topic,
+        'gamemodes'   : args.gamemode,
+        'search'      : args.search,
+        'dedup'       : args.dedup,
+    }
+
+
+def is_empty(selection):
+    return selection is None or all(value is None for value in selection.values())
+
+
+def select_polls(query, selection, columns=None, data_dir=DATA_DIR):
+    # Applies a selection as made by selection_from_args to the polls of a PollQuery. Its poll data needs the columns
+    # the selection is on as well as the ones asked for, which with memory mapped columns costs nothing until they're
+    # read. Deduplication picks each map's poll out of the whole history, the other parts of the selection then apply
+    # to the picked polls.
+    poll_data = query.poll_data
+    if is_empty(selection):
+        return { name : poll_data[name] for name in (columns or poll_data.keys()) }
+
+    selections = []
+
+    if selection.get('rounds') is not None:
+        first, _, last = selection['rounds'].partition(':')
+        selections.append(query.rounds(int(first) if first else None, int(last) if last else None))
+
+    if selection.get('last_rounds') is not None:
+        selections.append(query.last_rounds(selection['last_rounds']))
+
+    if selection.get('since') is not None or selection.get('until') is not None:
+        selections.append(query.time_range(selection.get('since'), selection.get('until')))
+
+    if selection.get('beatmapset') is not None:
+        selections.append(query.beatmapset(selection['beatmapset']))
+
+    if selection.get('topic') is not None:
+        selections.append(query.topic(selection['topic']))
+
+    if selection.get('search') is not None:
+        rows = poll_titles.search(selection['search'], data_dir)
+        selections.append(rows[rows < query.num_rows])
+
+    if selection.get('dedup') is not None:
+        groups = poll_groups.load_groups(data_dir)
+        if len(groups['group']) != query.num_rows:
+            groups = poll_groups.group_polls(poll_data)
+
+        selections.append(poll_groups.dedup_rows(groups, selection['dedup']))
+
+    rows = query.intersect(*selections)
+    if selection.get('gamemodes') is not None:
+        rows = query.gamemodes(selection['gamemodes'], rows)
+
+    return query.select(rows, columns)
@@ -0,0 +1,115 @@
+import os
+import html
+import argparse
+import numpy as np
+
+import poll_data
+
+
+# Proportions of std/taiko/catch/mania polls and the vote count scale of each mode, roughly as in the real history
+GAMEMODE_SHARE = np.asarray([ 0.41, 0.19, 0.13, 0.27 ])
+GAMEMODE_VOTES = np.asarray([ 150, 60, 50, 90 ])
+GAMEMODE_TAGS  = [ 'osu!std', 'osu!taiko', 'osu!catch', 'osu!mania' ]
+
+FIRST_ROUND_TIME = np.datetime64('2018-01-09T03:28:26', 's')
+ROUND_INTERVAL   = 7*24*3600
+FIRST_TOPIC_ID   = 684552
+MAX_BEATMAPSET   = 1500000
+
+# Round is stored as u2, so past this many rounds more polls are packed into each round instead
+MAX_ROUNDS      = 60000
+POLLS_PER_ROUND = 21
+
+CHUNK_ROWS = 100000
+
+HEADER = 'Round,Poll end time,Game mode,Beatmapset ID,Topic ID,Yes,No,Topic title\n'
+
+# Title parts, some with the characters the forum escapes or the csv has to quote
+WORDS = [
+    'Camellia', 'Nanahira', 'Frozen', 'World', 'Mentai', 'Cosmic', 'Satori', 'Eastbound', 'Down', 'Lone', 'Digger',
+    'Ubiquity', 'Party', 'Night', 'Girl', 'Vivid', 'Krew', 'Peter', 'Crack', 'Young', 'Mazare', 'Sliwa',
+    'What\'s', 'Rock & Roll', 'Hello, World', '"Quoted"', '<Bracketed>', 'feat.', 'ft.', 'Remix',
+]
+
+
+def polls_per_round(num_rows):
+    return max(POLLS_PER_ROUND, -(-num_rows//MAX_ROUNDS))
+
+
+def title_dates(times):
+    # m/d/yy like the dates in the real topic titles
+    days   = times.astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    years  = days.astype('datetime64[Y]')
+
+    month = (months - years.astype('datetime64[M]')).astype(np.int64) + 1
+    day   = (days - months.astype('datetime64[D]')).astype(np.int64) + 1
+    year  = (years.astype(np.int64) + 1970) % 100
+    return [ f'{m}/{d}/{y:02d}' for m, d, y in zip(month, day, year) ]
+
+
+def escape(text):
+    # Same escaping as the forum topic titles in the real csv
+    return html.escape(text).replace('&#x27;', '&#039;')
+
+
+def quote(field):
+    return f'"{field.replace(chr(34), chr(34)*2)}"' if ',' in field or '"' in field else field
+
+
+def generate_chunk(rng, start, stop, num_rows):
+    # Rows start..stop of a history of num_rows. Polls are grouped by round and by gamemode within a round, end a
+    # few seconds apart, and have lognormal vote counts with mostly high yes ratios like the real ones.
+    per_round = polls_per_round(num_rows)
+    row_idx   = np.arange(start, stop)
+    round_num = row_idx//per_round + 1
+    num_polls = len(row_idx)
+
+    gamemode = rng.choice(len(GAMEMODE_SHARE), size=num_polls, p=GAMEMODE_SHARE)
+    gamemode = gamemode[np.lexsort((gamemode, round_num))]
+
+    end_time = FIRST_ROUND_TIME + (round_num - 1)*ROUND_INTERVAL + (row_idx % per_round)*2
+    num_votes = np.maximum(1, rng.lognormal(np.log(GAMEMODE_VOTES[gamemode]), 0.8)).astype(np.int64)
+    num_yes   = rng.binomial(num_votes, rng.beta(10, 1, size=num_polls))
+
+    beatmapset_id = rng.integers(1, MAX_BEATMAPSET, size=num_polls)
+    topic_id      = FIRST_TOPIC_ID + row_idx
+
+    words  = rng.integers(0, len(WORDS), size=(num_polls, 5))
+    dates  = title_dates(end_time - ROUND_INTERVAL)
+    times  = np.datetime_as_string(end_time, unit='s')
+
+    lines = []
+    for i in range(num_polls):
+        artist, title, mapper = WORDS[words[i, 0]], f'{WORDS[words[i, 1]]} {WORDS[words[i, 2]]}', f'{WORDS[words[i, 3]]}{words[i, 4]}'
+        topic_title = escape(f'[{GAMEMODE_TAGS[gamemode[i]]}] {dates[i]} {artist} - {title} by {mapper} Vote/Discussion')
+
+        lines.append(f'{round_num[i]},{times[i]}+00:00,{gamemode[i]},{beatmapset_id[i]},{topic_id[i]},{num_yes[i]},{num_votes[i] - num_yes[i]},{quote(topic_title)}\n')
+
+    return ''.join(lines)
+
+
+def generate(num_rows, csv_path, seed=0, chunk_rows=CHUNK_ROWS):
+    # Written in chunks so memory stays flat up to tens of millions of rows
+    if -(-num_rows//polls_per_round(num_rows)) > np.iinfo(poll_data.COLUMNS[poll_data.ROUND]).max:
+        raise ValueError(f'{num_rows} rows do not fit in the round column')
+
+    os.makedirs(os.path.dirname(csv_path) or '.', exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    with open(f'{csv_path}.tmp', 'w', encoding='utf-8', newline='') as f:
+        f.write(HEADER)
+        for start in range(0, num_rows, chunk_rows):
+            f.write(generate_chunk(rng, start, min(start + chunk_rows, num_rows), num_rows))
+
+    os.replace(f'{csv_path}.tmp', csv_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic poll history in the same csv format as the real one')
+    parser.add_argument('rows', type=int)
+    parser.add_argument('--out', default='data/bench/poll_history.csv')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate(args.rows, args.out, args.seed)
@@ -0,0 +1,136 @@
+import bisect
+import collections
+import numpy as np
+
+from result_cache import memoize
+from poll_data import ROUND, END_TIME
+from poll_analysis import GAMEMODES, NUM_VOTES, YES_RATIO, LOVED_THRESHOLD
+
+
+# What a rolling window spans, a number of rounds or a number of seconds of poll end time
+BY_ROUNDS = 'rounds'
+BY_TIME   = 'time'
+
+ROUND_COLUMNS   = [ 'round', 'end_time', 'num_polls', 'median_votes', 'mean_yes_ratio', 'pass_rate' ]
+ROLLING_COLUMNS = [ 'rolling_rounds', 'rolling_polls', 'rolling_median_votes', 'rolling_mean_yes_ratio', 'rolling_pass_rate' ]
+
+
+class RollingWindow():
+
+    def __init__(self, window, by=BY_ROUNDS):
+        # Rounds enter on the right and leave on the left once they fall out of the window, each once, so the sums
+        # behind the mean yes ratio and pass rate cost O(1) amortized per round. The median of the per-round median
+        # participation is kept in a sorted list, a bisect plus a memmove the size of the window.
+        if not window > 0:
+            raise ValueError(f'Window must be positive, not {window}')
+
+        self.window  = window
+        self.by      = by
+        self.rounds  = collections.deque()
+        self.medians = []
+
+        self.num_polls   = 0
+        self.yes_total   = 0.0
+        self.num_passing = 0
+
+
+    def append(self, round_num, end_time, num_polls, median_votes, yes_total, num_passing):
+        entry = (round_num, end_time, num_polls, median_votes, yes_total, num_passing)
+        self.rounds.append(entry)
+        bisect.insort(self.medians, median_votes)
+
+        self.num_polls   += num_polls
+        self.yes_total   += yes_total
+        self.num_passing += num_passing
+
+        position = 0 if self.by == BY_ROUNDS else 1
+        while self.rounds[0][position] <= entry[position] - self.window:
+            _, _, old_polls, old_median, old_yes, old_passing = self.rounds.popleft()
+            del self.medians[bisect.bisect_left(self.medians, old_median)]
+
+            self.num_polls   -= old_polls
+            self.yes_total   -= old_yes
+            self.num_passing -= old_passing
+
+
+    def values(self):
+        num_medians = len(self.medians)
+        median = (self.medians[(num_medians - 1)//2] + self.medians[num_medians//2])/2 if num_medians > 0 else np.nan
+
+        return {
+            'rolling_rounds'         : len(self.rounds),
+            'rolling_polls'          : self.num_polls,
+            'rolling_median_votes'   : median,
+            'rolling_mean_yes_ratio' : self.yes_total/self.num_polls if self.num_polls > 0 else np.nan,
+            'rolling_pass_rate'      : self.num_passing/self.num_polls if self.num_polls > 0 else np.nan,
+        }
+
+
+class RoundSeries():
+
+    def __init__(self, window, by=BY_ROUNDS, threshold=LOVED_THRESHOLD):
+        # Per-round aggregates of one mode plus the rolling window over them. Rounds are appended in order as they
+        # close, each costing its own polls to aggregate and O(1) amortized to extend every series by.
+        self.threshold = threshold
+        self.rolling   = RollingWindow(window, by)
+        self.columns   = { name : [] for name in ROUND_COLUMNS + ROLLING_COLUMNS }
+
+
+    def __len__(self):
+        return len(self.columns['round'])
+
+
+    def append_round(self, round_num, end_time, votes, yes_ratio):
+        # end_time is when the round's last poll ended
+        if len(self) > 0 and round_num <= self.columns['round'][-1]:
+            raise ValueError(f'Round {round_num} is not after round {self.columns["round"][-1]}')
+
+        num_polls   = len(votes)
+        yes_total   = float(np.sum(yes_ratio))
+        num_passing = int(np.count_nonzero(yes_ratio > self.threshold))
+        median      = float(np.median(votes)) if num_polls > 0 else np.nan
+
+        round_values = {
+            'round'          : int(round_num),
+            'end_time'       : int(end_time),
+            'num_polls'      : num_polls,
+            'median_votes'   : median,
+            'mean_yes_ratio' : yes_total/num_polls if num_polls > 0 else np.nan,
+            'pass_rate'      : num_passing/num_polls if num_polls > 0 else np.nan,
+        }
+
+        self.rolling.append(int(round_num), int(end_time), num_polls, median, yes_total, num_passing)
+        round_values.update(self.rolling.values())
+
+        for name, value in round_values.items():
+            self.columns[name].append(value)
+
+
+    def arrays(self):
+        return { name : np.asarray(values) for name, values in self.columns.items() }
+
+
+def mode_series(rounds, end_time, votes, yes_ratio, window, by=BY_ROUNDS, threshold=LOVED_THRESHOLD):
+    # Polls are grouped by round with one stable sort, then fed through a RoundSeries a round at a time
+    order  = np.argsort(rounds, kind='stable')
+    rounds = rounds[order]
+    round_nums, round_start = np.unique(rounds, return_index=True)
+    round_stop = np.append(round_start[1:], len(rounds))
+
+    series = RoundSeries(window, by, threshold)
+    for round_num, start, stop in zip(round_nums, round_start, round_stop):
+        select = order[start:stop]
+        series.append_round(round_num, end_time[select].max(), votes[select], yes_ratio[select])
+
+    return series
+
+
+@memoize
+def timeseries_results(partition, window, by=BY_ROUNDS, threshold=LOVED_THRESHOLD):
+    results = {}
+
+    for name in GAMEMODES:
+        mode = partition[name]
+        results[name] = mode_series(mode[ROUND], mode[END_TIME], mode[NUM_VOTES], mode[YES_RATIO], window, by, threshold).arrays()
+
+    return results
@@ -0,0 +1,318 @@
+import os
+import re
+import html
+import shlex
+import argparse
+import numpy as np
+
+import poll_data
+from poll_data import ROUND, GAMEMODE, TOPIC_TITLE, ARTIST, TITLE, MAPPER
+
+
+INDEX_FILE = 'tokens.npz'
+
+# Fields with a token index, and the names a search term is prefixed with to look in one of them only
+INDEX_FIELDS = [ ARTIST, TITLE, MAPPER ]
+
+TOKEN = re.compile(r'\w+')
+
+# Tokens of many strings at once, joined by a character that is never part of a token and marks the next row
+ROW_BREAK = '\0'
+TOKEN_OR_ROW_BREAK = re.compile(r'\w+|\0')
+
+# Topic titles look like "[osu!std] 1/9/18 Ceui - Labyrinths by Es-HuStLeR Vote/Discussion". Later ones have no
+# date or suffix, and long ones are cut off with "..." somewhere along the way.
+TITLE_PREFIX = re.compile(r'^\[osu!\w+\]\s*(?:\d{1,2}/\d{1,2}/\d{2,4}\s+)?')
+TITLE_SUFFIXES = ('Vote/Discussion', 'Vote')
+TITLE_MAPPER = re.compile(r'^(.*)(?:\s|\.\.\.)by(?:\s+|(?=[A-Z]))(\S.*)$')
+
+
+def strip_suffix(text):
+    # Drops a " Vote" or " Vote/Discussion" at the end and the whitespace around it, without running a regex
+    stripped = text.rstrip()
+    for suffix in TITLE_SUFFIXES:
+        if stripped.endswith(suffix) and stripped[-len(suffix) - 1:-len(suffix)].isspace():
+            return stripped[:-len(suffix)].rstrip()
+
+    return text
+
+
+def split_title(topic_title):
+    # Artist, title and mapper out of a decoded topic title. The mapper is after the last " by ", the artist
+    # before the first " - ", and what can't be found is left empty.
+    # Patterns only run on titles that could match them
+    text = strip_suffix(TITLE_PREFIX.sub('', topic_title) if topic_title.startswith('[') else topic_title)
+
+    match = TITLE_MAPPER.match(text) if 'by' in text else None
+    text, mapper = (match.group(1), match.group(2)) if match is not None else (text, '')
+
+    artist, separator, title = text.partition(' - ')
+    if separator == '':
+        artist, title = '', text
+
+    return artist.strip(), title.strip(), mapper.strip()
+
+
+def parse_titles(raw_titles):
+    # Columns of strings for one chunk of the ingest. Only titles with an & in them can have entities to decode.
+    topic_titles = [ html.unescape(raw_title) if '&' in raw_title else raw_title for raw_title in raw_titles ]
+    artists, titles, mappers = zip(*map(split_title, topic_titles)) if len(topic_titles) > 0 else ((), (), ())
+
+    return {
+        TOPIC_TITLE : topic_titles,
+        ARTIST      : list(artists),
+        TITLE       : list(titles),
+        MAPPER      : list(mappers),
+    }
+
+
+class StringWriter():
+
+    def __init__(self, name, committed_rows, data_dir=poll_data.DATA_DIR):
+        # Appends to a string column. Rows past the committed ones are dropped, as for the numeric columns.
+        buffer_path, offsets_path = poll_data.string_paths(name, data_dir)
+
+        self.end = 0
+        if committed_rows > 0:
+            self.end = int(np.fromfile(offsets_path, dtype='<i8', count=1, offset=committed_rows*8)[0])
+
+        self.f_offsets = open(offsets_path, 'ab')
+        self.f_offsets.truncate(committed_rows*8 + 8 if committed_rows > 0 else 0)
+        if committed_rows == 0:
+            self.f_offsets.write(np.zeros(1, dtype='<i8').tobytes())
+
+        self.f_buffer = open(buffer_path, 'ab')
+        self.f_buffer.truncate(self.end)
+
+
+    def write(self, strings):
+        encoded = [ string.encode('utf-8') for string in strings ]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+
+        self.f_buffer.write(b''.join(encoded))
+        self.f_offsets.write((self.end + np.cumsum(lengths)).astype('<i8').tobytes())
+        self.end += int(lengths.sum())
+
+
+    def close(self):
+        self.f_buffer.close()
+        self.f_offsets.close()
+
+
+class TokenIndex():
+
+    def __init__(self, vocab, offsets, rows):
+        # Sorted distinct tokens, and for each the rows holding it in ascending order, rows[offsets[i]:offsets[i + 1]].
+        # The tokens are a poll_data.StringColumn, one utf-8 buffer and the offset of each token in it.
+        self.vocab   = vocab
+        self.offsets = offsets
+        self.rows    = rows
+
+
+    def containing(self, fragment):
+        # Rows with a token that has the fragment in it. Matching is one scan of the buffer of distinct tokens, which
+        # grow far slower than the polls do, for every place the fragment starts, overlapping ones included. Places
+        # that run on past the end of their token are across two and don't count. The rows then come straight out of
+        # the postings.
+        encoded = fragment.encode('utf-8')
+        places  = np.fromiter((match.start() for match in re.finditer(b'(?=' + re.escape(encoded) + b')', self.vocab.buffer)), dtype=np.int64)
+
+        token_ids = np.searchsorted(self.vocab.offsets, places, side='right') - 1
+        token_ids = np.unique(token_ids[places + len(encoded) <= self.vocab.offsets[token_ids + 1]])
+
+        starts  = self.offsets[token_ids]
+        lengths = self.offsets[token_ids + 1] - starts
+
+        # Positions of all their postings, each run's start plus the place within it
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return np.unique(self.rows[positions])
+
+
+    def merge(self, other):
+        # Index of both, other's rows all coming after these
+        tokens, other_tokens = self.vocab[:], other.vocab[:]
+        all_tokens = sorted(set(tokens).union(other_tokens))
+        ids = { token : i for i, token in enumerate(all_tokens) }
+
+        token_ids = np.concatenate([
+            np.repeat(np.fromiter(map(ids.__getitem__, tokens), dtype=np.int64, count=len(tokens)), np.diff(self.offsets)),
+            np.repeat(np.fromiter(map(ids.__getitem__, other_tokens), dtype=np.int64, count=len(other_tokens)), np.diff(other.offsets)),
+        ])
+        rows  = np.concatenate([ self.rows, other.rows ])
+        order = np.argsort(token_ids, kind='stable')
+
+        offsets = np.zeros(len(all_tokens) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(token_ids, minlength=len(all_tokens)))
+        return TokenIndex(encode_vocab(all_tokens), offsets, rows[order])
+
+
+def encode_vocab(tokens):
+    # Sorted tokens laid out like a string column, their utf-8 sorts the same as they do
+    encoded = [ token.encode('utf-8') for token in tokens ]
+
+    offsets = np.zeros(len(encoded) + 1, dtype='<i8')
+    offsets[1:] = np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+    return poll_data.StringColumn(b''.join(encoded), offsets)
+
+
+def tokenize(text):
+    return TOKEN.findall(text.casefold())
+
+
+def index_strings(strings, start=0):
+    # Token index of a list of strings, the first being row start. All of them are tokenized in one pass over their
+    # joined text, each token gets an integer id from a dict of the distinct ones, and the rest is done on the ids.
+    pieces = TOKEN_OR_ROW_BREAK.findall(ROW_BREAK.join(strings).casefold())
+    ids    = { piece : i for i, piece in enumerate(dict.fromkeys(pieces)) }
+    piece_ids = np.fromiter(map(ids.__getitem__, pieces), dtype=np.int64, count=len(pieces))
+
+    is_break = piece_ids == ids.get(ROW_BREAK, -1)
+    rows     = (start + np.cumsum(is_break))[~is_break]
+
+    # Only the distinct tokens are sorted into the vocabulary, the ids are then ranked to match
+    tokens = sorted(piece for piece in ids if piece != ROW_BREAK)
+    rank   = np.full(len(ids), -1, dtype=np.int64)
+    rank[[ ids[token] for token in tokens ]] = np.arange(len(tokens))
+    token_ids = rank[piece_ids[~is_break]]
+
+    # Rows are in order already, so a stable sort by token keeps each token's rows ascending, and a token that
+    # comes up twice in a string is kept once
+    order = np.argsort(token_ids, kind='stable')
+    token_ids, rows = token_ids[order], rows[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (token_ids[1:] != token_ids[:-1]) | (rows[1:] != rows[:-1])
+    token_ids, rows = token_ids[first], rows[first]
+
+    offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(token_ids, minlength=len(tokens)))
+    return TokenIndex(encode_vocab(tokens), offsets, rows)
+
+
+def index_rows(strings, start, stop):
+    return { field : index_strings(strings[field][start:stop], start) for field in INDEX_FIELDS }
+
+
+def index_path(data_dir=poll_data.DATA_DIR):
+    return os.path.join(data_dir, INDEX_FILE)
+
+
+def save_index(indexes, rows, build_id, data_dir=poll_data.DATA_DIR):
+    # Stamped with the rows and build it covers, written to the side and swapped in
+    arrays = {}
+    for field, index in indexes.items():
+        arrays.update({
+            f'{field}_vocab'         : np.frombuffer(index.vocab.buffer, dtype=np.uint8),
+            f'{field}_vocab_offsets' : index.vocab.offsets,
+            f'{field}_offsets'       : index.offsets,
+            f'{field}_rows'          : index.rows,
+        })
+
+    path = index_path(data_dir)
+    with open(f'{path}.tmp', 'wb') as f:
+        np.savez(f, rows_stamp=rows, build_stamp=str(build_id), **arrays)
+
+    os.replace(f'{path}.tmp', path)
+
+
+def read_index(data_dir=poll_data.DATA_DIR):
+    # The saved indexes and the rows and build they cover, or None, also for one saved with its tokens in an array
+    # of fixed width strings before they were kept as utf-8
+    path = index_path(data_dir)
+    if not os.path.exists(path):
+        return None, None, None
+
+    with np.load(path) as saved:
+        if f'{INDEX_FIELDS[0]}_vocab_offsets' not in saved.files:
+            return None, None, None
+
+        indexes = {}
+        for field in INDEX_FIELDS:
+            vocab = poll_data.StringColumn(saved[f'{field}_vocab'].tobytes(), saved[f'{field}_vocab_offsets'])
+            indexes[field] = TokenIndex(vocab, saved[f'{field}_offsets'], saved[f'{field}_rows'])
+
+        return indexes, int(saved['rows_stamp']), str(saved['build_stamp'])
+
+
+def update_index(data_dir=poll_data.DATA_DIR):
+    # The ingest runs this after appending rows. As with the loved cube only committed rows go in the saved index,
+    # and only rows committed since it was saved are tokenized.
+    meta = poll_data.load_meta(data_dir)
+    committed_rows = meta['committed_rows']
+    indexes, rows, build_id = read_index(data_dir)
+
+    if indexes is None or build_id != str(meta.get('build_id')) or rows > committed_rows:
+        indexes, rows = None, 0
+
+    strings = poll_data.load_strings(data_dir, INDEX_FIELDS)
+    if indexes is None:
+        indexes = index_rows(strings, 0, committed_rows)
+    elif committed_rows > rows:
+        new_indexes = index_rows(strings, rows, committed_rows)
+        indexes = { field : indexes[field].merge(new_indexes[field]) for field in INDEX_FIELDS }
+
+    save_index(indexes, committed_rows, meta.get('build_id'), data_dir)
+    return indexes
+
+
+def load_index(data_dir=poll_data.DATA_DIR):
+    # The saved indexes brought up to date, plus any uncommitted last row indexed in memory only. Bringing them up
+    # to date writes the file the ingest does, so it's done under the same lock.
+    with poll_data.lock(data_dir):
+        meta = poll_data.load_meta(data_dir)
+        indexes, rows, build_id = read_index(data_dir)
+        if indexes is None or build_id != str(meta.get('build_id')) or rows != meta['committed_rows']:
+            indexes = update_index(data_dir)
+
+    if meta['rows'] > meta['committed_rows']:
+        tail_indexes = index_rows(poll_data.load_strings(data_dir, INDEX_FIELDS), meta['committed_rows'], meta['rows'])
+        indexes = { field : indexes[field].merge(tail_indexes[field]) for field in INDEX_FIELDS }
+
+    return indexes
+
+
+def search(query, data_dir=poll_data.DATA_DIR, indexes=None):
+    # Rows matching every term of the query, in row order. A term matches a poll when each of its words is part of a
+    # token of the poll's artist, title or mapper, or only the one field when prefixed like mapper:pishifat. Terms
+    # that are more than one word, like "eastbound & down" in quotes, are then checked against the text itself for
+    # the polls their words matched.
+    if indexes is None:
+        indexes = load_index(data_dir)
+
+    rows = None
+
+    for term in shlex.split(query):
+        field, separator, text = term.partition(':')
+        fields = [ field ] if separator != '' and field in INDEX_FIELDS else INDEX_FIELDS
+        if fields == INDEX_FIELDS:
+            text = term
+
+        words = tokenize(text)
+        if len(words) == 0:
+            continue
+
+        term_rows = None
+        for word in words:
+            word_rows = np.unique(np.concatenate([ indexes[field].containing(word) for field in fields ]))
+            term_rows = word_rows if term_rows is None else np.intersect1d(term_rows, word_rows, assume_unique=True)
+
+        if words != [ text.casefold() ]:
+            name   = TOPIC_TITLE if len(fields) > 1 else fields[0]
+            column = poll_data.load_strings(data_dir, [ name ])[name]
+            phrase = text.casefold()
+            term_rows = term_rows[np.asarray([ phrase in column[row].casefold() for row in term_rows ], dtype=bool)]
+
+        rows = term_rows if rows is None else np.intersect1d(rows, term_rows, assume_unique=True)
+
+    return np.empty(0, dtype=np.int64) if rows is None else rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find polls by artist, title or mapper')
+    parser.add_argument('query', help='Terms that all have to match, each optionally prefixed with artist:, title: or mapper:')
+    args = parser.parse_args()
+
+    polls   = poll_data.load(columns=[ ROUND, GAMEMODE ])
+    strings = poll_data.load_strings()
+
+    for row in search(args.query):
+        print(f'{row:>7} round {polls[ROUND][row]:>3} mode {polls[GAMEMODE][row]} {strings[ARTIST][row]} - {strings[TITLE][row]} by {strings[MAPPER][row]}')
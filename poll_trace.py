@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import atexit
+import argparse
+import threading
+import contextlib
+import tracemalloc
+import numpy as np
+
+
+# Set to a file path to trace a run of any of the scripts, the same as passing them --trace
+TRACE_ENV = 'POLL_TRACE'
+
+# Set to 0 to leave out memory high-water marks, which slow down allocation heavy python code while tracing
+TRACE_MEMORY_ENV = 'POLL_TRACE_MEMORY'
+
+# Returned by span() while tracing is off, so a disabled span is one function call and a flag check
+NULL_SPAN = contextlib.nullcontext()
+
+
+class Span():
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name   = name
+        self.args   = args
+        self.peak   = 0
+
+
+    def __enter__(self):
+        # Memory peaks are global, so entering a span folds the peak so far into the enclosing span before resetting
+        # it, and leaving one folds its own peak back into the enclosing span
+        stack = self.tracer.stack()
+        if self.tracer.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if len(stack) > 0:
+                stack[-1].peak = max(stack[-1].peak, peak)
+
+            tracemalloc.reset_peak()
+            self.start_bytes = current
+
+        stack.append(self)
+        self.t_start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        t_end = time.perf_counter()
+        stack = self.tracer.stack()
+        stack.pop()
+
+        args = dict(self.args)
+        if self.tracer.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, peak)
+            if len(stack) > 0:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+
+            args['start_bytes'] = self.start_bytes
+            args['end_bytes']   = current
+            args['peak_bytes']  = self.peak
+
+        self.tracer.record(self.name, self.t_start, t_end, args)
+        return False
+
+
+class Tracer():
+
+    def __init__(self):
+        self.enabled = False
+        self.memory  = False
+        self.path    = None
+        self.events  = []
+        self.t_zero  = time.perf_counter()
+        self.local   = threading.local()
+        self.lock    = threading.Lock()
+
+
+    def enable(self, path, memory=True):
+        # Traces are written when the process exits
+        if not self.enabled:
+            atexit.register(self.export)
+
+        self.enabled = True
+        self.path    = path
+        self.memory  = memory
+
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+
+        return self.local.stack
+
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+
+        return Span(self, name, args)
+
+
+    def record(self, name, t_start, t_end, args):
+        # Complete events in the chrome trace format, times in microseconds since the tracer was created
+        with self.lock:
+            self.events.append({
+                'name' : name,
+                'ph'   : 'X',
+                'ts'   : (t_start - self.t_zero)*1e6,
+                'dur'  : (t_end - t_start)*1e6,
+                'pid'  : os.getpid(),
+                'tid'  : threading.get_ident(),
+                'args' : args,
+            })
+
+
+    def export(self, path=None):
+        # Loads in chrome://tracing or Perfetto. Events are sorted by start time so two runs' traces diff cleanly.
+        path = path or self.path
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event['ts'])
+
+        with open(path, 'w') as f:
+            json.dump({ 'traceEvents' : events, 'displayTimeUnit' : 'ms' }, f, indent=1)
+
+
+tracer = Tracer()
+span   = tracer.span
+
+
+def enable(path, memory=None):
+    if memory is None:
+        memory = os.environ.get(TRACE_MEMORY_ENV, '1') != '0'
+
+    tracer.enable(path, memory)
+
+
+def summarize(path):
+    # Total time, calls and largest memory peak per span name
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+
+    summary = {}
+    for event in events:
+        total = summary.setdefault(event['name'], { 'calls' : 0, 'ms' : 0.0, 'peak_bytes' : 0 })
+        total['calls']     += 1
+        total['ms']        += event['dur']/1000
+        total['peak_bytes'] = max(total['peak_bytes'], event['args'].get('peak_bytes', 0))
+
+    return summary
+
+
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize a trace per span, or compare two of them')
+    parser.add_argument('trace')
+    parser.add_argument('baseline', nargs='?', default=None)
+    args = parser.parse_args()
+
+    summary  = summarize(args.trace)
+    baseline = summarize(args.baseline) if args.baseline is not None else {}
+
+    print(f'{"span":<32} {"calls":>6} {"ms":>10} {"peak MB":>9}' + (f' {"base ms":>10} {"ratio":>7}' if baseline else ''))
+    for name, total in sorted(summary.items(), key=lambda item: -item[1]['ms']):
+        line = f'{name:<32} {total["calls"]:>6} {total["ms"]:>10.2f} {total["peak_bytes"]/(1 << 20):>9.1f}'
+        if name in baseline:
+            base_ms = baseline[name]['ms']
+            line += f' {base_ms:>10.2f} {total["ms"]/base_ms if base_ms > 0 else np.nan:>6.2f}x'
+        print(line)
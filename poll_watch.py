@@ -0,0 +1,111 @@
+import os
+
+from PyQt5.QtCore import *
+
+import numpy as np
+
+import poll_data
+import poll_jobs
+import csv_to_npy
+from poll_trace import span
+
+
+# A burst of writes to the csv within this long of each other is ingested and drawn once
+DEBOUNCE_MS = 500
+
+
+def read_rows(data_dir, columns, start, stop):
+    return { name : np.array(column[start:stop]) for name, column in poll_data.load(data_dir, columns).items() }
+
+
+def ingest(csv_path, data_dir, columns, committed_rows, num_rows):
+    # Runs on the watcher's job thread. Returns the meta after the ingest, the tail rows handed out before as they
+    # read now, and the rows after them.
+    with span('watch.ingest'):
+        csv_to_npy.convert(csv_path, data_dir)
+        meta = poll_data.load_meta(data_dir)
+
+        tail      = read_rows(data_dir, columns, committed_rows, num_rows)
+        new_polls = read_rows(data_dir, columns, num_rows, max(num_rows, meta['rows']))
+
+    return meta, tail, new_polls
+
+
+class PollWatcher(QObject):
+
+    # Columns of the polls appended since the last update, as a dict like poll_data.load returns
+    pollsAppended = pyqtSignal(object)
+
+    # The cache was rebuilt or rows already handed out changed, everything has to be loaded again
+    pollsReloaded = pyqtSignal()
+
+    def __init__(self, columns, num_rows, csv_path=csv_to_npy.CSV_PATH, data_dir=poll_data.DATA_DIR, debounce_ms=DEBOUNCE_MS, parent=None):
+        # Tails the csv. Appended lines go through the incremental ingest and only the rows after the num_rows the
+        # window already has are read back out of the cache. The ingest runs on a thread of its own so the window
+        # stays responsive, one at a time, with changes that come in meanwhile picked up by one more run after it.
+        QObject.__init__(self, parent)
+
+        self.columns  = columns
+        self.csv_path = csv_path
+        self.data_dir = data_dir
+        self.pending  = False
+        self.__sync(num_rows)
+
+        self.jobs = poll_jobs.JobRunner(max_threads=1, parent=self)
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(debounce_ms)
+        self.timer.timeout.connect(self.__update)
+
+        self.file_watcher = QFileSystemWatcher([ csv_path ], self)
+        self.file_watcher.fileChanged.connect(self.__file_changed)
+
+
+    def __sync(self, num_rows, meta=None):
+        # Rows past the committed ones came from a last line without a newline. Writers that put the newline at the
+        # start of the next line leave one there all the time, so it's kept to check against rather than reloaded.
+        if meta is None:
+            meta = poll_data.load_meta(self.data_dir)
+
+        self.num_rows       = num_rows
+        self.committed_rows = meta['committed_rows']
+        self.build_id       = meta.get('build_id')
+        self.tail           = self.__read(self.committed_rows, num_rows)
+
+
+    def __read(self, start, stop):
+        return read_rows(self.data_dir, self.columns, start, stop)
+
+
+    def __file_changed(self, path):
+        # Writers that replace the file instead of appending to it take it off the watch list
+        if path not in self.file_watcher.files() and os.path.exists(path):
+            self.file_watcher.addPath(path)
+
+        self.timer.start()
+
+
+    def __update(self):
+        if self.jobs.busy():
+            self.pending = True
+            return
+
+        self.pending = False
+        self.jobs.submit(ingest, self.csv_path, self.data_dir, self.columns, self.committed_rows, self.num_rows, callback=self.__ingested)
+
+
+    def __ingested(self, ingested):
+        meta, tail, new_polls = ingested
+
+        with span('watch.update'):
+            # A tail row handed out before it was committed may have been re-parsed into something else since
+            if meta.get('build_id') != self.build_id or any(not np.array_equal(tail[name], self.tail[name]) for name in self.columns):
+                self.__sync(meta['rows'], meta)
+                self.pollsReloaded.emit()
+            elif meta['rows'] > self.num_rows:
+                self.__sync(meta['rows'], meta)
+                self.pollsAppended.emit(new_polls)
+
+        if self.pending:
+            self.__update()
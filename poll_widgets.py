@@ -0,0 +1,191 @@
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtGui import *
+
+from poll_analysis import GAMEMODES, LOVED_THRESHOLD
+
+
+class ThresholdControl(QWidget):
+
+    SLIDER_STEPS = 1000
+
+    thresholdChanged = pyqtSignal(float)
+
+    def __init__(self, threshold=LOVED_THRESHOLD, parent=None):
+        QWidget.__init__(self, parent)
+
+        self.slider = QSlider(Qt.Horizontal)
+        self.slider.setRange(0, self.SLIDER_STEPS)
+        self.slider.setValue(round(threshold*self.SLIDER_STEPS))
+
+        self.spinbox = QDoubleSpinBox()
+        self.spinbox.setRange(0, 1)
+        self.spinbox.setDecimals(3)
+        self.spinbox.setSingleStep(0.005)
+        self.spinbox.setValue(threshold)
+
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(4, 0, 4, 0)
+        layout.addWidget(QLabel('% Yes threshold'))
+        layout.addWidget(self.slider, stretch=1)
+        layout.addWidget(self.spinbox)
+
+        self.slider.valueChanged.connect(self.__slider_changed)
+        self.spinbox.valueChanged.connect(self.__spinbox_changed)
+
+
+    def value(self):
+        return self.spinbox.value()
+
+
+    def __slider_changed(self, value):
+        self.spinbox.setValue(value/self.SLIDER_STEPS)
+
+
+    def __spinbox_changed(self, value):
+        self.slider.blockSignals(True)
+        self.slider.setValue(round(value*self.SLIDER_STEPS))
+        self.slider.blockSignals(False)
+
+        self.thresholdChanged.emit(value)
+
+
+
+class SelectionControl(QWidget):
+
+    selectionChanged = pyqtSignal(object)
+
+    def __init__(self, selection=None, parent=None):
+        # The last N rounds, a gamemode and a title search, the part of a poll_query selection that can be changed
+        # from the window. The rest of the selection, from the command line, is passed along as it is.
+        QWidget.__init__(self, parent)
+
+        self.selection = dict(selection or {})
+        gamemodes = self.selection.get('gamemodes') or []
+
+        self.rounds_spinbox = QSpinBox()
+        self.rounds_spinbox.setRange(0, 65535)
+        self.rounds_spinbox.setSpecialValueText('All')
+        self.rounds_spinbox.setKeyboardTracking(False)
+        self.rounds_spinbox.setValue(self.selection.get('last_rounds') or 0)
+
+        self.gamemode_combo = QComboBox()
+        self.gamemode_combo.addItems([ 'All' ] + list(GAMEMODES))
+        if len(gamemodes) == 1:
+            self.gamemode_combo.setCurrentText(gamemodes[0])
+
+        self.search_edit = QLineEdit(self.selection.get('search') or '')
+        self.search_edit.setPlaceholderText('artist, title or mapper')
+
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(4, 0, 4, 0)
+        layout.addWidget(QLabel('Last rounds'))
+        layout.addWidget(self.rounds_spinbox)
+        layout.addWidget(QLabel('Gamemode'))
+        layout.addWidget(self.gamemode_combo)
+        layout.addWidget(QLabel('Search'))
+        layout.addWidget(self.search_edit)
+
+        self.rounds_spinbox.valueChanged.connect(self.__changed)
+        self.gamemode_combo.currentIndexChanged.connect(self.__changed)
+        self.search_edit.editingFinished.connect(self.__search_changed)
+
+
+    def value(self):
+        return dict(self.selection)
+
+
+    def __changed(self, _):
+        self.selection['last_rounds'] = self.rounds_spinbox.value() or None
+        self.selection['gamemodes']   = None if self.gamemode_combo.currentIndex() == 0 else [ self.gamemode_combo.currentText() ]
+        self.selection['search']      = self.search_edit.text().strip() or None
+
+        self.selectionChanged.emit(self.value())
+
+
+    def __search_changed(self):
+        # Editing finishes on every loss of focus too, only an actual change reloads
+        search = self.search_edit.text().strip() or None
+        if search == self.selection.get('search'):
+            return
+
+        self.__changed(None)
+
+
+
+class RoundRangeControl(QWidget):
+
+    roundsChanged = pyqtSignal(object)
+
+    def __init__(self, last_round=0, parent=None):
+        # A first and last round, or None while the first is left at Off
+        QWidget.__init__(self, parent)
+
+        self.first_spinbox = QSpinBox()
+        self.first_spinbox.setRange(0, 65535)
+        self.first_spinbox.setSpecialValueText('Off')
+        self.first_spinbox.setKeyboardTracking(False)
+
+        self.last_spinbox = QSpinBox()
+        self.last_spinbox.setRange(0, 65535)
+        self.last_spinbox.setKeyboardTracking(False)
+        self.last_spinbox.setValue(last_round)
+
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(4, 0, 4, 0)
+        layout.addWidget(QLabel('Rounds'))
+        layout.addWidget(self.first_spinbox)
+        layout.addWidget(QLabel('to'))
+        layout.addWidget(self.last_spinbox)
+
+        self.first_spinbox.valueChanged.connect(self.__changed)
+        self.last_spinbox.valueChanged.connect(self.__changed)
+
+
+    def set_last_round(self, last_round):
+        # Follows the data as it's loaded, without counting as a change
+        self.last_spinbox.blockSignals(True)
+        self.last_spinbox.setValue(last_round)
+        self.last_spinbox.blockSignals(False)
+
+
+    def value(self):
+        if self.first_spinbox.value() == 0:
+            return None
+
+        return self.first_spinbox.value(), self.last_spinbox.value()
+
+
+    def __changed(self, _):
+        self.roundsChanged.emit(self.value())
+
+
+
+class JobProgress(QWidget):
+
+    def __init__(self, parent=None):
+        # Shown while a poll_jobs.JobRunner has jobs left, hidden once they're all in
+        QWidget.__init__(self, parent)
+
+        self.label = QLabel('Computing')
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(200)
+
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(4, 0, 4, 0)
+        layout.addWidget(self.label)
+        layout.addWidget(self.progress_bar)
+
+        self.setVisible(False)
+
+
+    def set_progress(self, num_done, num_jobs):
+        self.progress_bar.setRange(0, max(num_jobs, 1))
+        self.progress_bar.setValue(num_done)
+        self.setVisible(num_done < num_jobs)
+
+
+    def reset(self, *_):
+        # Connected to JobRunner.jobFailed, a failure clears the bar until the next progress comes in
+        self.progress_bar.reset()
+        self.setVisible(False)
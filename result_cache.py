@@ -0,0 +1,184 @@
+import os
+import pickle
+import inspect
+import hashlib
+import threading
+import functools
+import collections
+import numpy as np
+
+from poll_trace import span
+
+
+CACHE_DIR = 'data/cache'
+
+# Bump when the analyses change what they return so stale results stop matching
+CACHE_VERSION = 1
+
+MAX_DISK_BYTES     = 256 << 20
+MAX_MEMORY_ENTRIES = 32
+
+
+def fingerprint(value, digest=None):
+    # Content hash of an argument. Arrays hash their bytes, objects that are expensive to hash (the partition)
+    # provide a precomputed fingerprint, and everything else goes by its repr.
+    if digest is None:
+        digest = hashlib.blake2b(digest_size=20)
+
+    if hasattr(value, 'fingerprint'):
+        digest.update(b'fingerprint')
+        digest.update(value.fingerprint.encode())
+    elif isinstance(value, np.ndarray):
+        digest.update(f'ndarray{value.dtype.str}{value.shape}'.encode())
+        digest.update(np.ascontiguousarray(value).view(np.uint8).data)
+    elif isinstance(value, dict):
+        digest.update(f'dict{len(value)}'.encode())
+        for key in sorted(value):
+            fingerprint(key, digest)
+            fingerprint(value[key], digest)
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            fingerprint(item, digest)
+    else:
+        digest.update(repr(value).encode())
+
+    return digest
+
+
+class ResultCache():
+
+    def __init__(self, cache_dir=CACHE_DIR, max_disk_bytes=MAX_DISK_BYTES, max_memory_entries=MAX_MEMORY_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_entries = max_memory_entries
+        self.memory = collections.OrderedDict()
+
+        # The GUIs compute on a thread pool, gets and puts from different threads take turns
+        self.lock = threading.RLock()
+
+
+    def key(self, name, args, kwargs):
+        digest = fingerprint((CACHE_VERSION, name, args, kwargs))
+        return digest.hexdigest()
+
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pkl')
+
+
+    def get(self, key):
+        # Returns (hit, value). Disk hits get their mtime bumped, which is what the disk eviction orders by.
+        with self.lock:
+            return self.__get(key)
+
+
+    def __get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return True, self.memory[key]
+
+        if self.cache_dir is None or not os.path.exists(self.path(key)):
+            return False, None
+
+        try:
+            with open(self.path(key), 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+        os.utime(self.path(key))
+        self.__remember(key, value)
+        return True, value
+
+
+    def put(self, key, value):
+        with self.lock:
+            self.__put(key, value)
+
+
+    def __put(self, key, value):
+        self.__remember(key, value)
+
+        if self.cache_dir is None:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(f'{self.path(key)}.tmp', 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(f'{self.path(key)}.tmp', self.path(key))
+        self.evict()
+
+
+    def evict(self):
+        # Drops the least recently used results until the cache directory fits in its size budget
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pkl'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_disk_bytes:
+                break
+
+            os.remove(path)
+            total_bytes -= size
+
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.cache_dir is not None and os.path.exists(self.cache_dir):
+                for entry in os.scandir(self.cache_dir):
+                    if entry.name.endswith('.pkl'):
+                        os.remove(entry.path)
+
+
+    def __remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+
+default_cache = ResultCache(os.environ.get('POLL_CACHE_DIR', CACHE_DIR))
+
+
+def memoize(fn=None, ignore=()):
+    # Results are keyed by the function and a content hash of its arguments, so they stay valid across runs
+    # for as long as the data and parameters don't change. Arguments are keyed by name with defaults filled in, so
+    # passing one positionally or by keyword is the same result. Ones in ignore, like a worker count, don't change
+    # the result and are left out of the key.
+    if fn is None:
+        return functools.partial(memoize, ignore=ignore)
+
+    name = f'{fn.__module__}.{fn.__qualname__}'
+    signature = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with span(fn.__qualname__) as fn_span:
+            with span('cache.get'):
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                key = default_cache.key(name, (), { arg : value for arg, value in bound.arguments.items() if arg not in ignore })
+                hit, value = default_cache.get(key)
+
+            if fn_span is not None:
+                fn_span.args['cached'] = hit
+
+            if hit:
+                return value
+
+            value = fn(*args, **kwargs)
+
+            with span('cache.put'):
+                default_cache.put(key, value)
+
+            return value
+
+    return wrapper
@@ -0,0 +1,312 @@
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+np.set_printoptions(suppress=True, formatter={ 'float_kind' : '{:0.2f}'.format })
+
+import poll_data
+import poll_analysis
+import poll_bootstrap
+import poll_timeseries
+import poll_trace
+import poll_query
+import poll_groups
+import poll_chunked
+import poll_cube
+import result_cache
+from poll_trace import span
+from poll_data import ROUND, END_TIME, GAMEMODE, BEATMAPSET_ID, NUM_YES, NUM_NO
+from poll_analysis import GAMEMODES, NUM_VOTES, YES_RATIO, LOVED_LEVELS, LOVED_THRESHOLD
+
+
+# Headless counterpart of the run_*.py scripts. Nothing here imports Qt unless images are asked for.
+
+def loved_percent_results(partition, threshold_resolution):
+    percent_threshold = np.linspace(0, 1, threshold_resolution)
+    return format_loved_percent(percent_threshold, poll_analysis.loved_results(partition, percent_threshold))
+
+
+def format_loved_percent(percent_threshold, loved_results):
+    results = {}
+
+    for name in GAMEMODES:
+        results[name] = {
+            'threshold'     : percent_threshold.tolist(),
+            'loved_passing' : nan_to_none(loved_results[name]['loved_passing']),
+            'breakpoints'   : { f'{loved_level*100:.0f}%' : (None if np.isnan(threshold) else threshold) for loved_level, threshold in zip(LOVED_LEVELS, loved_results[name]['breakpoints']) },
+        }
+
+    return results
+
+
+def nan_to_none(values):
+    return [ None if np.isnan(value) else value for value in values ]
+
+
+def yes_vote_results(partition, num_bins, percentiles=(25, 50, 75), num_ratio_bins=20):
+    ratio_edges = np.linspace(0, 1, num_ratio_bins + 1)
+    return format_yes_vote(ratio_edges, poll_analysis.yes_vote_results(partition, num_bins, percentiles, ratio_edges))
+
+
+def format_yes_vote(ratio_edges, yes_vote_results):
+    results = {}
+
+    for name in GAMEMODES:
+        yes_votes_stats = yes_vote_results[name]
+
+        results[name] = {
+            'bin_edges'        : yes_votes_stats['bin_edges'].tolist(),
+            'ratio_edges'      : ratio_edges.tolist(),
+            'count'            : yes_votes_stats['count'].tolist(),
+            'mean_yes_percent' : nan_to_none(yes_votes_stats['mean']),
+            'percentiles'      : { percentile : nan_to_none(values) for percentile, values in yes_votes_stats.get('percentiles', {}).items() },
+            'density'          : yes_votes_stats['density'].tolist(),
+        }
+
+    return results
+
+
+def bootstrap_results(partition, threshold_resolution, num_bins, num_resamples, confidence, seed, workers):
+    confidence_bands = poll_bootstrap.bootstrap(partition, np.linspace(0, 1, threshold_resolution), num_bins, num_resamples, confidence, seed, workers)
+    results = {}
+
+    for name in GAMEMODES:
+        results[name] = {
+            'loved_passing'    : [ nan_to_none(band) for band in confidence_bands[name]['loved_passing'] ],
+            'breakpoints'      : { f'{loved_level*100:.0f}%' : nan_to_none(band) for loved_level, band in zip(LOVED_LEVELS, confidence_bands[name]['breakpoints'].T) },
+            'mean_yes_percent' : [ nan_to_none(band) for band in confidence_bands[name]['mean_yes_percent'] ],
+        }
+
+    return results
+
+
+def participation_results(partition, loved_threshold):
+    # One row per poll: gamemode, round, total votes, yes ratio, passed
+    results = []
+
+    for name, gamemode in GAMEMODES.items():
+        mode = partition[name]
+        results.append(np.column_stack([
+            np.full(len(mode[ROUND]), gamemode), mode[ROUND], mode[NUM_VOTES], mode[YES_RATIO], mode[YES_RATIO] > loved_threshold
+        ]))
+
+    return np.concatenate(results)
+
+
+def timeseries_results(partition, window, by, loved_threshold):
+    series  = poll_timeseries.timeseries_results(partition, window, by, loved_threshold)
+    results = {}
+
+    for name in GAMEMODES:
+        results[name] = { column : (values.tolist() if values.dtype.kind in 'iu' else nan_to_none(values)) for column, values in series[name].items() }
+
+    return results
+
+
+def beatmapset_results(groups, loved_threshold):
+    # One row per map and gamemode: beatmapset, gamemode, polls, latest and best yes ratio, pass/fail per poll
+    return zip(groups['beatmapset_id'], groups['gamemode'], groups['num_polls'], groups['latest_yes_ratio'], groups['best_yes_ratio'],
+        poll_groups.outcome_strings(groups, loved_threshold))
+
+
+def round_range_results(cube, round_ranges, thresholds):
+    # One row per mode, round range and threshold: gamemode, first round, last round, threshold, the grid threshold
+    # the cube counted at or above for it, polls, passing, pass rate
+    results = []
+
+    for name, gamemode in GAMEMODES.items():
+        for first_round, last_round in round_ranges:
+            for threshold in thresholds:
+                results.append((gamemode, first_round, last_round, threshold, cube.grid_threshold(threshold), cube.num_polls(name, first_round, last_round),
+                    cube.num_passing(name, threshold, first_round, last_round), cube.pass_rate(name, threshold, first_round, last_round)))
+
+    return results
+
+
+def chunked_results(threshold_resolution, num_bins, loved_threshold, chunk_rows, workers, num_ratio_bins=20):
+    # Out of core over the whole column cache. Yes vote bins have no percentiles and rounds have no rolling windows,
+    # neither is mergeable across blocks.
+    percent_threshold = np.linspace(0, 1, threshold_resolution)
+    ratio_edges = np.linspace(0, 1, num_ratio_bins + 1)
+    results = poll_chunked.chunked_results(poll_data.DATA_DIR, percent_threshold, num_bins, ratio_edges, loved_threshold, chunk_rows, workers)
+
+    loved_percent = format_loved_percent(percent_threshold, results)
+    yes_vote      = format_yes_vote(ratio_edges, { name : results[name]['yes_vote'] for name in GAMEMODES })
+    rounds        = { name : { column : (values.tolist() if values.dtype.kind in 'iu' else nan_to_none(values)) for column, values in results[name]['rounds'].items() }
+        for name in GAMEMODES }
+
+    return loved_percent, yes_vote, rounds
+
+
+def save_images(out_dir, loved_percent, yes_vote, participation):
+    # Qt is only pulled in here and rendered without a display
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+    import pyqtgraph
+    import pyqtgraph.exporters
+
+    # Widgets need an application to exist first, pyqtgraph keeps hold of the one it makes
+    pyqtgraph.mkQApp()
+
+    for name, gamemode in GAMEMODES.items():
+        widget = pyqtgraph.PlotWidget(title=f'{name.capitalize()} % of Maps Loved vs % Yes Threashold')
+        widget.setLabel('left', '% of Maps Loved')
+        widget.setLabel('bottom', '% Yes Threshold')
+        widget.plot(loved_percent[name]['threshold'], loved_percent[name]['loved_passing'], pen='y')
+        pyqtgraph.exporters.ImageExporter(widget.plotItem).export(os.path.join(out_dir, f'loved_percent_{name}.png'))
+
+        mode = participation[participation[:, 0] == gamemode]
+        mean_yes_percent = np.asarray(yes_vote[name]['mean_yes_percent'], dtype=np.float64)
+
+        widget = pyqtgraph.PlotWidget(title=f'{name.capitalize()} participation vs % Yes votes')
+        widget.setLabel('left', '% Yes')
+        widget.setLabel('bottom', '# Total Votes')
+        widget.plot(mode[:, 2], mode[:, 3], pen=None, symbol='o', symbolPen=None, symbolSize=2, symbolBrush=(100, 100, 255, 200))
+        widget.plot(yes_vote[name]['bin_edges'][:-1], mean_yes_percent, pen=pyqtgraph.mkPen(color=(255, 255, 0, 100)))
+        pyqtgraph.exporters.ImageExporter(widget.plotItem).export(os.path.join(out_dir, f'yes_vote_{name}.png'))
+
+        passed = mode[:, 4] == 1
+        widget = pyqtgraph.PlotWidget(title=f'{name.capitalize()} cycle vs # total votes')
+        widget.setLabel('left', '# Total Votes')
+        widget.setLabel('bottom', 'Cycle')
+        widget.plot(mode[passed, 1], mode[passed, 2], pen=None, symbol='o', symbolPen=None, symbolSize=2, symbolBrush=(100, 100, 255, 200))
+        widget.plot(mode[~passed, 1], mode[~passed, 2], pen=None, symbol='o', symbolPen=None, symbolSize=2, symbolBrush=(255, 100, 100, 200))
+        pyqtgraph.exporters.ImageExporter(widget.plotItem).export(os.path.join(out_dir, f'participation_{name}.png'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the loved percent, yes vote and participation analyses without a GUI')
+    parser.add_argument('--out', default='output', help='Directory to write results to')
+    parser.add_argument('--threshold-resolution', type=int, default=1000)
+    parser.add_argument('--bins', type=int, default=20)
+    parser.add_argument('--loved-threshold', type=float, default=LOVED_THRESHOLD)
+    parser.add_argument('--images', action='store_true', help='Also render the plots to png files')
+    parser.add_argument('--bootstrap', type=int, default=0, help='Number of bootstrap resamples for confidence bands, 0 to skip')
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-cache', action='store_true', help='Recompute everything without reading or writing the result cache')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes for the bootstrap and --chunked, defaults to the number of cores')
+    parser.add_argument('--window', type=int, default=8, help='Rounds in each rolling window of the per-round time series')
+    parser.add_argument('--window-days', type=float, default=None, help='Roll over this many days of poll end time instead of a number of rounds')
+    poll_query.add_selection_args(parser)
+    parser.add_argument('--round-range', action='append', default=[], help='Round range FIRST:LAST to give pass rates for from the loved cube, may be repeated')
+    parser.add_argument('--range-thresholds', type=float, nargs='+', default=[ 0.7, 0.75, 0.8, 0.85, 0.9 ], help='Yes ratio thresholds for --round-range, counted at or above the cube grid threshold they round up to')
+    parser.add_argument('--chunked', action='store_true', help='Stream the whole history through in blocks with constant memory, for loved percent, yes vote and per-round results only')
+    parser.add_argument('--chunk-rows', type=int, default=poll_chunked.CHUNK_ROWS, help='Rows per block with --chunked')
+    parser.add_argument('--trace', default=None, help='Write a chrome trace of the analysis stages to this file')
+    args = parser.parse_args()
+
+    if args.chunked and not poll_query.is_empty(poll_query.selection_from_args(args)):
+        parser.error('--chunked runs over the whole history and takes no selection')
+
+    if args.window < 1:
+        parser.error('--window must be at least 1')
+
+    if args.window_days is not None and not args.window_days > 0:
+        parser.error('--window-days must be positive')
+
+    if args.trace is not None:
+        poll_trace.enable(args.trace)
+
+    os.makedirs(args.out, exist_ok=True)
+
+    if args.no_cache:
+        result_cache.default_cache.cache_dir = None
+
+    if args.chunked:
+        with span('chunked'):
+            workers = 0 if args.workers == 1 else args.workers
+            loved_percent, yes_vote, rounds = chunked_results(args.threshold_resolution, args.bins, args.loved_threshold, args.chunk_rows, workers)
+
+        for file_name, results in [ ('loved_percent.json', loved_percent), ('yes_vote.json', yes_vote), ('rounds.json', rounds) ]:
+            with open(os.path.join(args.out, file_name), 'w') as f:
+                json.dump(results, f)
+
+        for name in GAMEMODES:
+            print(f'{name.capitalize()}:')
+            for loved_level, threshold in loved_percent[name]['breakpoints'].items():
+                print(f' {loved_level:>4}: {threshold}')
+            print()
+
+        sys.exit()
+
+    with span('load'):
+        selection = poll_query.selection_from_args(args)
+        query     = poll_query.PollQuery(poll_data.load())
+        columns   = poll_query.select_polls(query, selection, [ ROUND, END_TIME, GAMEMODE, NUM_YES, NUM_NO ])
+
+    with span('partition'):
+        partition = poll_analysis.GamemodePartition(columns)
+
+    with span('loved_percent'):
+        loved_percent = loved_percent_results(partition, args.threshold_resolution)
+
+    with span('yes_vote'):
+        yes_vote = yes_vote_results(partition, args.bins)
+
+    with span('participation'):
+        participation = participation_results(partition, args.loved_threshold)
+
+    # The grouping saved at ingest covers the whole history, a selection is grouped on its own
+    with span('beatmapsets'):
+        if poll_query.is_empty(selection):
+            groups = poll_groups.load_groups()
+        else:
+            groups = poll_groups.group_polls(poll_query.select_polls(query, selection, [ BEATMAPSET_ID, GAMEMODE, NUM_YES, NUM_NO ]))
+
+        beatmapsets = beatmapset_results(groups, args.loved_threshold)
+
+    # The saved cube covers the whole history and is only counted once a round range asks for it, a selection gets
+    # one of its own over only its rounds
+    with span('round_ranges'):
+        round_ranges = [ (int(first), int(last)) for first, _, last in (round_range.partition(':') for round_range in args.round_range) ]
+        if len(round_ranges) > 0:
+            cube = poll_cube.load_cube() if poll_query.is_empty(selection) else poll_cube.build_cube(columns)
+            round_range_rates = round_range_results(cube, round_ranges, args.range_thresholds)
+
+    with span('timeseries'):
+        if args.window_days is not None:
+            timeseries = timeseries_results(partition, int(args.window_days*24*3600), poll_timeseries.BY_TIME, args.loved_threshold)
+        else:
+            timeseries = timeseries_results(partition, args.window, poll_timeseries.BY_ROUNDS, args.loved_threshold)
+
+    with open(os.path.join(args.out, 'loved_percent.json'), 'w') as f:
+        json.dump(loved_percent, f)
+
+    with open(os.path.join(args.out, 'yes_vote.json'), 'w') as f:
+        json.dump(yes_vote, f)
+
+    with open(os.path.join(args.out, 'timeseries.json'), 'w') as f:
+        json.dump(timeseries, f)
+
+    np.savetxt(os.path.join(args.out, 'participation.csv'), participation, delimiter=',', fmt=[ '%d', '%d', '%d', '%.6f', '%d' ],
+        header='gamemode,round,num_votes,yes_ratio,passed', comments='')
+
+    with open(os.path.join(args.out, 'beatmapsets.csv'), 'w') as f:
+        f.write('beatmapset_id,gamemode,num_polls,latest_yes_ratio,best_yes_ratio,outcomes\n')
+        for beatmapset_id, gamemode, num_polls, latest_yes_ratio, best_yes_ratio, outcome in beatmapsets:
+            f.write(f'{beatmapset_id},{gamemode},{num_polls},{latest_yes_ratio:.6f},{best_yes_ratio:.6f},{outcome}\n')
+
+    if len(round_ranges) > 0:
+        with open(os.path.join(args.out, 'round_ranges.csv'), 'w') as f:
+            f.write('gamemode,first_round,last_round,threshold,grid_threshold,num_polls,num_passing,pass_rate\n')
+            for gamemode, first_round, last_round, threshold, grid_threshold, num_polls, num_passing, pass_rate in round_range_rates:
+                f.write(f'{gamemode},{first_round},{last_round},{threshold},{grid_threshold},{num_polls},{num_passing},{pass_rate:.6f}\n')
+
+    if args.bootstrap > 0:
+        with span('bootstrap'):
+            confidence_bands = bootstrap_results(partition, args.threshold_resolution, args.bins, args.bootstrap, args.confidence, args.seed, args.workers)
+        with open(os.path.join(args.out, 'bootstrap.json'), 'w') as f:
+            json.dump(confidence_bands, f)
+
+    if args.images:
+        with span('save_images'):
+            save_images(args.out, loved_percent, yes_vote, participation)
+
+    for name in GAMEMODES:
+        print(f'{name.capitalize()}:')
+        for loved_level, threshold in loved_percent[name]['breakpoints'].items():
+            print(f' {loved_level:>4}: {threshold}')
+        print()
@@ -0,0 +1,184 @@
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import contextlib
+import subprocess
+import tracemalloc
+
+import numpy as np
+
+import poll_data
+import poll_synth
+import csv_to_npy
+import poll_analysis
+import poll_timeseries
+import poll_chunked
+import run_batch
+import run_loved_percent
+import run_yes_vote
+import run_participation
+from poll_data import ROUND, END_TIME, GAMEMODE, NUM_YES, NUM_NO
+from poll_analysis import GAMEMODES, LOVED_THRESHOLD
+
+
+BENCH_DIR = 'data/bench'
+OUT_DIR   = 'output/benchmark'
+
+SIZES = [ 10000, 100000, 1000000 ]
+
+THRESHOLD_RESOLUTION = 1000
+NUM_BINS             = 20
+RATIO_EDGES          = np.linspace(0, 1, 21)
+THRESHOLD_STEPS      = 100
+TIMESERIES_WINDOW    = 8
+
+# Small enough that even the smallest history takes a few blocks, so the chunked peak shows as flat across sizes
+CHUNK_ROWS = 1 << 16
+
+
+def measure(fn, repeat=1):
+    # Best wall time over the repeats, then one more run under tracemalloc for the peak of memory allocated while
+    # the stage ran. Tracing slows python allocations down a lot, so it is kept out of the timed runs. Peaks are
+    # what numpy and python allocate, pages mapped in from the column files don't count.
+    best = np.inf
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t_start)
+
+    tracemalloc.start()
+    result = fn()
+    peak   = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, best, peak
+
+
+def threshold_sweep(partition):
+    # What dragging the threshold control does to the participation plots, one step at a time across the range
+    for name in GAMEMODES:
+        threshold_index = poll_analysis.ThresholdIndex(partition.sorted_yes_ratio(name), LOVED_THRESHOLD)
+        for threshold in np.linspace(0, 1, THRESHOLD_STEPS):
+            threshold_index.set_threshold(threshold)
+
+
+def plot_data(mode_fn, partition, *args):
+    # What a window computes for each mode once its polls are loaded, before anything is drawn
+    for name in GAMEMODES:
+        mode_fn(partition, name, *args)
+
+
+def bench_size(num_rows, bench_dir, seed, repeat):
+    csv_path = os.path.join(bench_dir, f'poll_history_{num_rows}_{seed}.csv')
+    data_dir = os.path.join(bench_dir, f'polls_{num_rows}_{seed}')
+
+    # Histories are generated once and kept, only the stages after are timed
+    if not os.path.exists(csv_path):
+        print(f'Generating {num_rows} rows', file=sys.stderr)
+        poll_synth.generate(num_rows, csv_path, seed)
+
+    def ingest():
+        with contextlib.redirect_stdout(io.StringIO()):
+            csv_to_npy.convert(csv_path, data_dir, rebuild=True)
+
+    stages = {}
+    def stage(name, fn):
+        result, seconds, peak = measure(fn, repeat)
+        stages[name] = {
+            'seconds'    : seconds,
+            'rows_per_s' : num_rows/seconds if seconds > 0 else None,
+            'peak_bytes' : peak,
+        }
+        return result
+
+    # The analyses are timed without the result cache in front of them
+    stage('ingest', ingest)
+    columns   = stage('load',      lambda: { name : np.array(column) for name, column in poll_data.load(data_dir, [ ROUND, END_TIME, GAMEMODE, NUM_YES, NUM_NO ]).items() })
+    partition = stage('partition', lambda: poll_analysis.GamemodePartition(columns))
+    stage('loved_percent',      lambda: poll_analysis.loved_results.__wrapped__(partition, np.linspace(0, 1, THRESHOLD_RESOLUTION)))
+    stage('yes_vote',           lambda: poll_analysis.yes_vote_results.__wrapped__(partition, NUM_BINS, (25, 50, 75), RATIO_EDGES))
+    stage('participation',      lambda: run_batch.participation_results(partition, LOVED_THRESHOLD))
+    stage('threshold_sweep',    lambda: threshold_sweep(partition))
+    stage('plot_loved',         lambda: plot_data(run_loved_percent.mode_results, partition, np.linspace(0, 1, THRESHOLD_RESOLUTION)))
+    stage('plot_yes_vote',      lambda: plot_data(run_yes_vote.mode_results, partition))
+    stage('plot_participation', lambda: plot_data(run_participation.mode_plot_data, partition))
+    stage('timeseries',         lambda: poll_timeseries.timeseries_results.__wrapped__(partition, TIMESERIES_WINDOW))
+    stage('chunked',            lambda: poll_chunked.chunked_results(data_dir, np.linspace(0, 1, THRESHOLD_RESOLUTION), NUM_BINS, RATIO_EDGES, LOVED_THRESHOLD, CHUNK_ROWS, workers=0))
+
+    stages['ingest']['csv_bytes'] = os.path.getsize(csv_path)
+    return stages
+
+
+def environment():
+    try:
+        commit = subprocess.run([ 'git', 'rev-parse', '--short', 'HEAD' ], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit'    : commit,
+        'time'      : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python'    : platform.python_version(),
+        'numpy'     : np.__version__,
+        'platform'  : platform.platform(),
+        'cpu_count' : os.cpu_count(),
+    }
+
+
+def print_results(results, baseline=None):
+    print(f'{"rows":>10} {"stage":<18} {"time (s)":>10} {"rows/s":>12} {"peak MB":>9}' + (f' {"vs base":>8}' if baseline else ''))
+
+    for num_rows, stages in results['sizes'].items():
+        for name, stage in stages.items():
+            line = f'{num_rows:>10} {name:<18} {stage["seconds"]:>10.4f} {stage["rows_per_s"] or 0:>12.0f} {stage["peak_bytes"]/(1 << 20):>9.1f}'
+
+            base = (baseline or {}).get('sizes', {}).get(num_rows, {}).get(name)
+            if base is not None:
+                line += f' {stage["seconds"]/base["seconds"]:>7.2f}x'
+
+            print(line)
+
+    print(f'Max RSS: {results["max_rss_bytes"]/(1 << 20):.1f} MB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time ingest, loading and each analysis stage on synthetic poll histories')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Rows per synthetic history, up to 10000000 or so')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per stage, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bench-dir', default=BENCH_DIR, help='Where generated histories and their column files are kept')
+    parser.add_argument('--out', default=OUT_DIR, help='Directory results are saved to, one json file per run')
+    parser.add_argument('--compare', default=None, help='Earlier results file to compare stage times against')
+    args = parser.parse_args()
+
+    results = {
+        'environment' : environment(),
+        'repeat'      : args.repeat,
+        'seed'        : args.seed,
+        'sizes'       : {},
+    }
+
+    for num_rows in args.sizes:
+        results['sizes'][str(num_rows)] = bench_size(num_rows, args.bench_dir, args.seed, args.repeat)
+
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['max_rss_bytes'] = max_rss if sys.platform == 'darwin' else max_rss*1024
+
+    os.makedirs(args.out, exist_ok=True)
+    out_path = os.path.join(args.out, f'{time.strftime("%Y%m%d-%H%M%S")}_{results["environment"]["commit"] or "unknown"}.json')
+    with open(out_path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline)
+    print(f'Saved to {out_path}')
@@ -0,0 +1,132 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import collections
+import urllib.parse
+
+import numpy as np
+
+import run_server
+from poll_analysis import GAMEMODES
+
+
+CONCURRENCY  = 16
+NUM_REQUESTS = 2000
+
+# Distinct parameter sets requests are drawn from, fewer of them means more response cache hits
+NUM_DISTINCT = 50
+
+PERCENTILES = [ 50, 90, 99, 99.9 ]
+
+
+def random_target(rng, endpoints):
+    # A request like the GUIs would make, a threshold resolution or bin count over some gamemodes and last rounds
+    path = rng.choice(endpoints)
+    params = {
+        '/loved_percent' : lambda: { 'threshold_resolution' : rng.choice([ 100, 500, 1000, 2000 ]) },
+        '/yes_vote'      : lambda: { 'bins' : rng.choice([ 10, 20, 40, 80 ]) },
+        '/participation' : lambda: { 'loved_threshold' : rng.choice([ 0.8, 0.85, 0.9 ]) },
+        '/timeseries'    : lambda: { 'window' : rng.choice([ 4, 8, 16 ]) },
+    }[path]()
+
+    if rng.random() < 0.5:
+        params['last_rounds'] = rng.randint(1, 100)
+
+    if rng.random() < 0.5:
+        params['gamemode'] = rng.choice(list(GAMEMODES))
+
+    return f'{path}?{urllib.parse.urlencode(params)}'
+
+
+async def fetch(reader, writer, host, target):
+    # One keep-alive GET, returns the status and the X-Cache header
+    writer.write(f'GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode('latin-1'))
+    await writer.drain()
+
+    status  = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    await reader.readexactly(int(headers['content-length']))
+    return status, headers.get('x-cache')
+
+
+async def client(host, port, targets, queue, latencies, outcomes):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while not queue.empty():
+            target = targets[queue.get_nowait()]
+
+            t_start = time.perf_counter()
+            status, outcome = await fetch(reader, writer, host, target)
+            latencies.append(time.perf_counter() - t_start)
+            outcomes[outcome if status == 200 else f'status {status}'] += 1
+    finally:
+        writer.close()
+
+
+async def load_test(host, port, targets, num_requests, concurrency, rng):
+    # Each client holds a connection open and takes the next request off a shared queue until none are left
+    queue = asyncio.Queue()
+    for _ in range(num_requests):
+        queue.put_nowait(rng.randrange(len(targets)))
+
+    latencies = []
+    outcomes  = collections.Counter()
+
+    t_start = time.perf_counter()
+    await asyncio.gather(*[ client(host, port, targets, queue, latencies, outcomes) for _ in range(concurrency) ])
+    elapsed = time.perf_counter() - t_start
+
+    latencies = np.asarray(latencies)
+    return {
+        'requests'    : len(latencies),
+        'concurrency' : concurrency,
+        'elapsed_s'   : elapsed,
+        'rps'         : len(latencies)/elapsed,
+        'latency_ms'  : { f'p{percentile:g}' : float(np.percentile(latencies, percentile)*1000) for percentile in PERCENTILES } | { 'max' : float(latencies.max()*1000) },
+        'outcomes'    : dict(outcomes),
+    }
+
+
+def print_results(results):
+    print(f'{results["requests"]} requests over {results["concurrency"]} connections in {results["elapsed_s"]:.2f}s, {results["rps"]:.1f} requests/s')
+    print('Latency (ms): ' + ', '.join(f'{name} {value:.2f}' for name, value in results['latency_ms'].items()))
+    print('Outcomes: ' + ', '.join(f'{name} {count}' for name, count in sorted(results['outcomes'].items())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure requests per second and tail latency of run_server.py')
+    parser.add_argument('--host', default=run_server.HOST)
+    parser.add_argument('--port', type=int, default=run_server.PORT)
+    parser.add_argument('--requests', type=int, default=NUM_REQUESTS)
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='Connections sending requests at once')
+    parser.add_argument('--distinct', type=int, default=NUM_DISTINCT, help='Distinct parameter sets to draw requests from')
+    parser.add_argument('--endpoints', nargs='+', choices=list(run_server.ENDPOINTS), default=list(run_server.ENDPOINTS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='Also save the results to this json file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    targets = [ random_target(rng, args.endpoints) for _ in range(args.distinct) ]
+
+    try:
+        results = asyncio.run(load_test(args.host, args.port, targets, args.requests, args.concurrency, rng))
+    except ConnectionRefusedError:
+        print(f'Nothing listening on {args.host}:{args.port}, start run_server.py first', file=sys.stderr)
+        sys.exit(1)
+
+    print_results(results)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,4 +1,6 @@
 import sys
+import argparse
+import functools
 
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
@@ -8,50 +10,168 @@ import pyqtgraph
 from pyqtgraph.Qt import QtCore, QtGui
 from pyqtgraph.dockarea import DockArea
 
-from scipy import stats
-
 import numpy as np
 np.set_printoptions(suppress=True, formatter={ 'float_kind' : '{:0.2f}'.format })
 
+import poll_data
+import poll_analysis
+import poll_trace
+import poll_bootstrap
+import poll_widgets
+import poll_watch
+import poll_query
+import poll_cube
+import poll_jobs
+from poll_data import ROUND, GAMEMODE, NUM_YES, NUM_NO
+from poll_trace import span
+from poll_analysis import GAMEMODES, LOVED_LEVELS, LOVED_THRESHOLD
+
+
+
+POLL_COLUMNS = [ ROUND, GAMEMODE, NUM_YES, NUM_NO ]
+
+THRESHOLD_RESOLUTION = 1000
+CI_BRUSH = (255, 255, 0, 50)
+RANGE_PEN = (0, 200, 255)
+
+
+def load_polls(selection, query=None):
+    # Runs on the job pool. All columns are mapped so the selection can use their indexes, the partition only takes
+    # the ones graphed.
+    with span('load'):
+        if query is None:
+            query = poll_query.PollQuery(poll_data.load())
+
+        selected_polls = poll_query.select_polls(query, selection, POLL_COLUMNS)
+
+    with span('partition'):
+        partition = poll_analysis.GamemodePartition(selected_polls)
+
+    return query, partition
 
 
-ROUND         = 0
-END_TIME      = 1
-GAMEMODE      = 2
-BEATMAPSET_ID = 3
-TOPIC_ID      = 4
-NUM_YES       = 5
-NUM_NO        = 6
+def load_cube(selection, partition):
+    # Runs on the job pool the first time a round range is asked for. The saved cube covers the whole history, a
+    # selection gets one of its own over only the rounds it has polls in.
+    with span('cube'):
+        return poll_cube.load_cube() if poll_query.is_empty(selection) else poll_cube.build_cube(partition.columns)
 
-STD_GAMEMODE   = 0
-TAIKO_GAMEMODE = 1
-CATCH_GAMEMODE = 2
-MANIA_GAMEMODE = 3
+
+def mode_results(partition, name, percent_threshold):
+    # Runs on the job pool, one mode at a time
+    with span('mode_results', mode=name):
+        return poll_analysis.loved_mode_results(partition, name, percent_threshold)
 
 
 class MainWindow(QtGui.QMainWindow):
     
-    def __init__(self):
+    def __init__(self, num_resamples=0, watch=False, selection=None):
         QtGui.QMainWindow.__init__(self)
 
-        with open('data/player_skills.npy', 'rb') as f:
-            self.poll_data = np.load(f)
+        self.selection = selection
+
+        # Indexes over the loaded polls, kept across selection changes until polls are appended
+        self.query = None
+        self.round_range = None
+
+        self.num_resamples = num_resamples
+        self.threshold_index = {}
 
-        self.std_gamemode_mask    = (self.poll_data[:, GAMEMODE] == STD_GAMEMODE)
-        self.taiko_gamemode_mask  = (self.poll_data[:, GAMEMODE] == TAIKO_GAMEMODE)
-        self.catch_gamemode_mask  = (self.poll_data[:, GAMEMODE] == CATCH_GAMEMODE)
-        self.mania_gamemode_mask  = (self.poll_data[:, GAMEMODE] == MANIA_GAMEMODE)
+        self.watch   = watch
+        self.watcher = None
 
+        # Loved cube for the round range, only loaded once a range is set
+        self.partition      = None
+        self.cube           = None
+        self.cube_requested = False
+
+        # The window and its docks are up before anything is loaded, each dock fills in as its mode's results come in
+        self.jobs = poll_jobs.JobRunner(parent=self)
         self.__init_gui()
+        self.show()
+
+        self.__load_polls()
+
+
+    def __load_polls(self):
+        # Anything still running for the previous load is dropped, the docks say they're loading until theirs are in
+        self.jobs.restart()
+        self.statusBar().clearMessage()
+        self.threshold_index  = {}
+        self.mode_results     = {}
+        self.confidence_bands = None
+        self.partition        = None
+        self.cube             = None
+        self.cube_requested   = False
+
+        for name in GAMEMODES:
+            self.graphs[name]['dock'].setTitle('Loading')
+
+        self.jobs.submit(load_polls, self.selection, self.query, callback=self.__polls_loaded)
+
+
+    def __polls_loaded(self, loaded):
+        self.query, self.partition = loaded
+
+        rounds = self.partition.columns[ROUND]
+        self.round_range_control.set_last_round(int(rounds.max()) if len(rounds) > 0 else 0)
+
+        if self.watch and self.watcher is None:
+            self.watcher = poll_watch.PollWatcher(POLL_COLUMNS, self.query.num_rows, parent=self)
+            self.watcher.pollsAppended.connect(self.__append_polls)
+            self.watcher.pollsReloaded.connect(self.__reload_polls)
+
         self.__graph_results()
+        self.__load_cube()
+
+
+    def __load_cube(self):
+        if self.round_range is None or self.partition is None or self.cube is not None or self.cube_requested:
+            return
+
+        self.cube_requested = True
+        self.jobs.submit(load_cube, self.selection, self.partition, callback=self.__cube_loaded, name='cube')
 
-        self.show()
+
+    def __cube_loaded(self, cube):
+        self.cube = cube
+        for name in self.threshold_index:
+            self.__graph_range(name)
+            self.__update_stats(name)
+
+
+    def __job_failed(self, name, error):
+        # A mode's failure shows in its dock, the load's in all of them, anything else only in the status bar
+        if name is not None and name not in GAMEMODES:
+            self.statusBar().showMessage(f'{name.capitalize()} failed: {error}')
+            return
+
+        for name in GAMEMODES if name is None else [ name ]:
+            self.graphs[name]['dock'].setTitle(f'Failed: {error}')
 
     
     def __init_gui(self):
         self.graphs = {}
         self.area = DockArea()
 
+        self.threshold_control = poll_widgets.ThresholdControl(LOVED_THRESHOLD)
+        self.threshold_control.thresholdChanged.connect(self.__set_threshold)
+        self.addToolBar('Threshold').addWidget(self.threshold_control)
+
+        self.selection_control = poll_widgets.SelectionControl(self.selection)
+        self.selection_control.selectionChanged.connect(self.__set_selection)
+        self.addToolBar('Selection').addWidget(self.selection_control)
+
+        self.round_range_control = poll_widgets.RoundRangeControl()
+        self.round_range_control.roundsChanged.connect(self.__set_round_range)
+        self.addToolBar('Rounds').addWidget(self.round_range_control)
+
+        self.job_progress = poll_widgets.JobProgress()
+        self.jobs.progressChanged.connect(self.job_progress.set_progress)
+        self.jobs.jobFailed.connect(self.job_progress.reset)
+        self.jobs.jobFailed.connect(self.__job_failed)
+        self.statusBar().addPermanentWidget(self.job_progress)
+
         self.__create_graph(
             graph_id  = 'std',
             pos       = 'top',
@@ -103,83 +223,166 @@ class MainWindow(QtGui.QMainWindow):
         self.area.addDock(dock, pos, relativeTo=relative_to)
 
         self.graphs[graph_id] = {
-            'widget' : widget,
-            'dock'   : dock,
-            'plot'   : widget.plot()
+            'widget'         : widget,
+            'dock'           : dock,
+            'plot'           : widget.plot(),
+            'threshold_line' : pyqtgraph.InfiniteLine(pos=self.threshold_control.value(), angle=90, pen=pyqtgraph.mkPen(color=(255, 255, 255, 100))),
+            'ci_low_plot'    : widget.plot(),
+            'ci_high_plot'   : widget.plot(),
+            'range_plot'     : widget.plot(),
         }
 
+        widget.addItem(pyqtgraph.FillBetweenItem(self.graphs[graph_id]['ci_low_plot'], self.graphs[graph_id]['ci_high_plot'], brush=CI_BRUSH))
+        widget.addItem(self.graphs[graph_id]['threshold_line'])
+
 
     def __graph_results(self):
-        yes_votes = self.poll_data[:, NUM_YES]
-        no_votes = self.poll_data[:, NUM_NO]
-        percent_threshold = np.linspace(0, 1, 1000)
-
-        # Std processing
-        std_yes_percent = yes_votes[self.std_gamemode_mask] / (yes_votes[self.std_gamemode_mask] + no_votes[self.std_gamemode_mask])
-        xv, yv = np.meshgrid(percent_threshold, std_yes_percent)
-        std_loved_passing = np.count_nonzero(yv >= xv, axis=0)/len(std_yes_percent)
-
-        # Taiko processing
-        taiko_yes_percent = yes_votes[self.taiko_gamemode_mask] / (yes_votes[self.taiko_gamemode_mask] + no_votes[self.taiko_gamemode_mask])
-        xv, yv = np.meshgrid(percent_threshold, taiko_yes_percent)
-        taiko_loved_passing = np.count_nonzero(yv >= xv, axis=0)/len(taiko_yes_percent)
-
-        # Catch processing
-        catch_yes_percent = yes_votes[self.catch_gamemode_mask] / (yes_votes[self.catch_gamemode_mask] + no_votes[self.catch_gamemode_mask])
-        xv, yv = np.meshgrid(percent_threshold, catch_yes_percent)
-        catch_loved_passing = np.count_nonzero(yv >= xv, axis=0)/len(catch_yes_percent)
-
-        ## Mania processing
-        mania_yes_percent = yes_votes[self.mania_gamemode_mask] / (yes_votes[self.mania_gamemode_mask] + no_votes[self.mania_gamemode_mask])
-        xv, yv = np.meshgrid(percent_threshold, mania_yes_percent)
-        mania_loved_passing = np.count_nonzero(yv >= xv, axis=0)/len(mania_yes_percent)
+        percent_threshold = np.linspace(0, 1, THRESHOLD_RESOLUTION)
+
+        for name in GAMEMODES:
+            self.jobs.submit(mode_results, self.partition, name, percent_threshold, callback=functools.partial(self.__mode_ready, name, percent_threshold), name=name)
+
+        if self.num_resamples > 0:
+            self.jobs.submit(poll_bootstrap.bootstrap, self.partition, percent_threshold, 1, self.num_resamples, callback=functools.partial(self.__bands_ready, percent_threshold), name='bootstrap')
+
+
+    def __mode_ready(self, name, percent_threshold, mode_results):
+        # With a bootstrap still running the curve goes up now and the breakpoints are printed along with their bands
+        self.mode_results[name] = mode_results
+        mode_bands = self.confidence_bands[name] if self.confidence_bands is not None else None
+        self.__graph_mode(name, percent_threshold, mode_results, mode_bands, report=self.num_resamples == 0 or mode_bands is not None)
+
+
+    def __bands_ready(self, percent_threshold, confidence_bands):
+        self.confidence_bands = confidence_bands
+        for name, mode_results in self.mode_results.items():
+            self.__graph_mode(name, percent_threshold, mode_results, confidence_bands[name])
+
+
+    def __graph_mode(self, name, percent_threshold, mode_results, mode_bands=None, report=True):
+        yes_percent   = self.partition.sorted_yes_ratio(name)
+        loved_passing = mode_results['loved_passing']
+
+        self.threshold_index[name] = poll_analysis.ThresholdIndex(yes_percent, self.threshold_control.value())
+        self.__update_stats(name)
 
         # Graphing
-        self.graphs['std']['plot'].setData(percent_threshold[std_loved_passing < 1], std_loved_passing[std_loved_passing < 1], pen='y')
-        self.graphs['taiko']['plot'].setData(percent_threshold[std_loved_passing < 1], taiko_loved_passing[std_loved_passing < 1], pen='y')
-        self.graphs['catch']['plot'].setData(percent_threshold[std_loved_passing < 1], catch_loved_passing[std_loved_passing < 1], pen='y')
-        self.graphs['mania']['plot'].setData(percent_threshold[std_loved_passing < 1], mania_loved_passing[std_loved_passing < 1], pen='y')
+        with span('set_data', mode=name):
+            self.graphs[name]['plot'].setData(percent_threshold[loved_passing < 1], loved_passing[loved_passing < 1], pen='y')
+
+            if mode_bands is not None:
+                ci_loved_passing = mode_bands['loved_passing']
+                self.graphs[name]['ci_low_plot'].setData(percent_threshold[loved_passing < 1], ci_loved_passing[0][loved_passing < 1], pen=pyqtgraph.mkPen(None))
+                self.graphs[name]['ci_high_plot'].setData(percent_threshold[loved_passing < 1], ci_loved_passing[1][loved_passing < 1], pen=pyqtgraph.mkPen(None))
+            else:
+                self.graphs[name]['ci_low_plot'].setData([], [])
+                self.graphs[name]['ci_high_plot'].setData([], [])
+
+        self.__graph_range(name)
+
+        if not report:
+            return
 
         # Print out
-        print('Std:')
-        print(f' 100%: {percent_threshold[std_loved_passing < 1.00][0]}')
-        print(f'  95%: {percent_threshold[std_loved_passing < 0.95][0]}')
-        print(f'  90%: {percent_threshold[std_loved_passing < 0.90][0]}')
-        print(f'  85%: {percent_threshold[std_loved_passing < 0.85][0]}')
-        print(f'  80%: {percent_threshold[std_loved_passing < 0.80][0]}')
-        print(f'  75%: {percent_threshold[std_loved_passing < 0.75][0]}')
-        print(f'  50%: {percent_threshold[std_loved_passing < 0.50][0]}')
-        print()
-        print('Taiko:')
-        print(f' 100%: {percent_threshold[taiko_loved_passing < 1.00][0]}')
-        print(f'  95%: {percent_threshold[taiko_loved_passing < 0.95][0]}')
-        print(f'  90%: {percent_threshold[taiko_loved_passing < 0.90][0]}')
-        print(f'  85%: {percent_threshold[taiko_loved_passing < 0.85][0]}')
-        print(f'  80%: {percent_threshold[taiko_loved_passing < 0.80][0]}')
-        print(f'  75%: {percent_threshold[taiko_loved_passing < 0.75][0]}')
-        print(f'  50%: {percent_threshold[taiko_loved_passing < 0.50][0]}')
-        print()
-        print('Catch:')
-        print(f' 100%: {percent_threshold[catch_loved_passing < 1.00][0]}')
-        print(f'  95%: {percent_threshold[catch_loved_passing < 0.95][0]}')
-        print(f'  90%: {percent_threshold[catch_loved_passing < 0.90][0]}')
-        print(f'  85%: {percent_threshold[catch_loved_passing < 0.85][0]}')
-        print(f'  80%: {percent_threshold[catch_loved_passing < 0.80][0]}')
-        print(f'  75%: {percent_threshold[catch_loved_passing < 0.75][0]}')
-        print(f'  50%: {percent_threshold[catch_loved_passing < 0.50][0]}')
-        print()
-        print('Mania:')
-        print(f' 100%: {percent_threshold[mania_loved_passing < 1.00][0]}')
-        print(f'  95%: {percent_threshold[mania_loved_passing < 0.95][0]}')
-        print(f'  90%: {percent_threshold[mania_loved_passing < 0.90][0]}')
-        print(f'  85%: {percent_threshold[mania_loved_passing < 0.85][0]}')
-        print(f'  80%: {percent_threshold[mania_loved_passing < 0.80][0]}')
-        print(f'  75%: {percent_threshold[mania_loved_passing < 0.75][0]}')
-        print(f'  50%: {percent_threshold[mania_loved_passing < 0.50][0]}')
+        print(f'{name.capitalize()}:')
+        for i, (loved_level, threshold) in enumerate(zip(LOVED_LEVELS, mode_results['breakpoints'])):
+            if mode_bands is not None:
+                ci_low, ci_high = mode_bands['breakpoints'][:, i]
+                print(f' {loved_level*100:>3.0f}%: {threshold} [{ci_low:.3f}, {ci_high:.3f}]')
+            else:
+                print(f' {loved_level*100:>3.0f}%: {threshold}')
         print()
+
+
+    def __append_polls(self, new_polls):
+        # A selection like the last N rounds moves as polls come in, so it is applied again from scratch, and so is
+        # a load still in progress. Either way the kept indexes don't cover the new polls.
+        self.query = None
+        if not poll_query.is_empty(self.selection) or self.jobs.busy():
+            self.__reload_polls()
+            return
+
+        # Only the modes that got new polls are recomputed, without the result cache as the partition has just
+        # changed. Their confidence bands would need a fresh bootstrap over the whole history, so they are dropped
+        # until the next full load instead of shown stale.
+        percent_threshold = np.linspace(0, 1, THRESHOLD_RESOLUTION)
+
+        # The cube is loaded again with them if a round range is still set, the saved one only needs their rows
+        self.cube, self.cube_requested = None, False
+        self.__load_cube()
+
+        with span('append_polls'):
+            for name in self.partition.append(new_polls):
+                self.__graph_mode(name, percent_threshold, poll_analysis.loved_mode(self.partition, name, percent_threshold))
+
+
+    def __set_selection(self, selection):
+        self.selection = selection
+        self.__load_polls()
+
+
+    def __reload_polls(self):
+        self.query = None
+        self.__load_polls()
+
+
+    def __graph_range(self, name):
+        # Loved curve of the polls in the round range, a difference of two rows of the cube
+        if self.round_range is None or self.cube is None:
+            self.graphs[name]['range_plot'].setData([], [])
+            return
+
+        loved_passing = self.cube.loved_curve(name, *self.round_range)
+        self.graphs[name]['range_plot'].setData(self.cube.thresholds[loved_passing < 1], loved_passing[loved_passing < 1], pen=RANGE_PEN)
+
+
+    def __set_round_range(self, round_range):
+        self.round_range = round_range
+        self.__load_cube()
+
+        for name in self.threshold_index:
+            self.__graph_range(name)
+            self.__update_stats(name)
+
+
+    def __set_threshold(self, threshold):
+        for name in GAMEMODES:
+            self.graphs[name]['threshold_line'].setValue(threshold)
+            if name not in self.threshold_index:
+                continue
+
+            changed, _ = self.threshold_index[name].set_threshold(threshold)
+            if changed.start != changed.stop or self.round_range is not None:
+                self.__update_stats(name)
+
+
+    def __update_stats(self, name):
+        threshold_index = self.threshold_index[name]
+        title = f'{threshold_index.num_passing}/{len(threshold_index)} pass ({threshold_index.pass_percent*100:.1f}%)'
+
+        # Polls pass above the threshold, as everywhere else. The round range counts come off the cube, which only
+        # has them at or above the grid thresholds like the loved curve, so the one they were read at is shown.
+        if self.round_range is not None and self.cube is not None:
+            first_round, last_round = self.round_range
+            num_passing = self.cube.num_passing(name, threshold_index.threshold, first_round, last_round)
+            num_polls   = self.cube.num_polls(name, first_round, last_round)
+            pass_rate   = self.cube.pass_rate(name, threshold_index.threshold, first_round, last_round)
+            title += f', rounds {first_round}-{last_round}: {num_passing}/{num_polls} at or above {self.cube.grid_threshold(threshold_index.threshold):.3f} ({pass_rate*100:.1f}%)'
+
+        self.graphs[name]['dock'].setTitle(title)
         
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
-    ex  = MainWindow()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bootstrap', type=int, default=0, help='Number of bootstrap resamples for confidence bands, 0 to skip')
+    poll_query.add_selection_args(parser)
+    parser.add_argument('--watch', action='store_true', help='Ingest and graph polls appended to the csv while the window is open')
+    parser.add_argument('--trace', default=None, help='Write a chrome trace of the load and graphing stages to this file')
+    args, qt_args = parser.parse_known_args()
+
+    if args.trace is not None:
+        poll_trace.enable(args.trace)
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    ex  = MainWindow(num_resamples=args.bootstrap, watch=args.watch, selection=poll_query.selection_from_args(args))
     sys.exit(app.exec_())
\ No newline at end of file
@@ -1,4 +1,6 @@
 import sys
+import argparse
+import functools
 
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
@@ -8,50 +10,150 @@ import pyqtgraph
 from pyqtgraph.Qt import QtCore, QtGui
 from pyqtgraph.dockarea import DockArea
 
-from scipy import stats
-
 import numpy as np
 np.set_printoptions(suppress=True, formatter={ 'float_kind' : '{:0.2f}'.format })
 
+import poll_data
+import poll_analysis
+import poll_trace
+import poll_widgets
+import poll_watch
+import poll_query
+import poll_jobs
+from poll_data import ROUND, GAMEMODE, NUM_YES, NUM_NO
+from poll_trace import span
+from poll_analysis import GAMEMODES, NUM_VOTES, YES_RATIO, LOVED_THRESHOLD
+
+
+
+POLL_COLUMNS = [ ROUND, GAMEMODE, NUM_YES, NUM_NO ]
+
+BRUSH_FAIL = (255, 100, 100, 200)
+BRUSH_PASS = (100, 100, 255, 200)
+
+# Polls that may sit in the flipped overlay before the pass/fail items are refilled. A refill costs the whole mode,
+# so it waits until about as many polls have flipped, and each threshold step before then only redraws the overlay.
+REBASE_POLLS = 2000
+
+
+def load_polls(selection, query=None):
+    # Runs on the job pool. All columns are mapped so the selection can use their indexes, the partition only takes
+    # the ones graphed.
+    with span('load'):
+        if query is None:
+            query = poll_query.PollQuery(poll_data.load())
 
+        selected_polls = poll_query.select_polls(query, selection, POLL_COLUMNS)
 
-ROUND         = 0
-END_TIME      = 1
-GAMEMODE      = 2
-BEATMAPSET_ID = 3
-TOPIC_ID      = 4
-NUM_YES       = 5
-NUM_NO        = 6
+    with span('partition'):
+        partition = poll_analysis.GamemodePartition(selected_polls)
 
-STD_GAMEMODE   = 0
-TAIKO_GAMEMODE = 1
-CATCH_GAMEMODE = 2
-MANIA_GAMEMODE = 3
+    return query, partition
+
+
+def mode_plot_data(partition, name):
+    # Runs on the job pool, one mode at a time
+    cycle             = partition[name][ROUND]
+    votes             = partition[name][NUM_VOTES]
+    percent_yes_votes = partition[name][YES_RATIO]
+
+    # Clipping to the view needs the x values in ascending order. The partition's ratio order is reused, moved
+    # over to the reordered positions when the polls aren't in round order already.
+    ratio_order = partition.ratio_order[name]
+    with span('plot_order', mode=name):
+        if np.any(cycle[1:] < cycle[:-1]):
+            cycle_order       = np.argsort(cycle, kind='stable')
+            cycle             = cycle[cycle_order]
+            votes             = votes[cycle_order]
+            percent_yes_votes = percent_yes_votes[cycle_order]
+
+            plot_position = np.empty(len(cycle_order), dtype=np.int64)
+            plot_position[cycle_order] = np.arange(len(cycle_order))
+            ratio_order = plot_position[ratio_order]
+
+    return {
+        'cycle'            : cycle,
+        'votes'            : votes,
+        'ratio_order'      : ratio_order,
+        'sorted_yes_ratio' : percent_yes_votes[ratio_order],
+    }
 
 
 class MainWindow(QtGui.QMainWindow):
     
-    def __init__(self):
+    def __init__(self, watch=False, selection=None):
         QtGui.QMainWindow.__init__(self)
 
-        with open('data/player_skills.npy', 'rb') as f:
-            self.poll_data = np.load(f)
+        self.selection = selection
+
+        # Indexes over the loaded polls, kept across selection changes until polls are appended
+        self.query = None
+
+        self.plot_data = {}
+        self.threshold_index = {}
 
-        self.std_gamemode_mask    = (self.poll_data[:, GAMEMODE] == STD_GAMEMODE)
-        self.taiko_gamemode_mask  = (self.poll_data[:, GAMEMODE] == TAIKO_GAMEMODE)
-        self.catch_gamemode_mask  = (self.poll_data[:, GAMEMODE] == CATCH_GAMEMODE)
-        self.mania_gamemode_mask  = (self.poll_data[:, GAMEMODE] == MANIA_GAMEMODE)
+        self.watch   = watch
+        self.watcher = None
 
+        # The window and its docks are up before anything is loaded, each dock fills in as its mode's results come in
+        self.jobs = poll_jobs.JobRunner(parent=self)
         self.__init_gui()
+        self.show()
+
+        self.__load_polls()
+
+
+    def __load_polls(self):
+        # Anything still running for the previous load is dropped, the docks say they're loading until theirs are in
+        self.jobs.restart()
+        self.statusBar().clearMessage()
+        self.threshold_index = {}
+
+        for name in GAMEMODES:
+            self.graphs[name]['dock'].setTitle('Loading')
+
+        self.jobs.submit(load_polls, self.selection, self.query, callback=self.__polls_loaded)
+
+
+    def __polls_loaded(self, loaded):
+        self.query, self.partition = loaded
+
+        if self.watch and self.watcher is None:
+            self.watcher = poll_watch.PollWatcher(POLL_COLUMNS, self.query.num_rows, parent=self)
+            self.watcher.pollsAppended.connect(self.__append_polls)
+            self.watcher.pollsReloaded.connect(self.__reload_polls)
+
         self.__graph_results()
 
-        self.show()
+
+    def __job_failed(self, name, error):
+        # A mode's failure shows in its dock, the load's in all of them, anything else only in the status bar
+        if name is not None and name not in GAMEMODES:
+            self.statusBar().showMessage(f'{name.capitalize()} failed: {error}')
+            return
+
+        for name in GAMEMODES if name is None else [ name ]:
+            self.graphs[name]['dock'].setTitle(f'Failed: {error}')
 
     
     def __init_gui(self):
         self.graphs = {}
         self.area = DockArea()
 
+        self.threshold_control = poll_widgets.ThresholdControl(LOVED_THRESHOLD)
+        self.threshold_control.thresholdChanged.connect(self.__set_threshold)
+        self.addToolBar('Threshold').addWidget(self.threshold_control)
+
+        self.selection_control = poll_widgets.SelectionControl(self.selection)
+        self.selection_control.selectionChanged.connect(self.__set_selection)
+        self.addToolBar('Selection').addWidget(self.selection_control)
+
+        self.job_progress = poll_widgets.JobProgress()
+        self.jobs.progressChanged.connect(self.job_progress.set_progress)
+        self.jobs.jobFailed.connect(self.job_progress.reset)
+        self.jobs.jobFailed.connect(self.__job_failed)
+        self.statusBar().addPermanentWidget(self.job_progress)
+
         self.__create_graph(
             graph_id  = 'std',
             pos       = 'top',
@@ -103,56 +205,120 @@ class MainWindow(QtGui.QMainWindow):
         self.area.addDock(dock, pos, relativeTo=relative_to)
 
         self.graphs[graph_id] = {
-            'widget' : widget,
-            'dock'   : dock,
-            'plot'   : widget.plot()
+            'widget'    : widget,
+            'dock'      : dock,
+            'pass_plot' : self.__create_scatter(widget, BRUSH_PASS),
+            'fail_plot' : self.__create_scatter(widget, BRUSH_FAIL),
+            'flip_plot' : self.__create_scatter(widget, BRUSH_FAIL),
         }
 
+        # Polls that flipped since the pass/fail items were last filled are drawn on top of them in their new colour.
+        # They're a run of the ratio order, drawn as is, so this item doesn't clip to the view or subsample, which
+        # need sorted x. It never holds more than REBASE_POLLS points.
+        self.graphs[graph_id]['flip_plot'].setZValue(10)
+        self.graphs[graph_id]['flip_plot'].setClipToView(False)
+        self.graphs[graph_id]['flip_plot'].setDownsampling(auto=False)
+
+
+    def __create_scatter(self, widget, brush):
+        # Each colour is its own item with one shared brush. Only points within the view's x range are drawn, and
+        # those are subsampled down to roughly the number of pixels across when zoomed out on a large history.
+        plot = widget.plot(pen=None, symbol='o', symbolPen=None, symbolSize=2, symbolBrush=brush)
+        plot.setClipToView(True)
+        plot.setDownsampling(auto=True, method='subsample')
+        return plot
+
 
     def __graph_results(self):
-        yes_votes = self.poll_data[:, NUM_YES]
-        no_votes = self.poll_data[:, NUM_NO]
-        cycle = self.poll_data[:, ROUND]
-
-        # Std processing
-        std_votes = yes_votes[self.std_gamemode_mask] + no_votes[self.std_gamemode_mask]
-        std_percent_yes_votes = yes_votes[self.std_gamemode_mask]/std_votes
-        std_cycle = cycle[self.std_gamemode_mask]
-
-        # Taiko processing
-        taiko_votes = yes_votes[self.taiko_gamemode_mask] + no_votes[self.taiko_gamemode_mask]
-        taiko_percent_yes_votes = yes_votes[self.taiko_gamemode_mask]/taiko_votes
-        taiko_cycle = cycle[self.taiko_gamemode_mask]
-
-        # Catch processing
-        catch_votes = yes_votes[self.catch_gamemode_mask] + no_votes[self.catch_gamemode_mask]
-        catch_percent_yes_votes = yes_votes[self.catch_gamemode_mask]/catch_votes
-        catch_cycle = cycle[self.catch_gamemode_mask]
-
-        # Mania processing
-        mania_votes = yes_votes[self.mania_gamemode_mask] + no_votes[self.mania_gamemode_mask]
-        mania_percent_yes_votes = yes_votes[self.mania_gamemode_mask]/mania_votes
-        mania_cycle = cycle[self.mania_gamemode_mask]
-
-        # Scatter plot highlighting
-        brush_fail = (255, 100, 100, 200)
-        brush_pass = (100, 100, 255, 200)
-
-        std_scatter_brush = [ pyqtgraph.mkBrush(brush_fail if std_percent_yes_vote <= 0.85 else brush_pass) for std_percent_yes_vote in std_percent_yes_votes ]
-        taiko_scatter_brush = [ pyqtgraph.mkBrush(brush_fail if taiko_percent_yes_vote <= 0.85 else brush_pass) for taiko_percent_yes_vote in taiko_percent_yes_votes ]
-        catch_scatter_brush = [ pyqtgraph.mkBrush(brush_fail if catch_percent_yes_vote <= 0.85 else brush_pass) for catch_percent_yes_vote in catch_percent_yes_votes ]
-        mania_scatter_brush = [ pyqtgraph.mkBrush(brush_fail if mania_percent_yes_vote <= 0.85 else brush_pass) for mania_percent_yes_vote in mania_percent_yes_votes ]
+        for name in GAMEMODES:
+            self.jobs.submit(mode_plot_data, self.partition, name, callback=functools.partial(self.__graph_mode, name), name=name)
+
+
+    def __graph_mode(self, name, plot_data):
+        self.plot_data[name] = plot_data
+        self.threshold_index[name] = poll_analysis.ThresholdIndex(plot_data['sorted_yes_ratio'], self.threshold_control.value())
+
+        self.__graph_base(name)
+        self.__update_stats(name)
+
+
+    def __append_polls(self, new_polls):
+        # A selection like the last N rounds moves as polls come in, so it is applied again from scratch, and so is
+        # a load still in progress. Either way the kept indexes don't cover the new polls.
+        self.query = None
+        if not poll_query.is_empty(self.selection) or self.jobs.busy():
+            self.__reload_polls()
+            return
+
+        # Only the modes that got new polls are redrawn
+        with span('append_polls'):
+            for name in self.partition.append(new_polls):
+                self.__graph_mode(name, mode_plot_data(self.partition, name))
+
+
+    def __set_selection(self, selection):
+        self.selection = selection
+        self.__load_polls()
+
+
+    def __reload_polls(self):
+        self.query = None
+        self.__load_polls()
+
+
+    def __graph_base(self, name):
+        # Fills the pass/fail items at the current threshold and empties the flipped overlay
+        cycle = self.plot_data[name]['cycle']
+        votes = self.plot_data[name]['votes']
+
+        passing = np.zeros(len(cycle), dtype=bool)
+        passing[self.plot_data[name]['ratio_order'][self.threshold_index[name].num_failing:]] = True
 
         # Graphing
-        self.graphs['std']['plot'].setData(std_cycle, std_votes, pen=None, symbol='o', symbolPen=None, symbolSize=2, symbolBrush=std_scatter_brush)
-        self.graphs['taiko']['plot'].setData(taiko_cycle, taiko_votes, pen=None, symbol='o', symbolPen=None, symbolSize=2, symbolBrush=taiko_scatter_brush)
-        self.graphs['catch']['plot'].setData(catch_cycle, catch_votes, pen=None, symbol='o', symbolPen=None, symbolSize=2, symbolBrush=catch_scatter_brush)
-        self.graphs['mania']['plot'].setData(mania_cycle, mania_votes, pen=None, symbol='o', symbolPen=None, symbolSize=2, symbolBrush=mania_scatter_brush)
+        with span('set_data', mode=name):
+            self.graphs[name]['pass_plot'].setData(cycle[passing], votes[passing])
+            self.graphs[name]['fail_plot'].setData(cycle[~passing], votes[~passing])
+            self.graphs[name]['flip_plot'].setData([], [])
 
+        self.plot_data[name]['base_num_failing'] = self.threshold_index[name].num_failing
+
+
+    def __set_threshold(self, threshold):
+        for name in self.threshold_index:
+            changed, _ = self.threshold_index[name].set_threshold(threshold)
+            if changed.start == changed.stop:
+                continue
+
+            # Polls in ratio order between the split the pass/fail items were filled at and the current split are
+            # the ones drawn in a different colour now, at most REBASE_POLLS of them
+            num_failing      = self.threshold_index[name].num_failing
+            base_num_failing = self.plot_data[name]['base_num_failing']
+            flipped = self.plot_data[name]['ratio_order'][min(num_failing, base_num_failing):max(num_failing, base_num_failing)]
+
+            if len(flipped) > REBASE_POLLS:
+                self.__graph_base(name)
+            else:
+                self.graphs[name]['flip_plot'].setData(self.plot_data[name]['cycle'][flipped], self.plot_data[name]['votes'][flipped])
+                self.graphs[name]['flip_plot'].setSymbolBrush(BRUSH_PASS if num_failing < base_num_failing else BRUSH_FAIL)
+
+            self.__update_stats(name)
+
+
+    def __update_stats(self, name):
+        threshold_index = self.threshold_index[name]
+        self.graphs[name]['dock'].setTitle(f'{threshold_index.num_passing}/{len(threshold_index)} pass ({threshold_index.pass_percent*100:.1f}%)')
 
-        
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
-    ex  = MainWindow()
+    parser = argparse.ArgumentParser()
+    poll_query.add_selection_args(parser)
+    parser.add_argument('--watch', action='store_true', help='Ingest and graph polls appended to the csv while the window is open')
+    parser.add_argument('--trace', default=None, help='Write a chrome trace of the load and graphing stages to this file')
+    args, qt_args = parser.parse_known_args()
+
+    if args.trace is not None:
+        poll_trace.enable(args.trace)
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    ex  = MainWindow(watch=args.watch, selection=poll_query.selection_from_args(args))
     sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,324 @@
+import json
+import math
+import asyncio
+import argparse
+import collections
+import urllib.parse
+import concurrent.futures
+
+import numpy as np
+
+import poll_data
+import poll_analysis
+import poll_timeseries
+import poll_trace
+import poll_query
+import poll_groups
+import result_cache
+import run_batch
+from poll_trace import span
+from poll_data import ROUND, END_TIME, GAMEMODE, NUM_YES, NUM_NO
+from poll_analysis import GAMEMODES, NUM_VOTES, YES_RATIO, LOVED_THRESHOLD
+
+
+HOST = '127.0.0.1'
+PORT = 8000
+
+# Encoded responses and per-selection partitions kept in memory, least recently used go first
+MAX_RESPONSES  = 256
+MAX_PARTITIONS = 16
+
+# Caps on the parameters that size a computation
+MAX_THRESHOLD_RESOLUTION = 100000
+MAX_BINS                 = 10000
+MAX_WINDOW               = 10000
+
+# Parameter parsers and defaults per endpoint, on top of the selection parameters every endpoint takes
+ENDPOINT_PARAMS = {
+    '/loved_percent' : { 'threshold_resolution' : (int, 1000) },
+    '/yes_vote'      : { 'bins' : (int, 20), 'ratio_bins' : (int, 20) },
+    '/participation' : { 'loved_threshold' : (float, LOVED_THRESHOLD) },
+    '/timeseries'    : { 'window' : (int, 8), 'window_days' : (float, None), 'loved_threshold' : (float, LOVED_THRESHOLD) },
+}
+
+SELECTION_PARAMS = {
+    'rounds'      : str,
+    'last_rounds' : int,
+    'since'       : str,
+    'until'       : str,
+    'beatmapset'  : int,
+    'topic'       : int,
+    'search'      : str,
+    'dedup'       : str,
+}
+
+STATUS_TEXT = {
+    200 : 'OK',
+    400 : 'Bad Request',
+    404 : 'Not Found',
+    405 : 'Method Not Allowed',
+    500 : 'Internal Server Error',
+}
+
+
+def json_safe(value):
+    # NaN isn't valid json, it goes out as null like run_batch writes it
+    if isinstance(value, dict):
+        return { str(key) : json_safe(item) for key, item in value.items() }
+
+    if isinstance(value, (list, tuple)):
+        return [ json_safe(item) for item in value ]
+
+    if isinstance(value, (float, np.floating)):
+        return None if math.isnan(value) else float(value)
+
+    if isinstance(value, np.integer):
+        return int(value)
+
+    return value
+
+
+def parse_params(path, query):
+    # Query string into the endpoint's parameters and a selection as poll_query.select_polls takes it. Anything
+    # unknown is refused rather than ignored, so it can't split the response cache.
+    values    = urllib.parse.parse_qs(query, strict_parsing=False)
+    params    = {}
+    selection = { name : None for name in SELECTION_PARAMS }
+    selection['gamemodes'] = None
+
+    for name, items in values.items():
+        if name == 'gamemode':
+            unknown = [ item for item in items if item not in GAMEMODES ]
+            if len(unknown) > 0:
+                raise ValueError(f'Unknown gamemode {unknown[0]}')
+
+            selection['gamemodes'] = sorted(set(items), key=list(GAMEMODES).index)
+        elif name in SELECTION_PARAMS:
+            selection[name] = SELECTION_PARAMS[name](items[-1])
+        elif name in ENDPOINT_PARAMS[path]:
+            params[name] = ENDPOINT_PARAMS[path][name][0](items[-1])
+        else:
+            raise ValueError(f'Unknown parameter {name}')
+
+    for name, (_, default) in ENDPOINT_PARAMS[path].items():
+        params.setdefault(name, default)
+
+    if selection['dedup'] not in (None, poll_groups.KEEP_LATEST, poll_groups.KEEP_BEST):
+        raise ValueError(f'dedup must be {poll_groups.KEEP_LATEST} or {poll_groups.KEEP_BEST}')
+
+    if not 2 <= params.get('threshold_resolution', 2) <= MAX_THRESHOLD_RESOLUTION:
+        raise ValueError(f'threshold_resolution must be between 2 and {MAX_THRESHOLD_RESOLUTION}')
+
+    if not 1 <= params.get('bins', 1) <= MAX_BINS or not 1 <= params.get('ratio_bins', 1) <= MAX_BINS:
+        raise ValueError(f'bins must be between 1 and {MAX_BINS}')
+
+    if not 1 <= params.get('window', 1) <= MAX_WINDOW:
+        raise ValueError(f'window must be between 1 and {MAX_WINDOW}')
+
+    if params.get('window_days') is not None and not params['window_days'] > 0:
+        raise ValueError('window_days must be positive')
+
+    return params, selection
+
+
+def participation_results(partition, loved_threshold):
+    # Columns per mode rather than run_batch's one row per poll
+    results = {}
+
+    for name in GAMEMODES:
+        mode = partition[name]
+        results[name] = {
+            'round'     : mode[ROUND].tolist(),
+            'num_votes' : mode[NUM_VOTES].tolist(),
+            'yes_ratio' : mode[YES_RATIO].tolist(),
+            'passed'    : (mode[YES_RATIO] > loved_threshold).tolist(),
+        }
+
+    return results
+
+
+def timeseries_results(partition, window, window_days, loved_threshold):
+    if window_days is not None:
+        return run_batch.timeseries_results(partition, int(window_days*24*3600), poll_timeseries.BY_TIME, loved_threshold)
+
+    return run_batch.timeseries_results(partition, window, poll_timeseries.BY_ROUNDS, loved_threshold)
+
+
+ENDPOINTS = {
+    '/loved_percent' : lambda partition, params: run_batch.loved_percent_results(partition, params['threshold_resolution']),
+    '/yes_vote'      : lambda partition, params: run_batch.yes_vote_results(partition, params['bins'], num_ratio_bins=params['ratio_bins']),
+    '/participation' : lambda partition, params: participation_results(partition, params['loved_threshold']),
+    '/timeseries'    : lambda partition, params: timeseries_results(partition, params['window'], params['window_days'], params['loved_threshold']),
+}
+
+
+class PollServer():
+
+    def __init__(self, data_dir=poll_data.DATA_DIR, max_responses=MAX_RESPONSES, max_partitions=MAX_PARTITIONS):
+        # The polls are loaded once. Responses are computed on a single worker thread, so misses don't contend with
+        # each other for the interpreter, and the event loop keeps answering from the response cache while one runs.
+        # Concurrent requests for the same response wait on the one computation.
+        self.data_dir       = data_dir
+        self.poll_data      = poll_data.load(data_dir)
+        self.query          = poll_query.PollQuery(self.poll_data)
+        self.max_responses  = max_responses
+        self.max_partitions = max_partitions
+
+        self.responses  = collections.OrderedDict()
+        self.partitions = collections.OrderedDict()
+        self.pending    = {}
+        self.executor   = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self.counts = collections.Counter()
+
+
+    def partition(self, selection):
+        # Only touched from the worker thread
+        key = json.dumps(selection, sort_keys=True)
+        if key in self.partitions:
+            self.partitions.move_to_end(key)
+            return self.partitions[key]
+
+        with span('server.partition'):
+            columns   = poll_query.select_polls(self.query, selection, [ ROUND, END_TIME, GAMEMODE, NUM_YES, NUM_NO ], self.data_dir)
+            partition = poll_analysis.GamemodePartition(columns)
+
+        self.partitions[key] = partition
+        while len(self.partitions) > self.max_partitions:
+            self.partitions.popitem(last=False)
+
+        return partition
+
+
+    def compute(self, path, params, selection):
+        with span(f'server{path.replace("/", ".")}'):
+            results = ENDPOINTS[path](self.partition(selection), params)
+            if selection['gamemodes'] is not None:
+                results = { name : results[name] for name in selection['gamemodes'] }
+
+            return json.dumps(json_safe(results)).encode()
+
+
+    async def response(self, path, params, selection):
+        # Returns the encoded response and whether it was a hit, shared with a request already computing it, or a miss
+        key = (path, json.dumps(params, sort_keys=True), json.dumps(selection, sort_keys=True))
+        if key in self.responses:
+            self.responses.move_to_end(key)
+            return self.responses[key], 'hit'
+
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key]), 'shared'
+
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self.compute, path, params, selection)
+        self.pending[key] = future
+        try:
+            body = await asyncio.shield(future)
+        finally:
+            del self.pending[key]
+
+        self.responses[key] = body
+        while len(self.responses) > self.max_responses:
+            self.responses.popitem(last=False)
+
+        return body, 'miss'
+
+
+    async def route(self, method, target):
+        # Returns status, body and the cache outcome
+        if method != 'GET':
+            return 405, json.dumps({ 'error' : f'{method} not allowed' }).encode(), None
+
+        path, _, query = target.partition('?')
+        if path == '/stats':
+            stats = dict(self.counts, rows=len(next(iter(self.poll_data.values()))), responses=len(self.responses), partitions=len(self.partitions), pending=len(self.pending))
+            return 200, json.dumps(stats).encode(), None
+
+        if path not in ENDPOINTS:
+            return 404, json.dumps({ 'error' : f'No endpoint {path}', 'endpoints' : list(ENDPOINTS) + [ '/stats' ] }).encode(), None
+
+        try:
+            params, selection = parse_params(path, query)
+            body, outcome = await self.response(path, params, selection)
+        except ValueError as e:
+            return 400, json.dumps({ 'error' : str(e) }).encode(), None
+        except Exception as e:
+            return 500, json.dumps({ 'error' : f'{type(e).__name__}: {e}' }).encode(), None
+
+        self.counts[outcome] += 1
+        return 200, body, outcome
+
+
+    async def handle(self, reader, writer):
+        # Minimal HTTP/1.1, GET only, with keep-alive so a client can send its requests down one connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                parts = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                if len(parts) != 3:
+                    status, body, outcome = 400, json.dumps({ 'error' : 'Malformed request line' }).encode(), None
+                    keep_alive = False
+                else:
+                    method, target, version = parts
+                    status, body, outcome = await self.route(method, target)
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                self.counts['requests'] += 1
+                head = [
+                    f'HTTP/1.1 {status} {STATUS_TEXT[status]}',
+                    'Content-Type: application/json',
+                    f'Content-Length: {len(body)}',
+                    f'Connection: {"keep-alive" if keep_alive else "close"}',
+                ]
+                if outcome is not None:
+                    head.append(f'X-Cache: {outcome}')
+
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def serve(self, host=HOST, port=PORT):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'Serving {len(next(iter(self.poll_data.values())))} polls on http://{host}:{port}')
+
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the loved percent, yes vote, participation and time series analyses as json over HTTP')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--max-responses', type=int, default=MAX_RESPONSES, help='Encoded responses kept in memory')
+    parser.add_argument('--no-cache', action='store_true', help='Keep results in memory only, without reading or writing the result cache on disk')
+    parser.add_argument('--trace', default=None, help='Write a chrome trace of the computations to this file on exit')
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        poll_trace.enable(args.trace)
+
+    if args.no_cache:
+        result_cache.default_cache.cache_dir = None
+
+    try:
+        asyncio.run(PollServer(max_responses=args.max_responses).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
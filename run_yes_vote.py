@@ -1,4 +1,6 @@
 import sys
+import argparse
+import functools
 
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
@@ -8,76 +10,147 @@ import pyqtgraph
 from pyqtgraph.Qt import QtCore, QtGui
 from pyqtgraph.dockarea import DockArea
 
-from scipy import stats
-
 import numpy as np
 np.set_printoptions(suppress=True, formatter={ 'float_kind' : '{:0.2f}'.format })
 
+import poll_data
+import poll_analysis
+import poll_trace
+import poll_bootstrap
+import poll_watch
+import poll_widgets
+import poll_query
+import poll_jobs
+from poll_data import GAMEMODE, NUM_YES, NUM_NO
+from poll_trace import span
+from poll_analysis import GAMEMODES, NUM_VOTES, YES_RATIO
+
+
+
+POLL_COLUMNS = [ GAMEMODE, NUM_YES, NUM_NO ]
+
+NUM_BINS = 20
+PERCENTILE_BAND = (25, 75)
+CI_BRUSH = (100, 255, 255, 50)
+
+# The % yes axis of the heatmap is binned the same for every mode
+RATIO_EDGES = np.linspace(0, 1, 21)
+
+
+def load_polls(selection, query=None):
+    # Runs on the job pool. All columns are mapped so the selection can use their indexes, the partition only takes
+    # the ones graphed.
+    with span('load'):
+        if query is None:
+            query = poll_query.PollQuery(poll_data.load())
+
+        selected_polls = poll_query.select_polls(query, selection, POLL_COLUMNS)
+
+    with span('partition'):
+        partition = poll_analysis.GamemodePartition(selected_polls)
 
+    return query, partition
 
-ROUND         = 0
-END_TIME      = 1
-GAMEMODE      = 2
-BEATMAPSET_ID = 3
-TOPIC_ID      = 4
-NUM_YES       = 5
-NUM_NO        = 6
 
-STD_GAMEMODE   = 0
-TAIKO_GAMEMODE = 1
-CATCH_GAMEMODE = 2
-MANIA_GAMEMODE = 3
+def mode_results(partition, name):
+    # Runs on the job pool, one mode at a time. The same vote bins serve the line stats and the heatmap.
+    with span('mode_results', mode=name):
+        return poll_analysis.yes_vote_mode_results(partition, name, NUM_BINS, (PERCENTILE_BAND[0], 50, PERCENTILE_BAND[1]), RATIO_EDGES)
 
 
 class MainWindow(QtGui.QMainWindow):
     
-    def __init__(self):
+    def __init__(self, num_resamples=0, watch=False, selection=None):
         QtGui.QMainWindow.__init__(self)
 
-        with open('data/player_skills.npy', 'rb') as f:
-            self.poll_data = np.load(f)
+        self.selection = selection
 
-        self.std_gamemode_mask    = (self.poll_data[:, GAMEMODE] == STD_GAMEMODE)
-        self.taiko_gamemode_mask  = (self.poll_data[:, GAMEMODE] == TAIKO_GAMEMODE)
-        self.catch_gamemode_mask  = (self.poll_data[:, GAMEMODE] == CATCH_GAMEMODE)
-        self.mania_gamemode_mask  = (self.poll_data[:, GAMEMODE] == MANIA_GAMEMODE)
+        # Indexes over the loaded polls, kept across selection changes until polls are appended
+        self.query = None
 
+        self.num_resamples = num_resamples
+
+        self.watch   = watch
+        self.watcher = None
+
+        # The window and its docks are up before anything is loaded, each dock fills in as its mode's results come in
+        self.jobs = poll_jobs.JobRunner(parent=self)
         self.__init_gui()
+        self.show()
+
+        self.__load_polls()
+
+
+    def __load_polls(self):
+        # Anything still running for the previous load is dropped, the docks say they're loading until theirs are in
+        self.jobs.restart()
+        self.statusBar().clearMessage()
+        self.mode_results     = {}
+        self.confidence_bands = None
+
+        for name in GAMEMODES:
+            self.graphs[name]['dock'].setTitle('Loading')
+
+        self.jobs.submit(load_polls, self.selection, self.query, callback=self.__polls_loaded)
+
+
+    def __polls_loaded(self, loaded):
+        self.query, self.partition = loaded
+
+        if self.watch and self.watcher is None:
+            self.watcher = poll_watch.PollWatcher(POLL_COLUMNS, self.query.num_rows, parent=self)
+            self.watcher.pollsAppended.connect(self.__append_polls)
+            self.watcher.pollsReloaded.connect(self.__reload_polls)
+
         self.__graph_results()
 
-        self.show()
+
+    def __job_failed(self, name, error):
+        # A mode's failure shows in its dock, the load's in all of them, anything else only in the status bar
+        if name is not None and name not in GAMEMODES:
+            self.statusBar().showMessage(f'{name.capitalize()} failed: {error}')
+            return
+
+        for name in GAMEMODES if name is None else [ name ]:
+            self.graphs[name]['dock'].setTitle(f'Failed: {error}')
 
     
     def __init_gui(self):
         self.graphs = {}
         self.area = DockArea()
 
+        self.heatmap_checkbox = QCheckBox('Heatmap')
+        self.heatmap_checkbox.toggled.connect(self.__show_heatmap)
+        self.addToolBar('Layers').addWidget(self.heatmap_checkbox)
+
+        self.selection_control = poll_widgets.SelectionControl(self.selection)
+        self.selection_control.selectionChanged.connect(self.__set_selection)
+        self.addToolBar('Selection').addWidget(self.selection_control)
+
+        self.job_progress = poll_widgets.JobProgress()
+        self.jobs.progressChanged.connect(self.job_progress.set_progress)
+        self.jobs.jobFailed.connect(self.job_progress.reset)
+        self.jobs.jobFailed.connect(self.__job_failed)
+        self.statusBar().addPermanentWidget(self.job_progress)
+
         self.__create_graph(
             graph_id  = 'std',
             pos       = 'top',
             widget    = pyqtgraph.PlotWidget(title='Std participation vs % Yes votes'),
         )
 
-        self.std_mean_plot = self.graphs['std']['widget'].plot()
-        self.std_mean_plot.setZValue(10)
-
         self.__create_graph(
             graph_id  = 'taiko',
             pos       = 'right',
             widget    = pyqtgraph.PlotWidget(title='Taiko participation vs % Yes votes'),
         )
 
-        self.taiko_mean_plot = self.graphs['taiko']['widget'].plot()
-        self.taiko_mean_plot.setZValue(10)
-
         self.__create_graph(
             graph_id  = 'catch',
             pos       = 'bottom',
             widget    = pyqtgraph.PlotWidget(title='Catch participation vs % Yes votes'),
         )
 
-        self.catch_mean_plot = self.graphs['catch']['widget'].plot()
-
         self.__create_graph(
             graph_id  = 'mania',
             pos       = 'right',
@@ -85,9 +158,6 @@ class MainWindow(QtGui.QMainWindow):
             widget    = pyqtgraph.PlotWidget(title='Mania participation vs % Yes votes'),
         )
 
-        self.mania_mean_plot = self.graphs['mania']['widget'].plot()
-        self.mania_mean_plot.setZValue(10)
-
         self.graphs['std']['widget'].setLabel('left', '% Yes')
         self.graphs['std']['widget'].setLabel('bottom', '# Total Votes')
         
@@ -114,80 +184,120 @@ class MainWindow(QtGui.QMainWindow):
         self.area.addDock(dock, pos, relativeTo=relative_to)
 
         self.graphs[graph_id] = {
-            'widget' : widget,
-            'dock'   : dock,
-            'plot'   : widget.plot()
+            'widget'       : widget,
+            'dock'         : dock,
+            'plot'         : widget.plot(),
+            'mean_plot'    : widget.plot(),
+            'median_plot'  : widget.plot(),
+            'low_plot'     : widget.plot(),
+            'high_plot'    : widget.plot(),
+            'heatmap'      : pyqtgraph.ImageItem(compositionMode=QtGui.QPainter.CompositionMode_Plus),
+            'ci_low_plot'  : widget.plot(),
+            'ci_high_plot' : widget.plot(),
         }
-    
 
-    def __graph_results(self):
-        yes_votes = self.poll_data[:, NUM_YES]
-        no_votes = self.poll_data[:, NUM_NO]
+        widget.addItem(pyqtgraph.FillBetweenItem(self.graphs[graph_id]['low_plot'], self.graphs[graph_id]['high_plot'], brush=(255, 255, 0, 40)))
+        widget.addItem(pyqtgraph.FillBetweenItem(self.graphs[graph_id]['ci_low_plot'], self.graphs[graph_id]['ci_high_plot'], brush=CI_BRUSH))
+        widget.addItem(self.graphs[graph_id]['heatmap'])
 
-        # Std processing
-        std_yes_votes = yes_votes[self.std_gamemode_mask]
-        std_no_votes = no_votes[self.std_gamemode_mask]
-        std_votes = std_yes_votes + std_no_votes
-
-        std_sort_idx = np.argsort(std_votes)
-        std_votes = std_votes[std_sort_idx]
-        std_yes_votes = std_yes_votes[std_sort_idx]
+        self.graphs[graph_id]['mean_plot'].setZValue(10)
+        self.graphs[graph_id]['median_plot'].setZValue(10)
+        self.graphs[graph_id]['heatmap'].setZValue(-10)
+        self.graphs[graph_id]['heatmap'].setVisible(False)
+    
 
-        std_mean_yes_votes_percent, std_bin_votes, _ = stats.binned_statistic(std_votes, std_yes_votes/std_votes, statistic='mean', bins=20)
-        
-        #heatmap, _, _ = np.histogram2d(std_votes, std_yes_votes/std_votes, bins=[ 40, 20 ])
-        #print(np.where(heatmap == np.max(heatmap)))
-        #heatmap_img = pyqtgraph.ImageItem(heatmap, compositionMode=QtGui.QPainter.CompositionMode_Plus)
-        #heatmap_img.setRect(QRectF(min(std_votes), min(std_yes_votes/std_votes), max(std_votes) - min(std_votes), max(std_yes_votes/std_votes) - min(std_yes_votes/std_votes)))
-        #heatmap_img.setParentItem(self.graphs['std']['plot'])
-        #self.graphs['std']['widget'].addItem(heatmap_img)
+    def __graph_results(self):
+        for name in GAMEMODES:
+            self.jobs.submit(mode_results, self.partition, name, callback=functools.partial(self.__mode_ready, name), name=name)
 
-        # Taiko processing
-        taiko_yes_votes = yes_votes[self.taiko_gamemode_mask]
-        taiko_no_votes = no_votes[self.taiko_gamemode_mask]
-        taiko_votes = taiko_yes_votes + taiko_no_votes
+        if self.num_resamples > 0:
+            self.jobs.submit(poll_bootstrap.bootstrap, self.partition, np.linspace(0, 1, 2), NUM_BINS, self.num_resamples, callback=self.__bands_ready, name='bootstrap')
 
-        taiko_sort_idx = np.argsort(taiko_votes)
-        taiko_votes = taiko_votes[taiko_sort_idx]
-        taiko_yes_votes = taiko_yes_votes[taiko_sort_idx]
 
-        taiko_mean_yes_votes_percent, taiko_bin_votes, _ = stats.binned_statistic(taiko_votes, taiko_yes_votes/taiko_votes, statistic='mean', bins=20)
+    def __mode_ready(self, name, yes_votes_stats):
+        self.mode_results[name] = yes_votes_stats
+        self.graphs[name]['dock'].setTitle(' ')
+        self.__graph_mode(name, yes_votes_stats, self.confidence_bands[name] if self.confidence_bands is not None else None)
 
-        # Catch processing
-        catch_yes_votes = yes_votes[self.catch_gamemode_mask]
-        catch_no_votes = no_votes[self.catch_gamemode_mask]
-        catch_votes = catch_yes_votes + catch_no_votes
 
-        catch_sort_idx = np.argsort(catch_votes)
-        catch_votes = catch_votes[catch_sort_idx]
-        catch_yes_votes = catch_yes_votes[catch_sort_idx]
+    def __bands_ready(self, confidence_bands):
+        self.confidence_bands = confidence_bands
+        for name, yes_votes_stats in self.mode_results.items():
+            self.__graph_mode(name, yes_votes_stats, confidence_bands[name])
 
-        catch_mean_yes_votes_percent, catch_bin_votes, _ = stats.binned_statistic(catch_votes, catch_yes_votes/catch_votes, statistic='mean', bins=20)
 
-        # Mania processing
-        mania_yes_votes = yes_votes[self.mania_gamemode_mask]
-        mania_no_votes = no_votes[self.mania_gamemode_mask]
-        mania_votes = mania_yes_votes + mania_no_votes
+    def __graph_mode(self, name, yes_votes_stats, mode_bands=None):
+        votes       = self.partition[name][NUM_VOTES]
+        yes_percent = self.partition[name][YES_RATIO]
 
-        mania_sort_idx = np.argsort(mania_votes)
-        mania_votes = mania_votes[mania_sort_idx]
-        mania_yes_votes = mania_yes_votes[mania_sort_idx]
+        bin_votes = yes_votes_stats['bin_edges']
 
-        mania_mean_yes_votes_percent, mania_bin_votes, _ = stats.binned_statistic(mania_votes, mania_yes_votes/mania_votes, statistic='mean', bins=20)
+        # Only bins with polls in them get a point on the percentile lines so the band has no holes
+        has_polls = yes_votes_stats['count'] > 0
+        percentiles = yes_votes_stats['percentiles']
 
         # Graphing
-        self.graphs['std']['plot'].setData(std_votes, std_yes_votes/std_votes, pen=None, symbol='o', symbolPen=None, symbolSize=2, symbolBrush=(100, 100, 255, 200))
-        self.graphs['taiko']['plot'].setData(taiko_votes, taiko_yes_votes/taiko_votes, pen=None, symbol='o', symbolPen=None, symbolSize=2, symbolBrush=(100, 100, 255, 200))
-        self.graphs['catch']['plot'].setData(catch_votes, catch_yes_votes/catch_votes, pen=None, symbol='o', symbolPen=None, symbolSize=2, symbolBrush=(100, 100, 255, 200))
-        self.graphs['mania']['plot'].setData(mania_votes, mania_yes_votes/mania_votes, pen=None, symbol='o', symbolPen=None, symbolSize=2, symbolBrush=(100, 100, 255, 200))
-
-        self.std_mean_plot.setData(std_bin_votes[:-1], std_mean_yes_votes_percent, pen=pyqtgraph.mkPen(color=(255, 255, 0, 100)))
-        self.taiko_mean_plot.setData(taiko_bin_votes[:-1], taiko_mean_yes_votes_percent, pen=pyqtgraph.mkPen(color=(255, 255, 0, 100)))
-        self.catch_mean_plot.setData(catch_bin_votes[:-1], catch_mean_yes_votes_percent, pen=pyqtgraph.mkPen(color=(255, 255, 0, 100)))
-        self.mania_mean_plot.setData(mania_bin_votes[:-1], mania_mean_yes_votes_percent, pen=pyqtgraph.mkPen(color=(255, 255, 0, 100)))
+        with span('set_data', mode=name):
+            self.graphs[name]['plot'].setData(votes, yes_percent, pen=None, symbol='o', symbolPen=None, symbolSize=2, symbolBrush=(100, 100, 255, 200))
+            self.graphs[name]['mean_plot'].setData(bin_votes[:-1], yes_votes_stats['mean'], pen=pyqtgraph.mkPen(color=(255, 255, 0, 100)))
+            self.graphs[name]['median_plot'].setData(bin_votes[:-1][has_polls], percentiles[50][has_polls], pen=pyqtgraph.mkPen(color=(255, 255, 0, 100), style=Qt.DashLine))
+            self.graphs[name]['low_plot'].setData(bin_votes[:-1][has_polls], percentiles[PERCENTILE_BAND[0]][has_polls], pen=pyqtgraph.mkPen(None))
+            self.graphs[name]['high_plot'].setData(bin_votes[:-1][has_polls], percentiles[PERCENTILE_BAND[1]][has_polls], pen=pyqtgraph.mkPen(None))
+
+            if mode_bands is not None:
+                ci_mean_yes_percent = mode_bands['mean_yes_percent']
+                self.graphs[name]['ci_low_plot'].setData(bin_votes[:-1][has_polls], ci_mean_yes_percent[0][has_polls], pen=pyqtgraph.mkPen(None))
+                self.graphs[name]['ci_high_plot'].setData(bin_votes[:-1][has_polls], ci_mean_yes_percent[1][has_polls], pen=pyqtgraph.mkPen(None))
+            else:
+                self.graphs[name]['ci_low_plot'].setData([], [])
+                self.graphs[name]['ci_high_plot'].setData([], [])
+
+            heatmap = self.graphs[name]['heatmap']
+            heatmap.setImage(yes_votes_stats['density'], levels=(0, max(1, yes_votes_stats['density'].max())))
+            heatmap.setRect(QRectF(bin_votes[0], RATIO_EDGES[0], bin_votes[-1] - bin_votes[0], RATIO_EDGES[-1] - RATIO_EDGES[0]))
+
+
+    def __append_polls(self, new_polls):
+        # A selection like the last N rounds moves as polls come in, so it is applied again from scratch, and so is
+        # a load still in progress. Either way the kept indexes don't cover the new polls.
+        self.query = None
+        if not poll_query.is_empty(self.selection) or self.jobs.busy():
+            self.__reload_polls()
+            return
+
+        # Only the modes that got new polls are recomputed, and lose their confidence bands as in run_loved_percent.py
+        with span('append_polls'):
+            for name in self.partition.append(new_polls):
+                self.mode_results[name] = poll_analysis.yes_vote_mode(self.partition, name, NUM_BINS, (PERCENTILE_BAND[0], 50, PERCENTILE_BAND[1]), RATIO_EDGES)
+                self.__graph_mode(name, self.mode_results[name])
+
+
+    def __set_selection(self, selection):
+        self.selection = selection
+        self.__load_polls()
+
+
+    def __reload_polls(self):
+        self.query = None
+        self.__load_polls()
+
+
+    def __show_heatmap(self, visible):
+        for name in GAMEMODES:
+            self.graphs[name]['heatmap'].setVisible(visible)
       
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
-    ex  = MainWindow()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bootstrap', type=int, default=0, help='Number of bootstrap resamples for confidence bands, 0 to skip')
+    poll_query.add_selection_args(parser)
+    parser.add_argument('--watch', action='store_true', help='Ingest and graph polls appended to the csv while the window is open')
+    parser.add_argument('--trace', default=None, help='Write a chrome trace of the load and graphing stages to this file')
+    args, qt_args = parser.parse_known_args()
+
+    if args.trace is not None:
+        poll_trace.enable(args.trace)
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    ex  = MainWindow(num_resamples=args.bootstrap, watch=args.watch, selection=poll_query.selection_from_args(args))
     sys.exit(app.exec_())
\ No newline at end of file